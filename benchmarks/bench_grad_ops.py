@@ -0,0 +1,60 @@
+"""Graph build time and size of the per-device-count gradient ops
+
+Run with `python benchmarks/bench_grad_ops.py`. For 1 to 8 virtual CPU
+devices, build a small convolutional tower per device and the gradient
+update ops, either as one averaging and update op per number of devices
+in use (`ladder`, i.e., masked_grad_avg=False) or as one single masked
+op (`masked`, the default). Report the time to build the graph and the
+size of the serialized GraphDef.
+"""
+from time import time
+
+import tensorflow as tf
+from tensorflow.contrib import slim
+
+from main_loop_tf.optimization import average_gradients
+
+
+def build(num_devs, masked):
+    graph = tf.Graph()
+    start = time()
+    with graph.as_default():
+        global_step = tf.train.get_or_create_global_step()
+        sym_num_devs = tf.placeholder(tf.int32, shape=None, name='num_devs')
+        optimizer = tf.train.AdamOptimizer(1e-4)
+        cum_grads_and_vars = {}
+        for dev_id in range(num_devs):
+            with tf.device('/cpu:%d' % dev_id), \
+                    tf.variable_scope('model', reuse=dev_id > 0):
+                x = tf.placeholder(tf.float32, [None, 32, 32, 3])
+                net = x
+                for i in range(6):
+                    net = slim.conv2d(net, 64, (3, 3), scope='conv%d' % i)
+                loss = tf.reduce_mean(net)
+                for g, v in optimizer.compute_gradients(loss):
+                    cum_grads_and_vars.setdefault(v, []).append(g)
+        with tf.device('/cpu:0'):
+            if masked:
+                avg = average_gradients(cum_grads_and_vars, 'T.grads.',
+                                        sym_num_devs=sym_num_devs)
+                optimizer.apply_gradients(avg, global_step=global_step)
+            else:
+                for dev_id in range(num_devs):
+                    scope = 'T.grads/uptodev' + str(dev_id)
+                    avg = average_gradients(cum_grads_and_vars, scope + '.',
+                                            up_to_dev=dev_id)
+                    optimizer.apply_gradients(avg, global_step=global_step,
+                                              name=scope)
+        size = len(graph.as_graph_def().SerializeToString())
+    return time() - start, size
+
+
+if __name__ == '__main__':
+    print('{:>5} {:>12} {:>12} {:>14} {:>14}'.format(
+        'devs', 'ladder (s)', 'masked (s)', 'ladder (KB)', 'masked (KB)'))
+    for num_devs in range(1, 9):
+        t_ladder, size_ladder = build(num_devs, masked=False)
+        t_masked, size_masked = build(num_devs, masked=True)
+        print('{:>5} {:>12.3f} {:>12.3f} {:>14.1f} {:>14.1f}'.format(
+            num_devs, t_ladder, t_masked, size_ladder / 1024.,
+            size_masked / 1024.))
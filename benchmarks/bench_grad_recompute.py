@@ -0,0 +1,79 @@
+"""Peak memory and step time of the gradient recomputation
+
+Run with `python benchmarks/bench_grad_recompute.py`. Build the model
+and the loss of the `ExampleExperiment` of `run_example.py` on one
+device and compute its gradients either normally or recomputing the
+activations (`--grad_recompute=auto`). Report the median step time and
+the peak memory of each allocator, as reported by the traced steps.
+"""
+from time import time
+
+import numpy as np
+import tensorflow as tf
+
+from common import build_example_model
+from main_loop_tf.optimization import gradients_with_recomputation
+
+nclasses = 12
+nsteps = 10
+
+
+def build(recompute, batch_size, size):
+    graph = tf.Graph()
+    with graph.as_default():
+        inputs, loss = build_example_model(batch_size, size, nclasses)
+        var_list = tf.trainable_variables()
+        if recompute:
+            grads = gradients_with_recomputation([loss], var_list)
+        else:
+            grads = tf.gradients(loss, var_list)
+        train_op = tf.train.GradientDescentOptimizer(1e-3).apply_gradients(
+            zip(grads, var_list))
+        init_op = tf.global_variables_initializer()
+    return graph, inputs, train_op, init_op
+
+
+def peak_memory(run_metadata):
+    """Return the peak memory of each allocator, in MB"""
+    peaks = {}
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for mem in node_stats.memory:
+                peaks[mem.allocator_name] = max(
+                    peaks.get(mem.allocator_name, 0), mem.peak_bytes)
+    return {k: v / 2. ** 20 for k, v in peaks.items()}
+
+
+def bench(recompute, batch_size, size):
+    graph, inputs, train_op, init_op = build(recompute, batch_size, size)
+    feed_dict = {
+        inputs['data']: np.random.rand(batch_size, size, size,
+                                       3).astype('float32'),
+        inputs['labels']: np.random.randint(
+            0, nclasses, batch_size * size * size).astype('int32')}
+    with tf.Session(graph=graph) as sess:
+        sess.run(init_op)
+        sess.run(train_op, feed_dict)  # warm up
+        times = []
+        for _ in range(nsteps):
+            start = time()
+            sess.run(train_op, feed_dict)
+            times.append(time() - start)
+        run_metadata = tf.RunMetadata()
+        sess.run(train_op, feed_dict,
+                 options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                 run_metadata=run_metadata)
+    return np.median(times), peak_memory(run_metadata)
+
+
+if __name__ == '__main__':
+    print('{:>4} {:>5} {:>10} {:>10} {:>12} {:>12}'.format(
+        'bs', 'size', 'none (s)', 'auto (s)', 'none (MB)', 'auto (MB)'))
+    for batch_size, size in [(1, 128), (2, 128), (4, 128), (2, 256)]:
+        t_none, mem_none = bench(False, batch_size, size)
+        t_auto, mem_auto = bench(True, batch_size, size)
+        for allocator in sorted(mem_none):
+            print('{:>4} {:>5} {:>10.3f} {:>10.3f} {:>12.1f} {:>12.1f} '
+                  '{}'.format(batch_size, size, t_none, t_auto,
+                              mem_none[allocator],
+                              mem_auto.get(allocator, 0), allocator))
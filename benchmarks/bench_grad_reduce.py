@@ -0,0 +1,72 @@
+"""Step time of the gradient reduce strategies vs the number of devices
+
+Run with `python benchmarks/bench_grad_reduce.py`. For 1 to 8 virtual
+CPU devices, build a small convolutional tower per device and a masked
+averaging and update op with each of the `central`, `ring` and
+`hierarchical` strategies (see `average_gradients`). Report the mean
+step time of the update op.
+"""
+from time import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.contrib import slim
+
+from main_loop_tf.optimization import average_gradients
+
+MAX_DEVS = 8
+STRATEGIES = ['central', 'ring', 'hierarchical']
+
+
+def build(num_devs, strategy, batch_size=4):
+    graph = tf.Graph()
+    devices = ['/cpu:%d' % i for i in range(num_devs)]
+    with graph.as_default():
+        global_step = tf.train.get_or_create_global_step()
+        sym_num_devs = tf.placeholder(tf.int32, shape=None, name='num_devs')
+        optimizer = tf.train.GradientDescentOptimizer(1e-4)
+        cum_grads_and_vars = {}
+        for dev_id, dev in enumerate(devices):
+            with tf.device(dev), \
+                    tf.variable_scope('model', reuse=dev_id > 0):
+                x = tf.random_uniform([batch_size, 32, 32, 3])
+                net = x
+                for i in range(4):
+                    net = slim.conv2d(net, 128, (3, 3), scope='conv%d' % i)
+                loss = tf.reduce_mean(net)
+                for g, v in optimizer.compute_gradients(
+                        loss, colocate_gradients_with_ops=True):
+                    cum_grads_and_vars.setdefault(v, []).append(g)
+        with tf.device('/cpu:0'):
+            avg = average_gradients(cum_grads_and_vars, 'T.grads.',
+                                    sym_num_devs=sym_num_devs,
+                                    reduce_strategy=strategy,
+                                    devices=devices)
+            train_op = optimizer.apply_gradients(avg,
+                                                 global_step=global_step)
+        init_op = tf.global_variables_initializer()
+    return graph, train_op, init_op, sym_num_devs
+
+
+def step_time(num_devs, strategy, nsteps=20):
+    graph, train_op, init_op, sym_num_devs = build(num_devs, strategy)
+    config = tf.ConfigProto(device_count={'CPU': MAX_DEVS})
+    with tf.Session(graph=graph, config=config) as sess:
+        sess.run(init_op)
+        feed_dict = {sym_num_devs: num_devs}
+        sess.run(train_op, feed_dict)  # warm up
+        times = []
+        for _ in range(nsteps):
+            start = time()
+            sess.run(train_op, feed_dict)
+            times.append(time() - start)
+    return np.mean(times)
+
+
+if __name__ == '__main__':
+    print('{:>5} '.format('devs') +
+          ' '.join('{:>16}'.format(s + ' (ms)') for s in STRATEGIES))
+    for num_devs in range(1, MAX_DEVS + 1):
+        times = [step_time(num_devs, s) * 1000 for s in STRATEGIES]
+        print('{:>5} '.format(num_devs) +
+              ' '.join('{:>16.1f}'.format(t) for t in times))
@@ -0,0 +1,45 @@
+"""Measure the time it takes to import main_loop_tf
+
+Run with `python benchmarks/bench_import_time.py`. Each import is timed
+in a fresh interpreter, as the modules are cached after the first one.
+The time of the git hash and diff capture done at the construction of
+each Experiment is also reported, for the first and the cached calls.
+"""
+import os
+import subprocess
+import sys
+from timeit import default_timer
+
+nrep = 5
+root = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                    os.path.pardir)
+
+
+def time_import(module):
+    """Return the time it takes to import module in a new interpreter"""
+    code = ('from timeit import default_timer; t = default_timer(); '
+            'import {}; print(default_timer() - t)'.format(module))
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    return float(out.strip().split()[-1])
+
+
+if __name__ == '__main__':
+    print('{:<25} {:>10} {:>10}'.format('module', 'min (s)', 'max (s)'))
+    for module in ['numpy', 'tensorflow', 'main_loop_tf.utils',
+                   'main_loop_tf']:
+        times = [time_import(module) for _ in range(nrep)]
+        print('{:<25} {:>10.3f} {:>10.3f}'.format(module, min(times),
+                                                  max(times)))
+    # matplotlib should not be imported by main_loop_tf
+    out = subprocess.check_output(
+        [sys.executable, '-c', 'import sys, main_loop_tf; '
+         'print("matplotlib" in sys.modules)'], cwd=root)
+    print('matplotlib imported: {}'.format(out.strip().split()[-1]))
+
+    sys.path.insert(0, root)
+    from main_loop_tf.utils import save_repos_hash
+    for call in ['first', 'cached']:
+        t = default_timer()
+        save_repos_hash({}, 'main_loop_tf', [])
+        print('save_repos_hash ({} call): {:.4f}s'.format(
+            call, default_timer() - t))
@@ -0,0 +1,109 @@
+"""Step time of the session configurations
+
+Run with `python benchmarks/bench_session_config.py`. Build the model
+and the loss of the `ExampleExperiment` of `run_example.py` on the CPU
+and time a training step with several sizes of the thread pools, with
+and without XLA, while `nthreads` threads simulate the data loading
+(the augmentation of random images in numpy). If the machine has
+enough CPUs, each configuration is also timed with the loader and the
+session restricted to disjoint halves of the CPUs, as done by the
+`--loader_cpus` and `--compute_cpus` flags.
+"""
+from argparse import Namespace
+import os
+import threading
+from time import time
+
+import numpy as np
+import tensorflow as tf
+
+from common import build_example_model
+from main_loop_tf.utils import (cpu_affinity, get_tf_config,
+                                set_cpu_affinity, tower_jit_scope)
+
+nclasses = 12
+nsteps = 10
+batch_size = 2
+size = 128
+nthreads = 3
+
+
+def build(cfg):
+    graph = tf.Graph()
+    with graph.as_default():
+        with tower_jit_scope(cfg):
+            inputs, loss = build_example_model(batch_size, size, nclasses)
+        train_op = tf.train.GradientDescentOptimizer(1e-3).minimize(loss)
+        init_op = tf.global_variables_initializer()
+    return graph, inputs, train_op, init_op
+
+
+def loader_loop(stop, cpus):
+    """Simulate the load and augmentation of the minibatches"""
+    set_cpu_affinity(cpus)
+    while not stop.is_set():
+        x = np.random.rand(batch_size, 2 * size, 2 * size, 3)
+        x = np.rot90(x, axes=(1, 2))[:, :size, :size]
+        np.ascontiguousarray((x - x.mean()) / x.std())
+
+
+def bench(cfg, compute_cpus, loader_cpus):
+    graph, inputs, train_op, init_op = build(cfg)
+    feed_dict = {
+        inputs['data']: np.random.rand(batch_size, size, size,
+                                       3).astype('float32'),
+        inputs['labels']: np.random.randint(
+            0, nclasses, batch_size * size * size).astype('int32')}
+    stop = threading.Event()
+    loaders = [threading.Thread(target=loader_loop, args=(stop, loader_cpus))
+               for _ in range(nthreads)]
+    for th in loaders:
+        th.daemon = True
+        th.start()
+    try:
+        with cpu_affinity(compute_cpus):
+            sess = tf.Session(graph=graph, config=get_tf_config(cfg))
+        with sess:
+            sess.run(init_op)
+            sess.run(train_op, feed_dict)  # warm up
+            times = []
+            for _ in range(nsteps):
+                start = time()
+                sess.run(train_op, feed_dict)
+                times.append(time() - start)
+    finally:
+        stop.set()
+        for th in loaders:
+            th.join()
+    return np.median(times)
+
+
+if __name__ == '__main__':
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        import multiprocessing
+        cpus = list(range(multiprocessing.cpu_count()))
+    affinities = [('shared', set(), set())]
+    if len(cpus) > 1:
+        half = len(cpus) // 2
+        affinities.append(('split', set(cpus[half:]), set(cpus[:half])))
+    threads = sorted({(0, 0), (1, 1), (2, 2), (len(cpus), 1),
+                      (max(len(cpus) - nthreads, 1), 2)})
+
+    print('{:>6} {:>6} {:>8} {:>8} {:>10}'.format(
+        'intra', 'inter', 'xla', 'cpus', 'step (s)'))
+    for intra, inter in threads:
+        for xla_jit in ['off', 'session', 'towers']:
+            for name, compute_cpus, loader_cpus in affinities:
+                cfg = Namespace(intra_op_threads=intra,
+                                inter_op_threads=inter, xla_jit=xla_jit,
+                                grappler_options=None)
+                try:
+                    t = '{:>10.3f}'.format(
+                        bench(cfg, compute_cpus, loader_cpus))
+                except (ImportError, tf.errors.OpError) as e:
+                    # E.g., TF built without XLA
+                    t = '{:>10}'.format('n/a ' + type(e).__name__)
+                print('{:>6} {:>6} {:>8} {:>8} {}'.format(
+                    intra, inter, xla_jit, name, t))
@@ -0,0 +1,49 @@
+"""Compare the view-based `split_in_chunks` with the copying one
+
+Run with `python benchmarks/bench_split_in_chunks.py`. The minibatch
+mimics a video batch with optical flow, i.e., batch_size x seq_length x
+H x W x 6 float32 data and batch_size x seq_length x H x W int32 labels.
+"""
+from timeit import repeat
+
+import numpy as np
+
+from main_loop_tf.utils import split_in_chunks
+
+
+def split_in_chunks_copy(minibatch, num_splits, flatten_keys=['labels']):
+    '''The previous implementation, that copies the data twice'''
+    out = {}
+    for k, v in minibatch.iteritems():
+        out[k] = np.array_split(v.copy(), num_splits)
+        if any(k == v for v in flatten_keys):
+            out[k] = [el.flatten() for el in out[k]]
+    return map(dict, zip(*[[(k, v) for v in value]
+                           for k, value in out.items()]))
+
+
+def get_minibatch(batch_size, seq_length=5, h=128, w=128):
+    return {
+        'data': np.random.rand(batch_size, seq_length, h, w,
+                               6).astype('float32'),
+        'labels': np.random.randint(0, 12, (batch_size, seq_length, h,
+                                            w)).astype('int32')}
+
+
+if __name__ == '__main__':
+    nrep = 10
+    print('{:>6} {:>5} {:>10} {:>10} {:>8}'.format(
+        'bs', 'devs', 'copy (ms)', 'view (ms)', 'speedup'))
+    for batch_size in [4, 8, 16, 32]:
+        minibatch = get_minibatch(batch_size)
+        for num_devs in [1, 2, 4, 8]:
+            if num_devs > batch_size:
+                continue
+            t_copy = min(repeat(
+                lambda: split_in_chunks_copy(minibatch, num_devs),
+                number=1, repeat=nrep)) * 1000
+            t_view = min(repeat(
+                lambda: split_in_chunks(minibatch, num_devs),
+                number=1, repeat=nrep)) * 1000
+            print('{:>6} {:>5} {:>10.2f} {:>10.3f} {:>7.0f}x'.format(
+                batch_size, num_devs, t_copy, t_view, t_copy / t_view))
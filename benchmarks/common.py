@@ -0,0 +1,32 @@
+"""Helpers shared by the benchmarks"""
+from argparse import Namespace
+
+import tensorflow as tf
+
+from main_loop_tf.run_example import ExampleExperiment
+
+
+class BenchExperiment(ExampleExperiment):
+    """An `ExampleExperiment` that only holds its configuration
+
+    It lets the benchmarks build the model and the loss of the example
+    without parsing the flags nor building the graph of the main loop.
+    """
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+
+def build_example_model(batch_size, size, nclasses):
+    """Build the model and the loss of the `ExampleExperiment`
+
+    The model is built in the default graph, for training, on
+    placeholders for `batch_size` images of `size` x `size` pixels.
+    Return the placeholders and the loss.
+    """
+    exp = BenchExperiment(Namespace(nclasses_w_void=nclasses))
+    inputs = {'data': tf.placeholder(tf.float32,
+                                     [batch_size, size, size, 3]),
+              'labels': tf.placeholder(tf.int32, [None])}
+    model_out = exp.build_model(inputs, True)
+    loss = exp.build_loss(inputs, model_out, True)['loss']
+    return inputs, loss
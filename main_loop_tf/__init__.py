@@ -1,12 +1,7 @@
 import os
-from subprocess import check_output, CalledProcessError
 
 from main import Experiment
+from utils import get_git_revision
 
 
-try:
-    cwd = os.path.join(__path__[0], os.path.pardir)
-    __version__ = check_output('git rev-parse HEAD', cwd=cwd,
-                               shell=True).strip().decode('ascii')
-except CalledProcessError:
-    __version__ = -1
+__version__ = get_git_revision(os.path.join(__path__[0], os.path.pardir))
@@ -39,6 +39,16 @@ gflags.DEFINE_bool('remove_per_img_mean', False, 'If True each image or frame '
                    'will be normalized to have zero mean')
 gflags.DEFINE_bool('divide_by_per_img_std', False, 'If True each image or '
                    'frame will be normalized to have unit variance')
+gflags.DEFINE_bool('dataset_cache', False, 'If True, the shape of the data '
+                   'is cached on disk, to avoid loading the datasets at '
+                   'startup. The cache is not invalidated when the '
+                   'dataset changes on disk: use --refresh_dataset_cache '
+                   'to update it')
+gflags.DEFINE_string('dataset_cache_dir', '', 'Where to store the dataset '
+                     'cache. If empty, <checkpoints_basedir>/.dataset_cache')
+gflags.DEFINE_bool('refresh_dataset_cache', False, 'If True, the dataset '
+                   'cache is ignored and updated, e.g., after the dataset '
+                   'files changed')
 gflags.DEFINE_integer('val_batch_size', 1, 'The validation batch size',
                       lower_bound=0)
 gflags.DEFINE_integer('val_overlap', None, 'The overlap (in number of frames) '
@@ -49,3 +59,44 @@ gflags_ext.DEFINE_multidict('train_extra_params', {},
                             'Dataset train extra params')
 gflags_ext.DEFINE_multidict('val_extra_params', {},
                             'Dataset valid extra params')
+
+# ============ Input pipeline
+gflags.DEFINE_enum('input_pipeline', 'feed_dict', ['feed_dict', 'staging'],
+                   'How to transfer the training minibatches to the devices. '
+                   'If `feed_dict` the placeholders are fed at each step, if '
+                   '`staging` the next minibatches are copied to the devices '
+                   'in a StagingArea while the current step is running')
+gflags.DEFINE_integer('prefetch_batches', 1, 'How many minibatches to stage '
+                      'in advance when input_pipeline is `staging`',
+                      lower_bound=1)
+gflags.DEFINE_integer('feed_threads', 0, 'The number of threads that load '
+                      'the training minibatches, split them per device and '
+                      'build their feed_dict ahead of time. If zero, this is '
+                      'done in the main loop', lower_bound=0)
+gflags.DEFINE_integer('feed_queue_size', 4, 'How many ready-to-feed '
+                      'minibatches the feed threads can prepare in advance',
+                      lower_bound=1)
+gflags.DEFINE_integer('val_feed_threads', 0, 'The number of threads that '
+                      'prepare the validation minibatches ahead of time. '
+                      'The minibatches are loaded in order and their '
+                      'feed_dicts built in parallel, then returned in the '
+                      'order of the dataset. If zero, this is done by the '
+                      'validation loop', lower_bound=0)
+gflags.DEFINE_integer('val_feed_queue_size', 4, 'How many ready-to-feed '
+                      'validation minibatches the threads can prepare in '
+                      'advance', lower_bound=1)
+gflags.DEFINE_enum('idle_devices_input', 'replicate', ['replicate', 'empty'],
+                   'What to feed to the devices that are not used when a '
+                   'minibatch is too small to feed all of them. If '
+                   '`replicate` they get a copy of the data of the first '
+                   'device, if `empty` they get a zero-size batch so that '
+                   'they do not waste compute and transfers. `empty` '
+                   'requires the model and the loss to support empty '
+                   'batches')
+gflags.DEFINE_enum('input_dtype', 'float32', ['float32', 'uint8'], 'The type '
+                   'of the data fed to the graph. If `uint8`, the images '
+                   'are fed as bytes, and cast and normalized (see '
+                   'remove_mean and the like) by the graph on each device')
+gflags.DEFINE_enum('labels_dtype', 'int32', ['int32', 'int16', 'uint8'],
+                   'The type of the labels fed to the graph. They are cast '
+                   'to int32 by the graph on each device')
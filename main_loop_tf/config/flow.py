@@ -4,6 +4,21 @@ import gflags
 # ============ Flow control
 gflags.DEFINE_integer('val_every_epochs', 1, 'Validation frequency, in epochs',
                       lower_bound=1)
+gflags.DEFINE_integer('val_every_steps', 0, 'Optional. If positive, also '
+                      'validate every N steps', lower_bound=0)
+gflags.DEFINE_float('val_every_secs', 0, 'Optional. If positive, also '
+                    'validate when N seconds elapsed since the last '
+                    'validation', lower_bound=0)
+gflags.DEFINE_integer('quick_val_every_steps', 0, 'Optional. If positive, '
+                      'run a quick validation on a fixed subset of the '
+                      'validation sets every N steps, between the full '
+                      'validations. The quick validations are only '
+                      'reported in the summaries and do not affect the '
+                      'early stopping. Requires the default validation '
+                      'function', lower_bound=0)
+gflags.DEFINE_integer('quick_val_batches', 10, 'The number of minibatches '
+                      'of each validation set the quick validation runs on. '
+                      'Their feed_dicts are kept in memory', lower_bound=1)
 gflags.DEFINE_spaceseplist('val_on_sets', 'valid', 'On which sets to '
                            'perform validation')
 gflags.DEFINE_integer('val_skip_first', 0, 'How many epochs to skip before '
@@ -12,12 +27,30 @@ gflags.DEFINE_integer('min_epochs', 1, 'The minimum number of epochs '
                       'before early stopping is possible', lower_bound=1)
 gflags.DEFINE_integer('max_epochs', 100, 'The maximum number of epochs',
                       lower_bound=1)
-gflags.DEFINE_integer('patience', 10, 'The number of validation with no '
+gflags.DEFINE_integer('patience', 10, 'The number of validations with no '
                       'improvement the model will wait before early stopping',
                       lower_bound=1)
+gflags.DEFINE_string('early_stop_set', 'valid', 'The validation set the '
+                     'early stopping and the best model are based on. If '
+                     '`all`, the score is averaged over val_on_sets')
+gflags.DEFINE_string('early_stop_metric', 'mean_iou', 'The metric the early '
+                     'stopping and the best model are based on, if the '
+                     'validation function returns a dictionary of metrics')
+gflags.DEFINE_enum('early_stop_strategy', 'max', ['max', 'min'], 'Whether '
+                   'the early stopping metric should be maximized (e.g., '
+                   'mean_iou) or minimized (e.g., loss)')
+gflags.DEFINE_float('early_stop_delta', 0, 'The minimum change of the '
+                    'early stopping metric that counts as an improvement',
+                    lower_bound=0)
+gflags.DEFINE_float('early_stop_smoothing', 0, 'If positive, the early '
+                    'stopping metric is smoothed with an exponential moving '
+                    'average with this decay before being compared to the '
+                    'best one', lower_bound=0, upper_bound=0.999)
+gflags.DEFINE_bool('async_validation', False, 'If True, validate a snapshot '
+                   'of the weights in a background thread while the '
+                   'training continues')
+gflags.DEFINE_integer('async_val_max_lag', 1, 'With async_validation, the '
+                      'maximum number of epochs the training can run ahead '
+                      'of the oldest pending validation, and the maximum '
+                      'number of pending validations', lower_bound=1)
 gflags.DEFINE_bool('validate', False, 'If True runs validation, else training')
-# Other flags we might want to define (see also config/misc.py):
-# early_stop_metric='subsets_avg_val_jaccard_fg',
-# early_stop_strategy='max',
-# val_every_batches=None,
-# validate every n batches (else epoch)
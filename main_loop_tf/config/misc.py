@@ -5,6 +5,34 @@ import gflags
 gflags.DEFINE_bool('help', False, 'If True, shows this message')
 gflags.DEFINE_bool('nan', False, 'If True, enable nan detection hook')
 gflags.DEFINE_bool('debug', False, 'If True, enable tensorflow debug')
+gflags.DEFINE_string('profile_steps', '', 'Optional. A comma separated list '
+                     'of steps (e.g., 100) and ranges of steps (e.g., '
+                     '200:210, end excluded) to be profiled. A Chrome trace '
+                     'and a table of the per-op costs are saved for each of '
+                     'them in <save_path>/profile')
+# Session
+gflags.DEFINE_integer('intra_op_threads', 0, 'The number of threads used '
+                      'to parallelize the execution of each op. If 0, the '
+                      'number of CPUs the session is allowed to run on',
+                      lower_bound=0)
+gflags.DEFINE_integer('inter_op_threads', 0, 'The number of threads used '
+                      'to run independent ops in parallel. If 0, the number '
+                      'of CPUs the session is allowed to run on',
+                      lower_bound=0)
+gflags.DEFINE_enum('xla_jit', 'off', ['off', 'session', 'towers'],
+                   'Whether to compile with XLA. If `session`, the whole '
+                   'graph is auto-clustered, if `towers` only the model and '
+                   'the loss of each device and their gradients')
+gflags.DEFINE_list('grappler_options', None, 'Optional. A list of '
+                   '<name>=<value> rewrites of the graph optimizer, where '
+                   '<name> is a field of RewriterConfig (e.g., '
+                   'constant_folding=off,layout_optimizer=on)')
+gflags.DEFINE_list('compute_cpus', None, 'Optional. A list of CPU ids or '
+                   'ranges (e.g., 0-7,16) the threads of the session are '
+                   'restricted to. Linux only')
+gflags.DEFINE_list('loader_cpus', None, 'Optional. A list of CPU ids or '
+                   'ranges (e.g., 8-15) the threads that load the data are '
+                   'restricted to. Linux only')
 # Checkpoints
 gflags.DEFINE_integer('checkpoints_to_keep', 2, 'The number of checkpoints '
                       'to keep', lower_bound=0)
@@ -12,6 +40,12 @@ gflags.DEFINE_integer('checkpoints_save_secs', 0, 'Save every N secs',
                       lower_bound=0)
 gflags.DEFINE_integer('checkpoints_save_steps', 500, 'Save every N steps',
                       lower_bound=0)
+gflags.DEFINE_bool('async_checkpoints', False, 'If True, the variables are '
+                   'copied to host memory and the checkpoints are written in '
+                   'a background thread, without blocking the training. A '
+                   'new checkpoint replaces the one waiting to be written, '
+                   'if any. This takes about two to three times the size of '
+                   'the model in host memory while a checkpoint is written')
 gflags.DEFINE_string('checkpoints_basedir', 'checkpoints', 'The base path '
                      'where the model checkpoints are stored')
 gflags.DEFINE_string('suite_name', '', 'Optional. The name of the set of '
@@ -41,6 +75,9 @@ gflags.DEFINE_list('val_num_devs', None, 'How many decides to use for '
                    'training.')
 gflags.DEFINE_integer('random_seed', 8112017, 'Fixed random seed for '
                       'both tensorflow and numpy')
+gflags.DEFINE_bool('save_repos_hash', True, 'If True, the git hash and '
+                   'diff of the repository and the version of the packages '
+                   'are saved with the parameters')
 gflags.DEFINE_string('log_file', '', 'Optional. If defined the logs will '
                      'be saved in the specified log file.')
 gflags.DEFINE_string('log_verbosity', 'INFO', 'The verbosity of logging on '
@@ -52,4 +89,3 @@ gflags.DEFINE_string('disk_log_verbosity', 'NOTSET', 'The verbosity of '
 #                customizing_the_evaluation_metrics
 # metrics=[],  # TODO add additional metrics
 # val_metrics=['dice_loss', 'acc', 'jaccard'],
-# TODO parametrize according to which metric to save the model (best val loss?)
@@ -54,3 +54,57 @@ gflags.DEFINE_float("grad_noise_scale", None,
 gflags.DEFINE_string("grad_noise_decay", None,
                      "Gradient Noise Decay Schedule [neural_gpu]")
 gflags.DEFINE_float("grad_multiplier", None, "Gradient Multipliers")
+gflags.DEFINE_enum('grad_recompute', 'none', ['none', 'auto', 'collection'],
+                   'Whether to recompute the activations in the backward '
+                   'pass rather than keeping them in memory. If `auto`, '
+                   'about the square root of the convolutions and matrix '
+                   'multiplications outputs are kept in memory, if '
+                   '`collection` the tensors in the `grad_checkpoints` '
+                   'collection are')
+
+# Gradient averaging
+gflags.DEFINE_integer('accum_steps', 1, 'The number of minibatches the '
+                      'gradients are accumulated over before being applied. '
+                      'The effective batch size is accum_steps times the '
+                      'batch size. The global step counts the minibatches',
+                      lower_bound=1)
+gflags.DEFINE_bool('masked_grad_avg', True, 'If True, the gradients of the '
+                   'devices in use are averaged and applied by one single '
+                   'op that masks the unused devices at run-time. If False, '
+                   'one averaging and one update op are built for each '
+                   'possible number of devices in use')
+gflags.DEFINE_float('grad_bucket_mb', 0, 'If positive, average the dense '
+                    'gradients in fused buckets of at most this many MB, and '
+                    'the sparse gradients as IndexedSlices. This reduces the '
+                    'number of ops and transfers of the gradient averaging',
+                    lower_bound=0)
+gflags.DEFINE_enum('grad_reduce_strategy', 'central',
+                   ['central', 'ring', 'hierarchical'],
+                   'How to sum the gradients of the devices. `central` '
+                   'transfers them to and sums them on CPU, `ring` uses a '
+                   'ring all-reduce across the devices, `hierarchical` sums '
+                   'them within groups of devices first and then across '
+                   'groups with a ring all-reduce')
+gflags.DEFINE_integer('grad_reduce_group_size', 0, 'The number of devices '
+                      'per group of the hierarchical reduce strategy. If '
+                      'zero, the square root of the number of devices',
+                      lower_bound=0)
+
+# Mixed precision
+gflags.DEFINE_enum('precision', 'float32', ['float32', 'mixed'],
+                   'If `mixed`, the towers compute in `mixed_dtype` while '
+                   'the float variables are stored and updated in '
+                   'float32, and the loss is scaled to prevent the '
+                   'gradients from underflowing')
+gflags.DEFINE_enum('mixed_dtype', 'float16', ['float16', 'bfloat16'],
+                   'The type of the computations in mixed precision')
+gflags.DEFINE_float('loss_scale', 0, 'The constant loss scale in mixed '
+                    'precision. If 0, the loss scale is dynamic: it is '
+                    'halved and the update skipped when the gradients '
+                    'overflow, and doubled after `loss_scale_period` '
+                    'steps without overflow', lower_bound=0)
+gflags.DEFINE_float('loss_scale_init', 2 ** 15, 'The initial dynamic loss '
+                    'scale', lower_bound=1)
+gflags.DEFINE_integer('loss_scale_period', 2000, 'The number of steps '
+                      'without overflow after which the dynamic loss scale '
+                      'is doubled', lower_bound=1)
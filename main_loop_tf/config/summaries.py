@@ -8,6 +8,33 @@ gflags.DEFINE_bool('group_summaries', True, 'If True, groups the scalar '
                    '`layer`. The total number of summaries remains unchanged')
 gflags.DEFINE_integer('train_summary_freq', 10,
                       'How frequent save train summaries (in steps)')
+gflags.DEFINE_integer('train_norms_summary_freq', 0, 'How frequent save the '
+                      'weights and gradients norms train summaries (in '
+                      'steps). If 0, defaults to train_summary_freq',
+                      lower_bound=0)
+gflags.DEFINE_integer('train_hist_summary_freq', 0, 'How frequent save the '
+                      'histograms train summaries (in steps). If 0, '
+                      'defaults to train_summary_freq', lower_bound=0)
+gflags.DEFINE_integer('timings_freq', 0, 'How frequent save the '
+                      'percentiles of the duration of each phase of the '
+                      'main loop (in steps) to the summaries and to '
+                      '<save_path>/timings.jsonl. 0 (default) to disable',
+                      lower_bound=0)
+gflags.DEFINE_integer('timings_window', 1000, 'The number of steps the '
+                      'percentiles of the durations are computed on',
+                      lower_bound=1)
+gflags.DEFINE_bool('async_summaries', False, 'If True, the summaries are '
+                   'parsed and written to disk in batches by a background '
+                   'thread')
+gflags.DEFINE_integer('summaries_queue_size', 100, 'With async_summaries, the '
+                      'maximum number of summaries waiting to be written',
+                      lower_bound=1)
+gflags.DEFINE_enum('summaries_drop_policy', 'oldest', ['oldest', 'newest'],
+                   'With async_summaries, which summary to drop when the '
+                   'queue is full')
+gflags.DEFINE_integer('summaries_flush_secs', 10, 'With async_summaries, how '
+                      'frequently the summaries are flushed to disk (in '
+                      'seconds)', lower_bound=1)
 gflags_ext.DEFINE_multidict('hyperparams_summaries',
                             {'1-Dataset': ['dataset',
                                            'batch_size',
@@ -1,23 +1,155 @@
+from collections import deque
 import os
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import threading
 from time import time
 
 import tensorflow as tf
-from tensorflow.python.training.training import SessionRunHook
+from tensorflow.python.client import timeline
+from tensorflow.python.training.training import (SecondOrStepTimer,
+                                                 SessionRunArgs,
+                                                 SessionRunHook)
+
+
+def _link(src, dst):
+    """Hard-link `src` as `dst`, or copy it if links are not supported"""
+    if tf.gfile.Exists(dst):
+        tf.gfile.Remove(dst)
+    try:
+        os.link(src, dst)
+    except (AttributeError, OSError):
+        tf.gfile.Copy(src, dst, overwrite=True)
 
 
 class EarlyStopHook(SessionRunHook):
+    """Validate periodically and stop the training
+
+    The validation runs at the end of every `cfg.val_every_epochs`
+    epochs and, optionally, every `cfg.val_every_steps` steps or when
+    `cfg.val_every_secs` seconds elapsed since the last one. With
+    `cfg.quick_val_every_steps`, a quick validation on a fixed subset
+    of the validation sets is also run in between, for monitoring
+    only. The triggers only rely on the step counter the main loop
+    already keeps, so checking them costs nothing.
+
+    The training is stopped when the maximum number of epochs is
+    reached or when the validation score did not improve for
+    `patience` validations. The score is the `cfg.early_stop_metric`
+    of `cfg.early_stop_set` (see `_score`), optionally smoothed with an
+    exponential moving average, and it improves when it gets better
+    than the best one by at least `cfg.early_stop_delta`, according to
+    `cfg.early_stop_strategy`.
+
+    With `cfg.async_checkpoints`, the `AsyncCheckpointSaverHook` writes
+    its regular checkpoint at every validated step, and keeps it on
+    disk until the validation is over (see `pin`). The best model is
+    then promoted by hard-linking the files of that checkpoint, rather
+    than by saving the variables a second time. The best checkpoints
+    are listed in the `best_checkpoint` state file.
+
+    With `cfg.async_validation`, the validation does not stall the
+    training: the values of the variables the validation reads, i.e.,
+    not those of the optimizer nor the loss scale, are copied to host
+    memory with one single `sess.run` and validated by a background thread,
+    in a separate session on the same graph. `metrics_history`, the
+    best model and the early stopping decision are updated when the
+    results arrive. The training never gets more than
+    `cfg.async_val_max_lag` epochs ahead of the oldest pending
+    validation.
+    """
     def __init__(self, experiment):
         self.__name__ = 'EarlyStopHook'
         self.exp = experiment
         self.cfg = self.exp.cfg
         self.patience = self.cfg.patience
-        self.best_score = 0
+        self._maximize = self.cfg.early_stop_strategy == 'max'
+        self.best_score = float('-inf' if self._maximize else 'inf')
+        self._smoothed_score = None
         self.metrics_history = {}
-        self.validate_fn = getattr(experiment, "validate_fn", None)
-        self.saver = tf.train.Saver(
-            name='BestSaver',
-            save_relative_paths=True,
-            max_to_keep=self.cfg.checkpoints_to_keep)
+        self.validate_fn = getattr(experiment, "validate_fn",
+                                   experiment.default_validate_fn)
+        if self.cfg.async_checkpoints:
+            self.saver = None
+            self._best_checkpoints = []
+            self._best_lock = threading.Lock()
+        else:
+            self.saver = tf.train.Saver(
+                name='BestSaver',
+                save_relative_paths=True,
+                max_to_keep=self.cfg.checkpoints_to_keep)
+        self._async = self.cfg.async_validation
+        self._early_stopped = False
+        # Guards the state updated by `_update`
+        self._state_lock = threading.Lock()
+        self._thread = None
+        self._quick = self.cfg.quick_val_every_steps
+        if self._quick and hasattr(experiment, 'validate_fn'):
+            tf.logging.warn('The quick validation requires the default '
+                            'validation function: disabled')
+            self._quick = 0
+
+    def begin(self):
+        self._last_val_time = time()
+        if not self._async or not callable(self.validate_fn):
+            return
+        # The ops to load a snapshot of the variables in the
+        # validation session. They have to be created before the
+        # graph is finalized.
+        self._variables = self._snapshot_variables()
+        if self.saver is not None:
+            # The best model is saved from the validation session,
+            # that only holds the snapshot
+            self.saver = tf.train.Saver(
+                self._variables,
+                name='BestSaver',
+                save_relative_paths=True,
+                max_to_keep=self.cfg.checkpoints_to_keep)
+        self._snapshot_placeholders = []
+        assign_ops = []
+        with tf.name_scope('async_validation'):
+            for v in self._variables:
+                p = tf.placeholder(v.dtype.base_dtype, v.get_shape())
+                assign_ops.append(tf.assign(v, p))
+                self._snapshot_placeholders.append(p)
+            self._snapshot_load_op = tf.group(*assign_ops)
+            self._val_local_init_op = tf.local_variables_initializer()
+
+        # The epochs of the snapshots that are still being validated
+        self._pending = deque()
+        self._results = queue.Queue()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._validation_loop,
+                                        name='AsyncValidation')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _snapshot_variables(self):
+        """Return the variables the validation graph reads
+
+        These are the global variables, e.g., the weights, the
+        statistics of the batch normalization and the global step,
+        except for the slots and the other variables of the optimizer
+        and for the loss scale, that only the training reads.
+        """
+        exp = self.exp
+        optimizer = exp.optimizer
+        variables = tf.global_variables()
+        excluded = set()
+        for v in variables:
+            for name in optimizer.get_slot_names():
+                slot = optimizer.get_slot(v, name)
+                if slot is not None:
+                    excluded.add(slot.op.name)
+        # The non-slot variables, e.g., the powers of the betas of Adam
+        if hasattr(optimizer, 'variables'):
+            excluded.update(v.op.name for v in optimizer.variables())
+        if self.cfg.precision == 'mixed':
+            excluded.update([exp.loss_scale.op.name,
+                             exp._loss_scale_good_steps.op.name])
+        return [v for v in variables if v.op.name not in excluded]
 
     def after_run(self, run_context, run_values):
         if not hasattr(self.exp, 'global_step_val'):
@@ -27,68 +159,740 @@ class EarlyStopHook(SessionRunHook):
         exp = self.exp
         nbatches = exp.train.nbatches
 
-        # Skip validation if it's not the end of an epoch
-        if (exp.global_step_val + 1) % nbatches:
-            return
-
-        # Skip validation if we did not run at least `val_skip_first` epochs
-        if exp.global_step_val < (cfg.val_skip_first * nbatches):
-            tf.logging.info('Skipping validation for the first %d epochs' %
-                            cfg.val_skip_first)
-            return
-
-        # Skip validation if the epoch is not a multiple of `val_every_epochs`
-        if (exp.global_step_val + 1) % (cfg.val_every_epochs * nbatches):
-            tf.logging.info('Skipping validation: validating every %d epochs' %
-                            cfg.val_every_epochs)
-            return
+        if self._thread is not None:
+            self._collect_results(block=False)
+            with self._state_lock:
+                early_stopped = self._early_stopped
+            if early_stopped:
+                self._stop(run_context)
+                return
 
+        step = exp.global_step_val + 1  # The steps run so far
+        end_of_epoch = step % nbatches == 0
         last_epoch = False
-        estop = False
 
         # We hit the max number of epochs.
-        if exp.epoch_id == cfg.max_epochs - 1:
+        if end_of_epoch and exp.epoch_id == cfg.max_epochs - 1:
             tf.logging.info('STOP TRAINING: max epoch reached!!!')
             last_epoch = True
 
-        # Patience is over, validate one last time and possibly early stop.
-        if exp.epoch_id >= cfg.min_epochs and self.patience == 0:
-            estop = True
+        # Skip validation if we did not run at least `val_skip_first` epochs
+        if exp.global_step_val < (cfg.val_skip_first * nbatches):
+            if end_of_epoch:
+                tf.logging.info('Skipping validation for the first %d '
+                                'epochs' % cfg.val_skip_first)
+            validate = quick = False
+        else:
+            now = time()
+            validate = (
+                last_epoch or
+                step % (cfg.val_every_epochs * nbatches) == 0 or
+                (cfg.val_every_steps and step % cfg.val_every_steps == 0) or
+                (cfg.val_every_secs and
+                 now - self._last_val_time >= cfg.val_every_secs))
+            quick = (not validate and self._quick and
+                     step % self._quick == 0)
+            if validate:
+                self._last_val_time = now
+
+        if quick:
+            with exp.timings.time('quick_validation'):
+                exp.quick_validate(cfg.val_on_sets)
+        if not validate:
+            if last_epoch:
+                self._stop(run_context)
+            return
 
         if callable(self.validate_fn):
-            # Run validate on each validation set
-            metrics_val = {}
-            for s in cfg.val_on_sets:
-                metrics_val[s] = self.validate_fn(
-                    exp.val_graph_outs[s],
-                    which_set=s)
-                self.metrics_history.setdefault(s, []).append(metrics_val[s])
-            exp.metrics_val = metrics_val
-
-            valid_score = metrics_val.get('valid')
-            # We improved the *validation* metric
-            if valid_score >= self.best_score:
-                self.best_score = valid_score
-                tf.logging.info('## New best model found! Score: {} ##'.format(
-                    valid_score))
-                t_save = time()
-                # Save best model as a separate checkpoint
-                self.saver.save(run_context.session,
-                                os.path.join(cfg.save_path, 'best.ckpt'),
-                                global_step=exp.global_step)
-                t_save = time() - t_save
-                tf.logging.info('Best checkpoint saved in {}s'.format(t_save))
+            # The step of the variables, i.e., after this run
+            global_step = run_context.session.run(exp.global_step)
+            if self.saver is None:
+                # Checkpoint the validated variables, to promote them
+                # if they are the best ones
+                exp.saver_hook.pin(run_context.session, global_step)
+            if self._thread is not None:
+                self._submit(run_context.session, exp.epoch_id)
+                # Do not let the training get too far ahead of the
+                # validation, and wait for all the results at the end
+                while self._pending and (
+                        last_epoch or exp.epoch_id - self._pending[0] >=
+                        cfg.async_val_max_lag or
+                        len(self._pending) > cfg.async_val_max_lag):
+                    self._collect_results(block=True)
+            else:
+                metrics_val = self._validate()
+                self._update(metrics_val, exp.epoch_id, global_step,
+                             run_context.session)
+
+        with self._state_lock:
+            early_stopped = self._early_stopped
+        if last_epoch or early_stopped:
+            self._stop(run_context)
+
+    def end(self, session):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._collect_results(block=False)
+
+    def _validate(self):
+        """Run validate on each validation set"""
+        with self.exp.timings.time('validation'):
+            return self.exp.validate_sets(self.cfg.val_on_sets)
+
+    def _score(self, metrics_val):
+        """Return the score the early stopping is based on
+
+        The score is the validation metric of `cfg.early_stop_set`, or
+        its entry `cfg.early_stop_metric` if the metrics are a
+        dictionary. If `cfg.early_stop_set` is `all`, the score is
+        averaged over the validation sets.
+        """
+        cfg = self.cfg
+        sets = (cfg.val_on_sets if cfg.early_stop_set == 'all'
+                else [cfg.early_stop_set])
+        scores = []
+        for s in sets:
+            if s not in metrics_val:
+                raise ValueError('The early stopping set {} is not '
+                                 'validated. Check early_stop_set and '
+                                 'val_on_sets'.format(s))
+            m = metrics_val[s]
+            if isinstance(m, dict):
+                if cfg.early_stop_metric not in m:
+                    raise ValueError('Unknown early stopping metric {}. The '
+                                     'metrics are: {}'.format(
+                                         cfg.early_stop_metric, list(m)))
+                m = m[cfg.early_stop_metric]
+            scores.append(float(m))
+        return sum(scores) / len(scores)
+
+    def _update(self, metrics_val, epoch_id, global_step, session):
+        """Update the history, the best model and the patience
 
+        Parameters
+        ----------
+        metrics_val: dict
+            The validation metrics, per validation set.
+        epoch_id: int
+            The epoch the validated variables were taken at.
+        global_step: int
+            The step the validated variables were taken at.
+        session: Session
+            A session that holds the validated variables, used to save
+            the best model without `cfg.async_checkpoints`.
+        """
+        cfg = self.cfg
+        valid_score = self._score(metrics_val)
+        # The state is shared with the training thread when the
+        # validation is asynchronous
+        with self._state_lock:
+            for s, m in metrics_val.iteritems():
+                self.metrics_history.setdefault(s, []).append(m)
+            self.exp.metrics_val = metrics_val
+
+            # Patience is over, this validation is the last chance
+            estop = epoch_id >= cfg.min_epochs and self.patience == 0
+
+            smoothing = cfg.early_stop_smoothing
+            if smoothing and self._smoothed_score is not None:
+                valid_score = (smoothing * self._smoothed_score +
+                               (1 - smoothing) * valid_score)
+            self._smoothed_score = valid_score
+            if self._maximize:
+                improved = (valid_score >=
+                            self.best_score + cfg.early_stop_delta)
+            else:
+                improved = (valid_score <=
+                            self.best_score - cfg.early_stop_delta)
+
+            if improved:
+                self.best_score = valid_score
                 self.patience = cfg.patience  # Reset patience
-                self.estop = False  # Stop potential early stopping
             else:
                 self.patience -= 1
                 if estop:
-                    last_epoch = True
+                    self._early_stopped = True
                     tf.logging.info('STOP TRAINING: early stopping!!!')
 
-        if last_epoch:
+        # We improved the *validation* metric
+        if improved:
+            tf.logging.info('## New best model found! Score: {} ##'.format(
+                valid_score))
+            if self.saver is None:
+                self.exp.saver_hook.when_saved(global_step, self._promote)
+            else:
+                t_save = time()
+                # Save best model as a separate checkpoint
+                self.saver.save(session,
+                                os.path.join(cfg.save_path, 'best.ckpt'),
+                                global_step=global_step,
+                                latest_filename='best_checkpoint')
+                t_save = time() - t_save
+                tf.logging.info('Best checkpoint saved in {}s'.format(
+                    t_save))
+        if self.saver is None:
+            self.exp.saver_hook.unpin(global_step)
+
+    def _promote(self, path):
+        """Make the checkpoint at `path` the best model
+
+        The files of the checkpoint are hard-linked (or copied, if the
+        file system does not support hard links) as `best.ckpt-<step>`,
+        so that they survive the rotation of the checkpoints.
+        """
+        name = 'best.ckpt-' + path.rsplit('-', 1)[1]
+        best_path = os.path.join(self.cfg.save_path, name)
+        # The best model may have been saved on its own
+        files = tf.gfile.Glob(path + '.*') if path != best_path else []
+        for f in files:
+            dst = best_path + f[len(path):]
+            _link(f, dst)
+        with self._best_lock:
+            if best_path in self._best_checkpoints:
+                self._best_checkpoints.remove(best_path)
+            self._best_checkpoints.append(best_path)
+            max_to_keep = self.cfg.checkpoints_to_keep
+            while max_to_keep and len(self._best_checkpoints) > max_to_keep:
+                for f in tf.gfile.Glob(self._best_checkpoints.pop(0) + '.*'):
+                    tf.gfile.Remove(f)
+            tf.train.update_checkpoint_state(
+                self.cfg.save_path, name,
+                all_model_checkpoint_paths=[
+                    os.path.basename(p) for p in self._best_checkpoints],
+                latest_filename='best_checkpoint')
+        tf.logging.info('Best checkpoint promoted from {}'.format(path))
+
+    def _stop(self, run_context):
+        with self._state_lock:
             best = self.best_score
-            exp.return_value = self.best_score
-            tf.logging.info('\nBest validation score: {:.5f}\n'.format(best))
-            run_context.request_stop()  # Exit epoch loop
+        if abs(best) == float('inf'):
+            # No validation ran, keep the score reported before early
+            # stopping strategies were configurable
+            best = 0
+        self.exp.return_value = best
+        tf.logging.info('\nBest validation score: {:.5f}\n'.format(best))
+        run_context.request_stop()  # Exit epoch loop
+
+    def _submit(self, session, epoch_id):
+        """Snapshot the variables and queue them to be validated"""
+        t_stall = time()
+        values, global_step = session.run([self._variables,
+                                           self.exp.global_step])
+        self._pending.append(epoch_id)
+        self._queue.put((epoch_id, global_step, values))
+        t_stall = time() - t_stall
+        self._write_summary('stall_secs', t_stall, global_step)
+
+    def _collect_results(self, block):
+        """Process the validation results that have arrived
+
+        If `block` is True, wait for at least one result."""
+        while self._pending:
+            try:
+                item = self._results.get(block=block)
+            except queue.Empty:
+                return
+            block = False
+            self._pending.popleft()
+            if isinstance(item, Exception):
+                raise item
+            epoch_id, global_step, metrics_val = item
+            tf.logging.info('Validation of epoch {} done ({} epochs '
+                            'behind)'.format(epoch_id + 1,
+                                             self.exp.epoch_id - epoch_id))
+
+    def _validation_loop(self):
+        with tf.Session(graph=self.exp.graph,
+                        config=self.exp.tf_config) as sess:
+            # validate_fn runs on the validation session in this thread
+            self.exp._thread_local.unhookedsess = sess
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                epoch_id, global_step, values = item
+                try:
+                    t_val = time()
+                    sess.run(self._snapshot_load_op,
+                             feed_dict=dict(zip(self._snapshot_placeholders,
+                                                values)))
+                    sess.run(self._val_local_init_op)
+                    metrics_val = self._validate()
+                    # The validation session holds the snapshot, the
+                    # best model is saved from here
+                    self._update(metrics_val, epoch_id, global_step, sess)
+                    t_val = time() - t_val
+                    self._write_summary('validation_secs', t_val,
+                                        global_step)
+                    self._results.put((epoch_id, global_step, metrics_val))
+                except Exception as e:
+                    self._results.put(e)
+
+    def _write_summary(self, name, value, global_step):
+        summary_val = tf.Summary.Value(tag='T.async_validation/' + name,
+                                       simple_value=value)
+        summary = tf.Summary(value=[summary_val])
+        self.exp.summary_writer.add_summary(summary, global_step)
+
+
+class AsyncCheckpointSaverHook(SessionRunHook):
+    """Save checkpoints without blocking the training loop
+
+    Every `save_secs` seconds or `save_steps` steps, the values of the
+    variables are copied to host memory with one single `sess.run`.
+    The checkpoint files are then written by a background thread, with
+    a separate graph and session, while the training continues. Saving
+    never waits for the writer: a new snapshot replaces the pending
+    ones that no other hook waits for (see `pin` and `when_saved`).
+
+    Note that this costs host memory: each pending snapshot holds a
+    copy of the variables, and the writer session another one, i.e.,
+    about two to three times the size of the model while a checkpoint
+    is being written.
+
+    The files are written with a temporary name and renamed when
+    complete, so that a checkpoint is never visible until it has been
+    completely written. The checkpoint state file is updated
+    afterwards, and only the most recent `max_to_keep` checkpoints are
+    kept on disk. The meta graph is written once, as
+    `<checkpoint_basename>.meta`, and linked as the `.meta` file of
+    each checkpoint, so that `tf.train.import_meta_graph` works on
+    them.
+
+    The time the training loop was stalled to copy the variables and
+    the time it took to write the checkpoint are written to the
+    summaries.
+
+    An error of the writer thread does not stop it: the error is kept
+    and raised by the next call to `save`, `after_run` or `end`. `end`
+    waits at most `writer_timeout` seconds for the pending checkpoints
+    to be written. Checkpoints saved after `end` are written inline.
+
+    `pin` makes sure that the checkpoint of a given step is written,
+    and keeps it on disk until `unpin`, even after it has been rotated
+    out of the checkpoint state file. `when_saved` lets other hooks act
+    on the checkpoint of a given step (e.g., promote it to best model)
+    once it is on disk.
+    """
+    def __init__(self, experiment, checkpoint_dir, save_secs=None,
+                 save_steps=None, checkpoint_basename='model.ckpt',
+                 max_to_keep=5, writer_timeout=600):
+        self.__name__ = 'AsyncCheckpointSaverHook'
+        self.exp = experiment
+        self._checkpoint_dir = checkpoint_dir
+        self._basename = checkpoint_basename
+        self._max_to_keep = max_to_keep
+        self._timer = SecondOrStepTimer(every_secs=save_secs,
+                                        every_steps=save_steps)
+        self._writer_timeout = writer_timeout
+        # The snapshots waiting to be written, guarded by `_cond`, as
+        # `_closed`
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._meta_path = None
+        self._thread = None
+        self._error = None
+        self._closed = False
+        # The callbacks of the checkpoints queued or being written, per
+        # step. Guarded by `_lock`, as `_checkpoints`.
+        self._callbacks = {}
+        # The paths of the checkpoints to keep on disk until `unpin`
+        self._pinned = set()
+        self._last_saved_step = None
+        self._lock = threading.Lock()
+
+    def begin(self):
+        self._global_step_tensor = self.exp.global_step
+        self._variables = tf.global_variables()
+
+        # A graph that mirrors the variables, used to write the
+        # checkpoints from the background thread
+        self._writer_graph = tf.Graph()
+        with self._writer_graph.as_default():
+            self._writer_placeholders = []
+            writer_vars = {}
+            for v in self._variables:
+                p = tf.placeholder(v.dtype.base_dtype, v.get_shape())
+                writer_vars[v.op.name] = tf.Variable(p, trainable=False,
+                                                     collections=[])
+                self._writer_placeholders.append(p)
+            self._writer_init_op = tf.variables_initializer(
+                writer_vars.values())
+            self._writer_saver = tf.train.Saver(writer_vars,
+                                                save_relative_paths=True)
+        self._writer_graph.finalize()
+        # The saver of the meta graph, that restores the checkpoints in
+        # the training graph
+        self._meta_saver = tf.train.Saver(self._variables,
+                                          name='AsyncCheckpointSaver',
+                                          save_relative_paths=True)
+
+        ckpt = tf.train.get_checkpoint_state(self._checkpoint_dir)
+        self._checkpoints = (list(ckpt.all_model_checkpoint_paths)
+                             if ckpt else [])
+
+        self._thread = threading.Thread(target=self._writer_loop,
+                                        name='AsyncCheckpointWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def after_create_session(self, session, coord):
+        tf.train.write_graph(tf.get_default_graph().as_graph_def(),
+                             self._checkpoint_dir, 'graph.pbtxt')
+        meta_path = os.path.join(self._checkpoint_dir,
+                                 self._basename + '.meta')
+        self._meta_saver.export_meta_graph(meta_path)
+        self._meta_path = meta_path
+
+    def before_run(self, run_context):
+        return SessionRunArgs(self._global_step_tensor)
+
+    def after_run(self, run_context, run_values):
+        self._raise_writer_error()
+        stale_global_step = run_values.results
+        if self._timer.should_trigger_for_step(stale_global_step + 1):
+            global_step = run_context.session.run(self._global_step_tensor)
+            if self._timer.should_trigger_for_step(global_step):
+                self._timer.update_last_triggered_step(global_step)
+                self.save(run_context.session, global_step)
+
+    def end(self, session):
+        global_step = session.run(self._global_step_tensor)
+        if global_step != self._last_saved_step:
+            self.save(session, global_step)
+        # Wait for the pending checkpoints to be written. The later
+        # ones are written inline.
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(self._writer_timeout)
+        if self._thread.is_alive():
+            raise RuntimeError('The checkpoint writer did not finish '
+                               'within {}s'.format(self._writer_timeout))
+        self._raise_writer_error()
+
+    def _raise_writer_error(self):
+        """Raise the last error of the writer thread, if any"""
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def save(self, session, global_step, callback=None):
+        """Snapshot the variables and queue them to be written
+
+        Parameters
+        ----------
+        session: Session
+            The session to get the variables values from.
+        global_step: int
+            The step the checkpoint is saved at.
+        callback: callable (optional)
+            A function to be called by the writer thread with the path
+            of the checkpoint, once it has been written.
+        """
+        self._raise_writer_error()
+        t_stall = time()
+        values = session.run(self._variables)
+        callbacks = [callback] if callback is not None else []
+        self._last_saved_step = global_step
+        with self._lock:
+            self._callbacks.setdefault(global_step, []).extend(callbacks)
+        item = (global_step, values)
+        with self._cond:
+            if not self._closed:
+                self._drop_superseded(global_step)
+                self._pending.append(item)
+                self._cond.notify_all()
+                item = None
+        t_stall = time() - t_stall
+        self._write_summary('stall_secs', t_stall, global_step)
+        if item is not None:
+            # The writer thread is gone, write the checkpoint here
+            with tf.Session(graph=self._writer_graph) as sess:
+                self._process(sess, item)
+            self._raise_writer_error()
+
+    def _drop_superseded(self, global_step):
+        """Drop the pending snapshots superseded by `global_step`
+
+        These are the checkpoints that are neither pinned nor waited
+        for by a callback. Called with `_cond` held.
+        """
+        with self._lock:
+            for item in list(self._pending):
+                step, _ = item
+                if (self._callbacks.get(step) or
+                        self.checkpoint_path(step) in self._pinned):
+                    continue
+                self._pending.remove(item)
+                self._callbacks.pop(step, None)
+                tf.logging.info('Checkpoint of step {} not saved: '
+                                'superseded by step {}'.format(step,
+                                                               global_step))
+
+    def pin(self, session, global_step):
+        """Keep the checkpoint of `global_step` on disk until `unpin`
+
+        If the checkpoint of `global_step` is neither queued nor on
+        disk, the variables of `session` are saved as a regular
+        checkpoint of that step. The checkpoint still leaves the
+        checkpoint state file when rotated out, but its files are only
+        removed by `unpin`.
+        """
+        path = self.checkpoint_path(global_step)
+        with self._lock:
+            self._pinned.add(path)
+            saved = global_step in self._callbacks or path in self._checkpoints
+        if not saved:
+            self._timer.update_last_triggered_step(global_step)
+            self.save(session, global_step)
+
+    def unpin(self, global_step):
+        """Let the checkpoint of `global_step` be removed, see `pin`"""
+        path = self.checkpoint_path(global_step)
+        with self._lock:
+            if path not in self._pinned:
+                return
+            self._pinned.remove(path)
+            # Remove it if it has been rotated out in the meanwhile
+            if (global_step not in self._callbacks and
+                    path not in self._checkpoints):
+                for f in tf.gfile.Glob(path + '.*'):
+                    tf.gfile.Remove(f)
+
+    def when_saved(self, global_step, callback):
+        """Call `callback` with the path of the checkpoint of a step
+
+        If the checkpoint of `global_step` is queued or being written,
+        `callback` is called by the writer thread once it is written.
+        If it is already on disk, e.g., because it has been pinned,
+        `callback` is called right away. Otherwise, e.g., if it could
+        not be written, a `ValueError` is raised: the caller may not
+        hold all the variables (e.g., the session of the asynchronous
+        validation), so they are not saved here.
+        """
+        path = self.checkpoint_path(global_step)
+        with self._lock:
+            if global_step in self._callbacks:
+                self._callbacks[global_step].append(callback)
+                return
+            written = path in self._checkpoints or (
+                path in self._pinned and tf.gfile.Exists(path + '.index'))
+        if not written:
+            raise ValueError('The checkpoint of step {} is not on disk. '
+                             'Was it pinned?'.format(global_step))
+        callback(path)
+
+    def _writer_loop(self):
+        with tf.Session(graph=self._writer_graph) as sess:
+            while True:
+                with self._cond:
+                    while not self._pending and not self._closed:
+                        self._cond.wait()
+                    if not self._pending:
+                        return
+                    item = self._pending.popleft()
+                self._process(sess, item)
+
+    def _process(self, sess, item):
+        """Write a snapshot and call its callbacks"""
+        global_step, values = item
+        try:
+            t_save = time()
+            path = self._write(sess, global_step, values)
+            t_save = time() - t_save
+            self._write_summary('save_secs', t_save, global_step)
+            tf.logging.info('Checkpoint {} saved in {:.2f}s'.format(
+                path, t_save))
+        except Exception as e:
+            # Keep serving the queue, so that `save` never blocks
+            tf.logging.error('Checkpoint of step {} not saved: '
+                             '{}'.format(global_step, e))
+            self._error = e
+            path = None
+        finally:
+            with self._lock:
+                callbacks = self._callbacks.pop(global_step, [])
+        if path is None:
+            return
+        for callback in callbacks:
+            try:
+                callback(path)
+            except Exception as e:
+                tf.logging.error('Callback of the checkpoint {} '
+                                 'failed: {}'.format(path, e))
+                self._error = e
+
+    def checkpoint_path(self, global_step):
+        """Return the path of the checkpoint of `global_step`"""
+        return os.path.join(self._checkpoint_dir,
+                            '%s-%d' % (self._basename, global_step))
+
+    def _write(self, sess, global_step, values):
+        sess.run(self._writer_init_op,
+                 feed_dict=dict(zip(self._writer_placeholders, values)))
+        path = self.checkpoint_path(global_step)
+        name = os.path.basename(path)
+        tmp_path = os.path.join(self._checkpoint_dir, '.tmp_' + name)
+        self._writer_saver.save(sess, tmp_path, write_meta_graph=False,
+                                write_state=False)
+        if self._meta_path is not None:
+            _link(self._meta_path, tmp_path + '.meta')
+        # Rename the index last, as it marks the checkpoint as complete
+        tmp_files = sorted(tf.gfile.Glob(tmp_path + '.*'),
+                           key=lambda f: f.endswith('.index'))
+        for tmp_file in tmp_files:
+            tf.gfile.Rename(tmp_file, path + tmp_file[len(tmp_path):],
+                            overwrite=True)
+
+        with self._lock:
+            if path in self._checkpoints:
+                self._checkpoints.remove(path)
+            self._checkpoints.append(path)
+            if self._max_to_keep:
+                while len(self._checkpoints) > self._max_to_keep:
+                    old_path = self._checkpoints.pop(0)
+                    if old_path in self._pinned:
+                        continue
+                    for f in tf.gfile.Glob(old_path + '.*'):
+                        tf.gfile.Remove(f)
+            # Store relative paths, as the Saver does with
+            # save_relative_paths
+            tf.train.update_checkpoint_state(
+                self._checkpoint_dir, name,
+                all_model_checkpoint_paths=[os.path.basename(p)
+                                            for p in self._checkpoints])
+        return path
+
+    def _write_summary(self, name, value, global_step):
+        summary_val = tf.Summary.Value(tag='T.checkpoints/' + name,
+                                       simple_value=value)
+        self.exp.summary_writer.add_summary(tf.Summary(value=[summary_val]),
+                                            global_step)
+
+
+class ProfileHook(SessionRunHook):
+    """Trace the chosen training steps
+
+    For each step in `steps`, the step is run with a full trace and
+    the trace is saved in `output_dir` in the Chrome trace format (open
+    it in chrome://tracing). A table of the time and memory spent per
+    device, top level name scope (e.g., the towers, the gradients
+    averaging, the summaries) and op type is saved next to it, and the
+    most expensive entries are logged.
+    """
+    def __init__(self, experiment, steps, output_dir, log_top_n=20):
+        self.__name__ = 'ProfileHook'
+        self.exp = experiment
+        self._steps = set(steps)
+        self._output_dir = output_dir
+        self._log_top_n = log_top_n
+        self._next_step = None
+        self._tracing = False
+
+    def begin(self):
+        self._global_step_tensor = self.exp.global_step
+        if not tf.gfile.Exists(self._output_dir):
+            tf.gfile.MakeDirs(self._output_dir)
+
+    def after_create_session(self, session, coord):
+        self._next_step = session.run(self._global_step_tensor)
+
+    def before_run(self, run_context):
+        self._tracing = self._next_step in self._steps
+        options = None
+        if self._tracing:
+            options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        return SessionRunArgs(self._global_step_tensor, options=options)
+
+    def after_run(self, run_context, run_values):
+        if self._tracing:
+            self._save(self._next_step, run_values.run_metadata.step_stats)
+        self._next_step = run_values.results + 1
+
+    def _save(self, step, step_stats):
+        trace = timeline.Timeline(step_stats).generate_chrome_trace_format(
+            show_memory=True)
+        trace_path = os.path.join(self._output_dir, 'timeline-%d.json' % step)
+        with tf.gfile.GFile(trace_path, 'w') as f:
+            f.write(trace)
+
+        rows = self._aggregate(step_stats)
+        total_micros = sum(r[3] for r in rows) or 1
+        lines = ['{:<40} {:<30} {:<30} {:>6} {:>12} {:>7} {:>14}'.format(
+            'Device', 'Scope', 'Op', 'Count', 'Time (us)', '%',
+            'Memory (B)')]
+        for device, scope, op, count, micros, mem in rows:
+            lines.append(
+                '{:<40} {:<30} {:<30} {:>6} {:>12} {:>7.2f} {:>14}'.format(
+                    device, scope, op, count, micros,
+                    100. * micros / total_micros, mem))
+        table_path = os.path.join(self._output_dir, 'ops-%d.txt' % step)
+        with tf.gfile.GFile(table_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        tf.logging.info('Profile of step {} saved in {}. Most expensive '
+                        'ops:\n{}'.format(step, trace_path, '\n'.join(
+                            lines[:self._log_top_n + 1])))
+
+    @staticmethod
+    def _aggregate(step_stats):
+        """Sum the time and memory per device, scope and op type
+
+        Return a list of (device, scope, op, count, micros, bytes)
+        tuples, sorted by decreasing time."""
+        table = {}
+        for dev_stats in step_stats.dev_stats:
+            for node_stats in dev_stats.node_stats:
+                scope = node_stats.node_name.split('/')[0]
+                # The label is in the form `name = Op(inputs)`
+                label = node_stats.timeline_label
+                if ' = ' in label:
+                    op = label.split(' = ', 1)[1].split('(', 1)[0]
+                else:
+                    op = node_stats.node_name.split('/')[-1].split(':')[0]
+                key = (dev_stats.device, scope, op)
+                count, micros, mem = table.get(key, (0, 0, 0))
+                table[key] = (count + 1,
+                              micros + node_stats.all_end_rel_micros,
+                              mem + sum(m.total_bytes
+                                        for m in node_stats.memory))
+        rows = [k + v for k, v in table.iteritems()]
+        return sorted(rows, key=lambda r: r[4], reverse=True)
+
+
+class TimedHook(SessionRunHook):
+    """Time the calls of a hook
+
+    The time spent in `before_run` and `after_run` at each step is
+    added to `timings` as the `hooks/<hook name>` phase. Note that it
+    includes the time of the work the hook does, e.g., the validation
+    for the EarlyStopHook.
+    """
+    def __init__(self, hook, timings):
+        self.hook = hook
+        self.__name__ = getattr(hook, '__name__', type(hook).__name__)
+        self._phase = 'hooks/' + self.__name__
+        self._timings = timings
+        self._secs = 0
+
+    def begin(self):
+        self.hook.begin()
+
+    def after_create_session(self, session, coord):
+        self.hook.after_create_session(session, coord)
+
+    def before_run(self, run_context):
+        start = time()
+        run_args = self.hook.before_run(run_context)
+        self._secs = time() - start
+        return run_args
+
+    def after_run(self, run_context, run_values):
+        start = time()
+        self.hook.after_run(run_context, run_values)
+        self._timings.add(self._phase, self._secs + time() - start)
+
+    def end(self, session):
+        self.hook.end(session)
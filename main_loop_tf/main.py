@@ -1,6 +1,7 @@
 from copy import deepcopy
 import abc
 import hashlib
+from collections import deque
 try:
     from itertools import izip_longest as zip_longest
 except:
@@ -9,23 +10,35 @@ import json
 import logging
 import os
 import sys
+import threading
 from time import time
 
 import dataset_loaders
 import numpy as np
 import tensorflow as tf
+from tensorflow.python.ops.data_flow_ops import StagingArea
 from tensorflow.python.training.training import CheckpointSaverHook
 from tensorflow.python.training.monitored_session import (MonitoredSession,
                                                           ChiefSessionCreator)
 from tqdm import tqdm
 
 import gflags
-from hooks import EarlyStopHook
-from optimization import (apply_lr_decay, average_gradients,
-                          compute_and_process_grads, get_optimizer)
-from utils import (recursive_dict_stack, recursive_truncate_dict,
-                   save_repos_hash, split_in_chunks, squash_maybe, TqdmHandler,
-                   uniquify_path)
+from hooks import (AsyncCheckpointSaverHook, EarlyStopHook, ProfileHook,
+                   TimedHook)
+from optimization import (accumulate_gradients,
+                          apply_gradients_with_loss_scale, apply_lr_decay,
+                          average_gradients, clip_gradients,
+                          compute_and_process_grads, get_grad_accumulators,
+                          get_loss_scale, get_optimizer,
+                          streaming_segmentation_metrics)
+from utils import (AsyncSummaryWriter, cpu_affinity, fp32_storage_getter,
+                   get_tf_config, normalize_per_image, NullTimingRegistry,
+                   OrderedPrefetcher, parse_cpus, parse_steps,
+                   recursive_dict_stack, recursive_truncate_dict,
+                   retag_summary, save_repos_hash, split_in_chunks,
+                   squash_maybe, summary_tier,
+                   SUMMARY_TIERS, TimingRegistry, tower_jit_scope,
+                   TqdmHandler, uniquify_path)
 
 # config module load all flags from source files
 import config  # noqa
@@ -47,6 +60,7 @@ class Experiment(object):
 
     # def validate_fn(self, input_placeholders, graph_outs, which_set):
     #     return dict
+    # If not defined, `default_validate_fn` is used
 
     def __init__(self, flags_argv, Optimizer=None):
         """Create an Experiment object
@@ -61,6 +75,7 @@ class Experiment(object):
         """
         gflags.mark_flags_as_required(['dataset'])
         self.UserOptimizer = Optimizer
+        sys.setrecursionlimit(99999)
 
         # ============ Parse gflags
         try:
@@ -100,8 +115,16 @@ class Experiment(object):
 
         # Init variables
         self._graph_built = False
+        self._thread_local = threading.local()
+        self._unhookedsess = None
+        if self.cfg.timings_freq:
+            self.timings = TimingRegistry(window=self.cfg.timings_window)
+        else:
+            self.timings = NullTimingRegistry()
         self.cum_grads_and_vars = {}
         self.val_graph_outs = {}
+        self._val_datasets = {}
+        self._quick_val_feed_dicts = {}
         self.avg_loss = {True: {}, False: {}}
 
         # Build the graph
@@ -117,16 +140,35 @@ class Experiment(object):
 
         # ============ Hash, (gsheet) and checkpoints
         # Exclude non JSONable and not interesting objects
-        exclude_list = ['checkpoints_basedir', 'checkpoints_to_keep',
-                        'checkpoints_save_secs', 'checkpoints_save_steps',
-                        'data_queues_size', 'dataset', 'debug', 'devices',
-                        'group_summaries', 'help', 'hyperparams_summaries',
+        exclude_list = ['async_checkpoints', 'async_summaries',
+                        'async_val_max_lag', 'async_validation',
+                        'checkpoints_basedir', 'checkpoints_save_secs',
+                        'checkpoints_save_steps', 'checkpoints_to_keep',
+                        'compute_cpus', 'data_queues_size', 'dataset',
+                        'dataset_cache', 'dataset_cache_dir', 'debug',
+                        'devices', 'early_stop_delta', 'early_stop_metric',
+                        'early_stop_set', 'early_stop_smoothing',
+                        'early_stop_strategy', 'feed_queue_size',
+                        'feed_threads', 'grad_bucket_mb', 'grad_recompute',
+                        'grad_reduce_group_size', 'grad_reduce_strategy',
+                        'grappler_options', 'group_summaries', 'help',
+                        'hyperparams_summaries', 'idle_devices_input',
+                        'input_pipeline', 'inter_op_threads',
+                        'intra_op_threads', 'loader_cpus', 'masked_grad_avg',
                         'max_epochs', 'min_epochs', 'model_name',
                         'model_suffix', 'nthreads', 'patience',
-                        'restore_model', 'restore_suite', 'suite_name',
-                        'thresh_loss', 'train_summary_freq', 'use_threads',
-                        'val_every_epochs', 'val_on_sets', 'val_skip_first',
-                        'validate']
+                        'prefetch_batches', 'profile_steps',
+                        'quick_val_batches', 'quick_val_every_steps',
+                        'refresh_dataset_cache', 'restore_model',
+                        'restore_suite', 'save_repos_hash', 'suite_name',
+                        'summaries_drop_policy', 'summaries_flush_secs',
+                        'summaries_queue_size', 'thresh_loss', 'timings_freq',
+                        'timings_window', 'train_hist_summary_freq',
+                        'train_norms_summary_freq', 'train_summary_freq',
+                        'use_threads', 'val_every_epochs', 'val_every_secs',
+                        'val_every_steps', 'val_feed_queue_size',
+                        'val_feed_threads', 'val_on_sets', 'val_skip_first',
+                        'validate', 'xla_jit']
         if hasattr(self, 'extra_exclude_list'):
             exclude_list.extend(self.extra_exclude_list)
         cfg_dump_dict = {k: deepcopy(v) for (k, v) in cfg.__dict__.iteritems()
@@ -134,9 +176,10 @@ class Experiment(object):
         h = hashlib.md5()
         h.update(str(cfg_dump_dict))
         cfg.hash = h.hexdigest()
-        save_repos_hash(cfg_dump_dict, cfg.model_name, ['tensorflow',
-                                                        'dataset_loaders',
-                                                        'main_loop_tf'])
+        if cfg.save_repos_hash:
+            save_repos_hash(cfg_dump_dict, cfg.model_name, ['tensorflow',
+                                                            'dataset_loaders',
+                                                            'main_loop_tf'])
         self._cfg_dump_dict = cfg_dump_dict
 
         checkpoints_path = cfg.checkpoints_basedir
@@ -181,6 +224,11 @@ class Experiment(object):
 
         # ============ A bunch of derived params
         cfg._FLOATX = 'float32'
+        # The type of the computations of the towers
+        if cfg.precision == 'mixed':
+            cfg._COMPUTE_DTYPE = cfg.mixed_dtype
+        else:
+            cfg._COMPUTE_DTYPE = cfg._FLOATX
         # Infer devices from CUDA_VISIBLE_DEVICES if not specified
         if cfg.devices is None:
             cvd = os.environ['CUDA_VISIBLE_DEVICES']
@@ -226,10 +274,19 @@ class Experiment(object):
         dataset_params['use_threads'] = cfg.use_threads
         dataset_params['nthreads'] = cfg.nthreads
         dataset_params['queues_size'] = cfg.data_queues_size
-        dataset_params['remove_per_img_mean'] = cfg.remove_per_img_mean
-        dataset_params['divide_by_per_img_std'] = cfg.divide_by_per_img_std
-        dataset_params['remove_mean'] = cfg.remove_mean
-        dataset_params['divide_by_std'] = cfg.divide_by_std
+        if cfg.input_dtype == 'uint8':
+            if cfg.of:
+                raise ValueError('The optical flow cannot be fed as uint8')
+            # The normalization is done by the graph
+            dataset_params['remove_per_img_mean'] = False
+            dataset_params['divide_by_per_img_std'] = False
+            dataset_params['remove_mean'] = False
+            dataset_params['divide_by_std'] = False
+        else:
+            dataset_params['remove_per_img_mean'] = cfg.remove_per_img_mean
+            dataset_params['divide_by_per_img_std'] = cfg.divide_by_per_img_std
+            dataset_params['remove_mean'] = cfg.remove_mean
+            dataset_params['divide_by_std'] = cfg.divide_by_std
         cfg.dataset_params = dataset_params
         cfg.valid_params = deepcopy(cfg.dataset_params)
         cfg.valid_params.update({
@@ -245,29 +302,17 @@ class Experiment(object):
         # Add dataset extra parameters specific for each dataset
         cfg.valid_params.update(cfg.val_extra_params)
 
-        # Create temporary dataset object (training/validation) to get
-        # dynamic class elements (e.g. data_shape)
-        tmp_dataset_params = deepcopy(cfg.dataset_params)
-        tmp_dataset_params['use_threads'] = False
-        tmp_dataset_params['queues_size'] = 1
-        train_temp = Dataset(
-            which_set='train',
-            return_list=False,
-            **tmp_dataset_params)
-        tmp_dataset_params = deepcopy(cfg.valid_params)
-        tmp_dataset_params['use_threads'] = False
-        tmp_dataset_params['queues_size'] = 1
-        valid_temp = Dataset(
-            which_set='valid',
-            **tmp_dataset_params)
+        # Get the shape of the data of each set to infer dynamic class
+        # elements (e.g. data_shape)
+        train_data_shape, valid_data_shape = self._get_data_shapes(cfg)
 
         # TODO: check fvisin comment, this is not the correct behavior, but
         # it's done in order to work with movingMNST iirc
         if cfg.seq_length:
             cfg.input_shape = [None, cfg.seq_length] + list(
-                train_temp.next()['data'].shape[2:])
+                train_data_shape[2:])
             cfg.val_input_shape = [None, cfg.seq_length] + list(
-                valid_temp.next()['data'].shape[2:])
+                valid_data_shape[2:])
 
             if cfg.of:
                 cfg.input_shape[-1] = 6
@@ -276,24 +321,92 @@ class Experiment(object):
             if cfg.crop_size:
                 cfg.input_shape[2:4] = cfg.crop_size
         else:
-            cfg.input_shape = [None] + list(
-                train_temp.next()['data'].shape[1:])
-            cfg.val_input_shape = [None] + list(
-                valid_temp.next()['data'].shape[1:])
+            cfg.input_shape = [None] + list(train_data_shape[1:])
+            cfg.val_input_shape = [None] + list(valid_data_shape[1:])
             if cfg.crop_size:
                 cfg.input_shape[1:3] = cfg.crop_size
 
         cfg.void_labels = getattr(Dataset, 'void_labels', [])
         cfg.nclasses = Dataset.non_void_nclasses
         cfg.nclasses_w_void = Dataset.nclasses
+        max_label = max([cfg.nclasses_w_void - 1] + list(cfg.void_labels))
+        if max_label > np.iinfo(cfg.labels_dtype).max:
+            raise ValueError('The labels do not fit in {}'.format(
+                cfg.labels_dtype))
         tf.logging.info('{} classes ({} non-void):'.format(cfg.nclasses_w_void,
                                                            cfg.nclasses))
+
+        self.cfg = cfg
+
+    def _get_data_shapes(self, cfg):
+        """Return the shape of the data of the training and validation sets
+
+        Building the datasets to load a minibatch can take a long time,
+        so the shapes are cached on disk, keyed by a hash of the dataset
+        and of its parameters, when `cfg.dataset_cache` is True. The
+        datasets are only built if the shapes are not in the cache or if
+        `cfg.refresh_dataset_cache` is True. The key does not depend on
+        the dataset files, so the cache has to be refreshed by hand when
+        they change.
+        """
+        # The parameters that do not affect the data
+        ignored_params = ['use_threads', 'nthreads', 'queues_size']
+        key_dict = {
+            'dataset': self.Dataset.__module__ + '.' + self.Dataset.__name__,
+            'dataset_params': {k: v for k, v in cfg.dataset_params.iteritems()
+                               if k not in ignored_params},
+            'valid_params': {k: v for k, v in cfg.valid_params.iteritems()
+                             if k not in ignored_params}}
+        h = hashlib.md5()
+        h.update(json.dumps(key_dict, sort_keys=True, default=str))
+        cache_dir = (cfg.dataset_cache_dir or
+                     os.path.join(cfg.checkpoints_basedir, '.dataset_cache'))
+        cache_path = os.path.join(cache_dir, '{}_{}.json'.format(
+            cfg.dataset, h.hexdigest()))
+
+        if (cfg.dataset_cache and not cfg.refresh_dataset_cache and
+                os.path.exists(cache_path)):
+            with open(cache_path) as f:
+                cached = json.load(f)
+            tf.logging.info('Loaded the dataset metadata from {}'.format(
+                cache_path))
+            return cached['train_data_shape'], cached['valid_data_shape']
+
+        # Create temporary dataset object (training/validation)
+        tmp_dataset_params = deepcopy(cfg.dataset_params)
+        tmp_dataset_params['use_threads'] = False
+        tmp_dataset_params['queues_size'] = 1
+        train_temp = self.Dataset(
+            which_set='train',
+            return_list=False,
+            **tmp_dataset_params)
+        tmp_dataset_params = deepcopy(cfg.valid_params)
+        tmp_dataset_params['use_threads'] = False
+        tmp_dataset_params['queues_size'] = 1
+        valid_temp = self.Dataset(
+            which_set='valid',
+            **tmp_dataset_params)
+        train_data_shape = list(train_temp.next()['data'].shape)
+        valid_data_shape = list(valid_temp.next()['data'].shape)
+
         # Destroy temporary dataset objects
         train_temp.finish()
         valid_temp.finish()
         del(train_temp, valid_temp)
 
-        self.cfg = cfg
+        if cfg.dataset_cache:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            # Write to a temporary file first, to never leave a partial
+            # cache file behind
+            tmp_path = '{}.tmp{}'.format(cache_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump({'key': key_dict,
+                           'train_data_shape': train_data_shape,
+                           'valid_data_shape': valid_data_shape},
+                          f, sort_keys=True, indent=4, default=str)
+            os.rename(tmp_path, cache_path)
+        return train_data_shape, valid_data_shape
 
     def get_placeholders(self):
         """Create the graph's placeholders
@@ -311,20 +424,20 @@ class Experiment(object):
         val_placeholders = []
         # Iterate over the devices
         for i, _ in enumerate(range(cfg.num_devs)):
-            train_ins = tf.placeholder(dtype=cfg._FLOATX,
+            train_ins = tf.placeholder(dtype=self.input_dtype,
                                        shape=cfg.input_shape,
                                        name='train_inputs_per_gpu_%i' % i)
-            targets = tf.placeholder(dtype=np.int32,
+            targets = tf.placeholder(dtype=cfg.labels_dtype,
                                      shape=[None],  # flattened
                                      name='targets_per_gpu_%i' % i)
             # Note, the keys have to match those of the minibatch
             train_placeholders.append({'data': train_ins,
                                        'labels': targets})
         for i, _ in enumerate(range(cfg.val_num_devs)):
-            val_ins = tf.placeholder(dtype=cfg._FLOATX,
+            val_ins = tf.placeholder(dtype=self.input_dtype,
                                      shape=cfg.val_input_shape,
                                      name='val_inputs_per_gpu_%i' % i)
-            targets = tf.placeholder(dtype=np.int32,
+            targets = tf.placeholder(dtype=cfg.labels_dtype,
                                      shape=[None],  # flattened
                                      name='targets_per_gpu_%i' % i)
             # Note, the keys have to match those of the minibatch
@@ -332,6 +445,64 @@ class Experiment(object):
                                      'labels': targets})
         return train_placeholders, val_placeholders
 
+    @property
+    def input_dtype(self):
+        """The type the data is fed to the graph with"""
+        if self.cfg.input_dtype == 'uint8':
+            return 'uint8'
+        return self.cfg._FLOATX
+
+    def compact_minibatch(self, minibatch):
+        """Convert a minibatch to the types of the placeholders
+
+        When `cfg.input_dtype` is `uint8`, the data, that the datasets
+        return in [0, 1], is converted to bytes, and the labels are
+        converted to `cfg.labels_dtype`. The minibatch returned by the
+        dataset is left untouched, since the dataset or the caller may
+        hold on to it. Call it on the minibatches used to feed the
+        validation placeholders as well, including in custom
+        `validate_fn`s.
+        """
+        minibatch = dict(minibatch)
+        data = minibatch['data']
+        if self.cfg.input_dtype == 'uint8' and data.dtype != np.uint8:
+            minibatch['data'] = np.clip(np.rint(data * 255), 0,
+                                        255).astype(np.uint8)
+        if minibatch['labels'].dtype != self.cfg.labels_dtype:
+            minibatch['labels'] = minibatch['labels'].astype(
+                self.cfg.labels_dtype)
+        return minibatch
+
+    def cast_inputs(self, dev_inputs):
+        """Cast and normalize the inputs of a device in the graph
+
+        The compact data and labels (see `cfg.input_dtype` and
+        `cfg.labels_dtype`) are converted to `cfg._FLOATX` and int32
+        respectively. When the data is fed as bytes, it is also
+        normalized here rather than by the dataset.
+        """
+        cfg = self.cfg
+        dev_inputs = dict(dev_inputs)
+        if cfg.input_dtype == 'uint8':
+            x = tf.cast(dev_inputs['data'], cfg._FLOATX) / 255.
+            x = normalize_per_image(x, cfg.remove_per_img_mean,
+                                    cfg.divide_by_per_img_std)
+            mean = np.asarray(getattr(self.Dataset, 'mean', []),
+                              dtype=cfg._FLOATX)
+            std = np.asarray(getattr(self.Dataset, 'std', []),
+                             dtype=cfg._FLOATX)
+            if cfg.remove_mean and mean.size:
+                x -= mean
+            if cfg.divide_by_std and std.size:
+                x /= std
+            dev_inputs['data'] = x
+        if dev_inputs['data'].dtype != cfg._COMPUTE_DTYPE:
+            dev_inputs['data'] = tf.cast(dev_inputs['data'],
+                                         cfg._COMPUTE_DTYPE)
+        if dev_inputs['labels'].dtype != tf.int32:
+            dev_inputs['labels'] = tf.cast(dev_inputs['labels'], tf.int32)
+        return dev_inputs
+
     def __build_graph(self):
         if self._graph_built:
             raise RuntimeError('You cannot build the graph twice.')
@@ -361,6 +532,9 @@ class Experiment(object):
                 'global_step', [],
                 initializer=tf.constant_initializer(0),
                 trainable=False, dtype='int32')
+            if cfg.precision == 'mixed':
+                self.loss_scale, self._loss_scale_good_steps = \
+                    get_loss_scale(cfg)
             self.sym_num_devs = tf.placeholder(np.int32, shape=None,
                                                name='num_devs')
             self.sym_num_batches = tf.placeholder(np.int32, shape=None,
@@ -379,11 +553,25 @@ class Experiment(object):
             # placeholders (even if it's internally ignored). We could use
             # placeholder_with_default to assign a value to it's input but
             # the batch_size might change dynamically, so we rather
-            # replicate the input at runtime.
+            # replicate the input at runtime. Alternatively, the unused
+            # placeholders can be fed with empty batches (see
+            # idle_devices_input), so that their towers cost nothing.
             train_placeholders, val_placeholders = self.get_placeholders()
             self.per_dev_placeholders = {True: train_placeholders,
                                          False: val_placeholders}
 
+            # The tensors the towers will be built upon. These are the
+            # placeholders themselves, unless the training inputs are
+            # staged on the devices ahead of time.
+            self.per_dev_inputs = {True: train_placeholders,
+                                   False: val_placeholders}
+            self.per_phase_num_devs = {True: self.sym_num_devs,
+                                       False: self.sym_num_devs}
+            self.per_phase_num_batches = {True: self.sym_num_batches,
+                                          False: self.sym_num_batches}
+            if cfg.input_pipeline == 'staging':
+                self.__build_staging_areas()
+
             # Optimizer
             lr = apply_lr_decay(self.cfg, self.global_step)
             Optimizer = (self.UserOptimizer if self.UserOptimizer else
@@ -400,14 +588,20 @@ class Experiment(object):
                 self.train_graph_outs = self.__build_device_graph(
                     which_set='train', is_training=True)
 
-                # Build the validation graphs (reusing variables) for
-                # each subset we want to run validation on. This is
-                # necessary to build two ops, one to use all the devices
-                # and a second to potentially use less if we cannot feed
-                # all of them with the last batch.
+                # Build the validation graph (reusing variables). All the
+                # subsets we want to run validation on feed the same
+                # placeholders, so they share the same graph and only
+                # have their own metric accumulators. The shared
+                # summaries are written under the V_<set>. family by
+                # `add_val_summary`.
+                if cfg.val_on_sets:
+                    val_graph_out = self.__build_device_graph(
+                        which_set=None, is_training=False)
                 for s in cfg.val_on_sets:
-                    self.val_graph_outs[s] = self.__build_device_graph(
-                        which_set=s, is_training=False)
+                    self.avg_loss[False][s] = self.avg_loss[False][None]
+                    self.val_graph_outs[s] = dict(val_graph_out)
+                    self.val_graph_outs[s]['val_metrics'] = \
+                        self.__build_val_metrics(val_graph_out, s)
 
                 # Create the hyperparameters summaries operations
                 if cfg.hyperparams_summaries is not None:
@@ -429,6 +623,46 @@ class Experiment(object):
                             summary_text.append(summary)
                         self.summary_text_op = tf.summary.merge(summary_text)
 
+    def __build_staging_areas(self):
+        """Stage the training inputs on the devices ahead of time
+
+        Create a StagingArea on each device, that is filled with the
+        training placeholders' values and emptied by the towers. The
+        control flow placeholders are staged as well on CPU, so that
+        each step reads the number of devices and batches of the
+        minibatch it is actually processing rather than those of the
+        minibatch being staged.
+
+        Putting in the StagingArea the minibatch of step t+N while step t
+        is being computed removes the host-to-device copy from the
+        critical path.
+        """
+        cfg = self.cfg
+        put_ops = []
+        staged_inputs = []
+        for dev_id, (dev, p_dict) in enumerate(
+                zip(cfg.devices, self.per_dev_placeholders[True])):
+            names = sorted(p_dict.keys())
+            with tf.device(dev), tf.name_scope('T.staging_dev%d' % dev_id):
+                area = StagingArea(
+                    dtypes=[p_dict[k].dtype for k in names],
+                    shapes=[p_dict[k].get_shape() for k in names],
+                    names=names)
+                put_ops.append(area.put(p_dict))
+                staged_inputs.append(area.get())
+        with tf.device('/cpu:0'), tf.name_scope('T.staging_control_flow'):
+            area = StagingArea(dtypes=[tf.int32, tf.int32],
+                               shapes=[[], []],
+                               names=['num_devs', 'num_batches'])
+            put_ops.append(area.put({'num_devs': self.sym_num_devs,
+                                     'num_batches': self.sym_num_batches}))
+            staged_control_flow = area.get()
+
+        self.staging_put_op = tf.group(*put_ops, name='T.stage_minibatch')
+        self.per_dev_inputs[True] = staged_inputs
+        self.per_phase_num_devs[True] = staged_control_flow['num_devs']
+        self.per_phase_num_batches[True] = staged_control_flow['num_batches']
+
     def get_loss_extra_params(self):
         """Add extra parameters to the loss function
 
@@ -487,12 +721,75 @@ class Experiment(object):
         # against the labels.
         with tf.name_scope(merge_scope):
             stacked_placeholders = {}
-            for p in self.per_dev_placeholders[is_training]:
-                recursive_dict_stack(p, stacked_placeholders)
-            self.placeholders = recursive_truncate_dict(stacked_placeholders,
-                                                        self.sym_num_devs)
+            for p in self.per_dev_inputs[is_training]:
+                recursive_dict_stack(self.cast_inputs(p),
+                                     stacked_placeholders)
+            self.placeholders = recursive_truncate_dict(
+                stacked_placeholders, self.per_phase_num_devs[is_training])
         return graph_out
 
+    def __build_val_metrics(self, graph_out, which_set):
+        """Build the ops that accumulate the validation metrics
+
+        See `streaming_segmentation_metrics`.
+        """
+        cfg = self.cfg
+        with tf.name_scope('V_' + which_set + '.metrics'):
+            # The labels of the devices in use
+            labels = recursive_truncate_dict(
+                {'labels': [p['labels'] for p in self.per_dev_inputs[False]]},
+                self.per_phase_num_devs[False])['labels']
+            return streaming_segmentation_metrics(
+                labels, graph_out['model_outs']['pred'],
+                self.avg_loss[False][which_set],
+                self.per_phase_num_batches[False],
+                cfg.nclasses_w_void, cfg.void_labels)
+
+    def __optimizer_apply(self, grads_and_vars, name):
+        """Return the op that applies the gradients and steps the counter
+
+        With mixed precision, the update is skipped when the gradients
+        overflowed and the loss scale is updated.
+        """
+        if self.cfg.precision == 'mixed':
+            return apply_gradients_with_loss_scale(
+                self.cfg, self.optimizer, grads_and_vars, self.global_step,
+                self.loss_scale, self._loss_scale_good_steps, name=name)
+        return self.optimizer.apply_gradients(
+            grads_and_vars, global_step=self.global_step, name=name)
+
+    def __apply_gradients(self, avg_grads_and_vars, name):
+        """Return the ops to apply and to accumulate the gradients
+
+        Without gradient accumulation, return the op that applies the
+        gradients and None. Otherwise, return the op that adds the
+        gradients to the accumulators and applies the averaged
+        accumulated gradients, clipped, before zeroing the accumulators,
+        and the op that only adds the gradients to the accumulators.
+        Both increment the global step, that counts the minibatches.
+        """
+        cfg = self.cfg
+        if cfg.accum_steps == 1:
+            apply_op = self.__optimizer_apply(avg_grads_and_vars,
+                                              name)  # TODO ha senso?
+            return apply_op, None
+
+        with tf.name_scope(name + '_accum'):
+            accum_op, acc_grads_and_vars = accumulate_gradients(
+                avg_grads_and_vars, self._grad_accumulators,
+                cfg.accum_steps)
+            acc_grads_and_vars = clip_gradients(cfg, acc_grads_and_vars)
+            accum_op = tf.group(accum_op,
+                                tf.assign_add(self.global_step, 1))
+        apply_op = self.__optimizer_apply(acc_grads_and_vars, name)
+        accumulators = [self._grad_accumulators[v]
+                        for g, v in avg_grads_and_vars if g is not None]
+        with tf.name_scope(name + '_accum_reset'):
+            with tf.control_dependencies([apply_op]):
+                apply_op = tf.group(*[tf.assign(acc, tf.zeros_like(acc))
+                                      for acc in accumulators])
+        return apply_op, accum_op
+
     def __build_device_graph(self, which_set, is_training):
         ''' Build the multiGPU graph of computation
 
@@ -518,8 +815,15 @@ class Experiment(object):
         cfg = self.cfg
         reuse_variables = not is_training
 
-        per_dev_placeholders = self.per_dev_placeholders[is_training]
-        phase_set = 'T.' if is_training else 'V_' + which_set + '.'
+        per_dev_placeholders = self.per_dev_inputs[is_training]
+        sym_num_devs = self.per_phase_num_devs[is_training]
+        sym_num_batches = self.per_phase_num_batches[is_training]
+        if is_training:
+            phase_set = 'T.'
+        elif which_set is None:  # Shared by all the validation sets
+            phase_set = 'V.'
+        else:
+            phase_set = 'V_' + which_set + '.'
 
         # Create "towers" with the model outputs/loss keys and a value
         # for each device
@@ -543,11 +847,20 @@ class Experiment(object):
             # the various graphs
             with tf.name_scope(phase_set_dev) as phase_set_dev_scope, \
                     tf.device(dev):
-                with tf.variable_scope('model',
-                                       reuse=reuse_variables) as model_scope:
+                # Cast the (possibly compact) inputs on the device
+                dev_placeholders = self.cast_inputs(dev_placeholders)
+                # With mixed precision, the variables are stored in
+                # float32 and cast to the type of the computations
+                custom_getter = (fp32_storage_getter
+                                 if cfg.precision == 'mixed' else None)
+                with tf.variable_scope('model', reuse=reuse_variables,
+                                       custom_getter=custom_getter) as \
+                        model_scope:
                     # Model preactivation, activation (softmax) and prediction
                     # NOTE Will be then stacked in stacked_model_outs
-                    model_out = self.build_model(dev_placeholders, is_training)
+                    with tower_jit_scope(cfg):
+                        model_out = self.build_model(dev_placeholders,
+                                                     is_training)
                     assert isinstance(model_out, dict), """
                         Your model should return a dictionary"""
                     assert 'out_preact' in model_out, """Your model
@@ -561,9 +874,11 @@ class Experiment(object):
                 with tf.variable_scope('loss', reuse=reuse_variables):
                     reuse_variables = True  # Reuse from now on
                     loss_params = self.get_loss_extra_params()
-                    loss_out = self.build_loss(dev_placeholders, model_out,
-                                               is_training=is_training,
-                                               **loss_params)
+                    with tower_jit_scope(cfg):
+                        loss_out = self.build_loss(dev_placeholders,
+                                                   model_out,
+                                                   is_training=is_training,
+                                                   **loss_params)
                 assert loss_out is not None and isinstance(loss_out, dict), (
                     """Your loss should return a dictionary""")
                 assert 'loss' in loss_out, """Your loss function should
@@ -572,6 +887,12 @@ class Experiment(object):
                     return a dictionary with attribute 'components'
                     containing the list of terms that composes the total
                     loss!"""
+                if cfg.precision == 'mixed':
+                    # Aggregate and differentiate the loss in float32
+                    loss_out['loss'] = tf.cast(loss_out['loss'], tf.float32)
+                    loss_out['components'] = {
+                        k: tf.cast(v, tf.float32)
+                        for k, v in loss_out['components'].iteritems()}
                 # Append this device's loss outs to those of prev devices
                 recursive_dict_stack(loss_out, stacked_loss_outs)
 
@@ -637,9 +958,48 @@ class Experiment(object):
             #  ...
             these_s = these_s[1:]
 
+        # Create the buffers to accumulate the gradients, outside of any
+        # control dependency context
+        if is_training and cfg.accum_steps > 1:
+            self._grad_accumulators = get_grad_accumulators(
+                sorted(self.cum_grads_and_vars.keys(),
+                       key=lambda v: v.op.name))
+
         # Average the gradients on CPU and do SGD
-        if is_training:
+        avg_kwargs = {'bucket_size': int(cfg.grad_bucket_mb * 2 ** 20),
+                      'reduce_strategy': cfg.grad_reduce_strategy,
+                      'devices': cfg.devices,
+                      'group_size': cfg.grad_reduce_group_size}
+        if is_training and cfg.masked_grad_avg:
+            # Average the gradients of the devices in use, selected at
+            # run-time, and apply them with one single op
+            avg_grads_and_vars = average_gradients(self.cum_grads_and_vars,
+                                                   'T.grads.',
+                                                   sym_num_devs=sym_num_devs,
+                                                   **avg_kwargs)
+            apply_op, accum_op = self.__apply_gradients(avg_grads_and_vars,
+                                                        'T.grads')
+
+            # Create a *list* of ops that run the gradient update along
+            # with the update operations of the devices *up to* the t-th
+            # device. These are cheap groups that all share the same
+            # averaging and update ops.
+            grad_ops = []
+            accum_grad_ops = []
+            update_ops = []
+            for dev_id, dev in enumerate(cfg.devices):
+                phase_set_dev = 'T.dev' + str(dev_id)
+                update_ops += tf.get_collection(tf.GraphKeys.UPDATE_OPS,
+                                                scope=phase_set_dev)
+                grad_ops.append(tf.group(apply_op, *update_ops,
+                                         name='T.grads_uptodev%d' % dev_id))
+                if accum_op is not None:
+                    accum_grad_ops.append(tf.group(
+                        accum_op, *update_ops,
+                        name='T.accum_grads_uptodev%d' % dev_id))
+        elif is_training:
             grad_ops = []
+            accum_grad_ops = []
             update_ops = []
             for dev_id, dev in enumerate(cfg.devices):
                 # Recover device name_space
@@ -651,20 +1011,22 @@ class Experiment(object):
                 # Average the gradients over the devices processed so far
                 avg_grads_and_vars = average_gradients(self.cum_grads_and_vars,
                                                        scope + '.',
-                                                       up_to_dev=dev_id)
+                                                       up_to_dev=dev_id,
+                                                       **avg_kwargs)
 
                 # Impose graph dependency so that update operations are
                 # computed even if they're are not explicit in the outputs os
                 # session.run
                 with tf.control_dependencies(update_ops):
-                    grad_op = self.optimizer.apply_gradients(
-                        avg_grads_and_vars, global_step=self.global_step,
-                        name=scope)  # TODO ha senso? Probabilmente no
+                    grad_op, accum_op = self.__apply_gradients(
+                        avg_grads_and_vars, scope)
 
                 # Create a *list* of gradient update ops. The t-th element of
                 # the list updates the gradients of the devices *up to* the
                 # t-th device
                 grad_ops.append(grad_op)
+                if accum_op is not None:
+                    accum_grad_ops.append(accum_op)
 
             # Add the histograms of the gradients (all of them)
             # for grad, var in avg_grads_and_vars:
@@ -680,11 +1042,11 @@ class Experiment(object):
         with tf.name_scope(phase_set + 'merge_devs') as merge_scope:
             ps = phase_set
             curr_model_out = recursive_truncate_dict(stacked_model_outs,
-                                                     self.sym_num_batches,
+                                                     sym_num_batches,
                                                      parent_k=ps + '/outs',
                                                      exact_len=cfg.num_devs)
             curr_loss_out = recursive_truncate_dict(stacked_loss_outs,
-                                                    self.sym_num_devs,
+                                                    sym_num_devs,
                                                     parent_k=ps + '/losses',
                                                     exact_len=cfg.num_devs)
             self.loss_tensor = curr_loss_out['loss']
@@ -723,6 +1085,8 @@ class Experiment(object):
         # to update the loss summaries correctly
         with tf.name_scope(stats_scope):
             tf.summary.scalar('avg_loss', avg_loss, summaries)
+            if is_training and cfg.precision == 'mixed':
+                tf.summary.scalar('loss_scale', self.loss_scale, summaries)
 
         if is_training:
             # Write the summary of the mean per-component loss over the first
@@ -754,16 +1118,30 @@ class Experiment(object):
         # *up to* the n-th device. This will be used at run-time to ignore the
         # devices that are not in use when there are not enough batches to feed
         # all of them
+        # The summaries are also merged per tier (see `summary_tier`), to
+        # run the expensive ones less frequently. A tier can be None if
+        # it contains no summaries.
         summary_ops = []
+        tiered_summary_ops = {t: [] for t in SUMMARY_TIERS}
         for s in summaries:
-            summary_ops.append(tf.summary.merge(tf.get_collection_ref(key=s)))
+            collection = tf.get_collection_ref(key=s)
+            summary_ops.append(tf.summary.merge(collection))
+            for t in SUMMARY_TIERS:
+                tier_summaries = [el for el in collection
+                                  if summary_tier(el) == t]
+                tiered_summary_ops[t].append(
+                    tf.summary.merge(tier_summaries) if tier_summaries
+                    else None)
 
         graph_out = {
             'model_outs': curr_model_out,
             'summary_ops': summary_ops,
+            'tiered_summary_ops': tiered_summary_ops,
             }
         if is_training:
             graph_out['grad_ops'] = grad_ops
+            if cfg.accum_steps > 1:
+                graph_out['accum_grad_ops'] = accum_grad_ops
 
         # Allow the user to define custom metrics to be applied and
         # added to graph_out
@@ -773,6 +1151,19 @@ class Experiment(object):
 
         return graph_out
 
+    @property
+    def unhookedsess(self):
+        """The session without hooks
+
+        Threads other than the main one (e.g., the asynchronous
+        validation) can override it with their own session."""
+        return getattr(self._thread_local, 'unhookedsess',
+                       self._unhookedsess)
+
+    @unhookedsess.setter
+    def unhookedsess(self, sess):
+        self._unhookedsess = sess
+
     def run(self):
         with self._init_sess() as self.sess:
             self.unhookedsess = self.sess._sess._sess._sess._sess
@@ -788,7 +1179,10 @@ class Experiment(object):
                         uninit_vars))
 
             # Start training loop
-            return self._main_loop()
+            ret = self._main_loop()
+        # The hooks can write summaries until the session is closed
+        self.summary_writer.close()
+        return ret
 
     def validate(self):
         with self._init_sess() as self.sess:
@@ -804,17 +1198,190 @@ class Experiment(object):
                     raise RuntimeError('Uninitialized variables: {}'.format(
                         uninit_vars))
 
-            validate_fn = getattr(self, "validate_fn", None)
-            if validate_fn is not None:
-                metrics_val = {}
-                for s in self.cfg.val_on_sets:
-                    metrics_val[s] = validate_fn(
-                        self.val_graph_outs[s],
-                        which_set=s)
-                return metrics_val
-            else:
-                raise ValueError('No validation function defined! You '
-                                 'should implement validate_fn')
+            return self.validate_sets(self.cfg.val_on_sets)
+
+    def validate_sets(self, which_sets):
+        """Return the validation metrics of each of `which_sets`
+
+        If the experiment defines its own `validate_fn`, it is run on
+        each set in turn. Otherwise all the sets are validated at once,
+        interleaving their minibatches (see `_default_validate`).
+        """
+        validate_fn = getattr(self, "validate_fn", None)
+        if validate_fn is None:
+            return self._default_validate(which_sets)
+        metrics_val = {}
+        for s in which_sets:
+            metrics_val[s] = validate_fn(
+                self.val_graph_outs[s],
+                which_set=s)
+        return metrics_val
+
+    def add_val_summary(self, summary, which_set, global_step):
+        """Write a summary of the validation graph for `which_set`
+
+        The validation graph, and thus its `summary_ops` and
+        `tiered_summary_ops`, are shared by all the validation sets,
+        and their summaries are tagged `V.`. They are written here as
+        `V_<which_set>.`, so that the curves of the validation sets do
+        not overwrite each other. A custom `validate_fn` should write
+        the summaries it runs with this method.
+        """
+        self.summary_writer.add_summary(
+            retag_summary(summary, 'V.', 'V_' + which_set + '.'),
+            global_step)
+
+    def _val_feed_dicts(self, dataset, nbatches=None):
+        """Return the feed_dicts of one epoch of a validation set
+
+        With `cfg.val_feed_threads`, the minibatches are loaded in
+        order by one thread at a time, to preserve the order of the
+        dataset, while their feed_dicts are built in parallel. If
+        `nbatches` is given, only the first `nbatches` minibatches are
+        loaded. Close the returned iterator to stop the threads before
+        the end of the epoch.
+        """
+        cfg = self.cfg
+        nbatches = min(nbatches or dataset.nbatches, dataset.nbatches)
+
+        def process(minibatch):
+            minibatch = self.compact_minibatch(minibatch)
+            feed_dict, _ = self._build_feed_dict(
+                minibatch, self.get_n_splits(minibatch, cfg.val_batch_size),
+                is_training=False)
+            return feed_dict
+
+        if cfg.val_feed_threads == 0:
+            return (process(dataset.next()) for _ in range(nbatches))
+        # The threads inherit the affinity of this thread
+        with cpu_affinity(parse_cpus(cfg.loader_cpus)):
+            return OrderedPrefetcher(dataset.next, process, nbatches,
+                                     nthreads=cfg.val_feed_threads,
+                                     max_ahead=cfg.val_feed_queue_size)
+
+    def default_validate_fn(self, graph_out, which_set):
+        """Validate on one epoch of `which_set`
+
+        The metrics are accumulated on-graph (see `__build_val_metrics`)
+        so that neither the predictions nor the labels are fetched: only
+        the final metrics are. Used when the experiment does not define
+        its own `validate_fn`.
+
+        Returns
+        -------
+            metrics: dict
+                The `mean_iou` and the `per_class_iou` of the non-void
+                classes, the pixel `accuracy` and the mean `loss`.
+        """
+        return self._default_validate([which_set])[which_set]
+
+    def quick_validate(self, which_sets):
+        """Validate on a fixed subset of each of `which_sets`
+
+        The subset is made of the first `cfg.quick_val_batches`
+        minibatches of the set, whose feed_dicts are prepared once and
+        kept in memory, so that the quick validation costs only the
+        forward passes. See `_default_validate`.
+        """
+        cfg = self.cfg
+        for s in which_sets:
+            if s not in self._quick_val_feed_dicts:
+                dataset = self.Dataset(
+                    which_set=s,
+                    **cfg.valid_params)
+                set_feed_dicts = self._val_feed_dicts(dataset,
+                                                      cfg.quick_val_batches)
+                try:
+                    self._quick_val_feed_dicts[s] = list(set_feed_dicts)
+                finally:
+                    # Stop the loading threads before the dataset
+                    set_feed_dicts.close()
+                    dataset.finish()
+        return self._default_validate(which_sets, quick=True)
+
+    def _default_validate(self, which_sets, quick=False):
+        """Validate on one epoch of each of `which_sets`
+
+        The minibatches of the sets are interleaved through the shared
+        validation graph, each updating the accumulators of its set, so
+        that all the sets are loaded concurrently and the devices do
+        not wait for the data at the boundaries between sets. The
+        metrics of each set are logged and written to the summaries.
+        If `quick`, validate on the subsets of `quick_validate` instead.
+
+        The loading threads are stopped before returning. If the
+        validation fails, the datasets of the sets, left mid-epoch, are
+        discarded.
+
+        Returns
+        -------
+            metrics_val: dict
+                The metrics of each set (see `default_validate_fn`).
+        """
+        cfg = self.cfg
+        sess = self.unhookedsess
+        metrics = {s: self.val_graph_outs[s]['val_metrics']
+                   for s in which_sets}
+        sess.run([m['reset_op'] for m in metrics.values()])
+
+        feed_dicts = []
+        loaders = []
+        done = False
+        try:
+            for s in which_sets:
+                if quick:
+                    feed_dicts.append(
+                        (s, iter(self._quick_val_feed_dicts[s])))
+                    continue
+                if s not in self._val_datasets:
+                    self._val_datasets[s] = self.Dataset(
+                        which_set=s,
+                        **cfg.valid_params)
+                loaders.append(self._val_feed_dicts(self._val_datasets[s]))
+                feed_dicts.append((s, loaders[-1]))
+            # Round robin over the sets that have minibatches left
+            while feed_dicts:
+                for el in list(feed_dicts):
+                    s, set_feed_dicts = el
+                    try:
+                        feed_dict = next(set_feed_dicts)
+                    except StopIteration:
+                        feed_dicts.remove(el)
+                        continue
+                    sess.run(metrics[s]['update_op'], feed_dict=feed_dict)
+            done = True
+        finally:
+            # No thread must call the datasets after this point
+            for set_feed_dicts in loaders:
+                set_feed_dicts.close()
+            if not done and not quick:
+                for s in which_sets:
+                    dataset = self._val_datasets.pop(s, None)
+                    if dataset is not None:
+                        dataset.finish()
+
+        values, global_step = sess.run(
+            [{s: m['values'] for s, m in metrics.iteritems()},
+             self.global_step])
+        metrics_val = {}
+        name = 'quick_metrics' if quick else 'metrics'
+        for s in which_sets:
+            v = values[s]
+            tf.logging.info('{} on {}: mean IoU {:.5f}, accuracy {:.5f}, '
+                            'loss {:.5f}'.format(
+                                'Quick validation' if quick else 'Validation',
+                                s, v['mean_iou'], v['accuracy'], v['loss']))
+            tf.logging.debug('Per-class IoU on {}: {}'.format(
+                s, v['per_class_iou']))
+            summary = tf.Summary(value=[
+                tf.Summary.Value(tag='V_{}.{}/{}'.format(s, name, k),
+                                 simple_value=v[k])
+                for k in ['mean_iou', 'accuracy', 'loss']])
+            self.summary_writer.add_summary(summary, global_step)
+            metrics_val[s] = {k: float(v[k])
+                              for k in ['mean_iou', 'accuracy', 'loss']}
+            metrics_val[s]['per_class_iou'] = v['per_class_iou'].tolist()
+        return metrics_val
 
     def get_hooks(self):
         # For more hooks see
@@ -825,15 +1392,24 @@ class Experiment(object):
         # Checkpoint saver hook
         save_secs = self.cfg.checkpoints_save_secs or None
         save_steps = self.cfg.checkpoints_save_steps or None
-        saver = tf.train.Saver(
-            name='Saver',
-            save_relative_paths=True,
-            max_to_keep=cfg.checkpoints_to_keep)
-        saver_hook = CheckpointSaverHook(self.cfg.save_path,
-                                         saver=saver,
-                                         save_secs=save_secs,
-                                         save_steps=save_steps,
-                                         checkpoint_basename='model.ckpt')
+        if cfg.async_checkpoints:
+            saver_hook = AsyncCheckpointSaverHook(
+                self, self.cfg.save_path,
+                save_secs=save_secs,
+                save_steps=save_steps,
+                checkpoint_basename='model.ckpt',
+                max_to_keep=cfg.checkpoints_to_keep)
+        else:
+            saver = tf.train.Saver(
+                name='Saver',
+                save_relative_paths=True,
+                max_to_keep=cfg.checkpoints_to_keep)
+            saver_hook = CheckpointSaverHook(self.cfg.save_path,
+                                             saver=saver,
+                                             save_secs=save_secs,
+                                             save_steps=save_steps,
+                                             checkpoint_basename='model.ckpt')
+        self.saver_hook = saver_hook
         hooks.append(saver_hook)
 
         # Max epochs and early stopping
@@ -842,6 +1418,12 @@ class Experiment(object):
 
         if self.cfg.nan:
             hooks.append(tf.train.NanTensorHook(self.loss_tensor))
+
+        # Chrome traces and per-op costs of the chosen steps
+        profile_steps = parse_steps(cfg.profile_steps)
+        if profile_steps:
+            hooks.append(ProfileHook(self, profile_steps,
+                                     os.path.join(cfg.save_path, 'profile')))
         return hooks
 
     def _init_sess(self):
@@ -860,13 +1442,25 @@ class Experiment(object):
             #   training/basic_session_run_hooks.py#L337
             # TODO Use tf.contrib.summary
             self.summary_writer = tf.summary.FileWriter(self.cfg.save_path)
-            tf_config = tf.ConfigProto(allow_soft_placement=True)
+            if self.cfg.async_summaries:
+                self.summary_writer = AsyncSummaryWriter(
+                    self.summary_writer,
+                    max_queue=self.cfg.summaries_queue_size,
+                    drop_policy=self.cfg.summaries_drop_policy,
+                    flush_secs=self.cfg.summaries_flush_secs)
+            self.tf_config = get_tf_config(self.cfg)
             sess_creator = ChiefSessionCreator(
-                config=tf_config,
+                config=self.tf_config,
                 checkpoint_dir=self.cfg.restore_path)
             self._hooks = self.get_hooks()
-            sess_gen = MonitoredSession(session_creator=sess_creator,
-                                        hooks=self._hooks)
+            if self.cfg.timings_freq:
+                self._hooks = [TimedHook(h, self.timings)
+                               for h in self._hooks]
+            # The thread pools of the session inherit the affinity of
+            # the thread that creates them
+            with cpu_affinity(parse_cpus(self.cfg.compute_cpus)):
+                sess_gen = MonitoredSession(session_creator=sess_creator,
+                                            hooks=self._hooks)
 
             return sess_gen
 
@@ -887,14 +1481,41 @@ class Experiment(object):
         self.experiment_end()
         return self.return_value
 
-    def get_train_dicts(self, which_op):
+    def get_summary_tiers(self):
+        """Return the summary tiers to be computed at this step"""
+        cfg = self.cfg
+        freqs = {'scalars': cfg.train_summary_freq,
+                 'norms': cfg.train_norms_summary_freq or
+                 cfg.train_summary_freq,
+                 'histograms': cfg.train_hist_summary_freq or
+                 cfg.train_summary_freq}
+        return [t for t in SUMMARY_TIERS
+                if self.global_step_val % freqs[t] == 0]
+
+    def is_update_step(self):
+        """Whether the gradients are applied at this step
+
+        With gradient accumulation, the gradients are only applied
+        every `cfg.accum_steps` minibatches."""
+        return (self.global_step_val + 1) % self.cfg.accum_steps == 0
+
+    def get_train_dicts(self, which_op, summary_tiers=SUMMARY_TIERS):
+        tiered_summary_ops = self.train_graph_outs['tiered_summary_ops']
+        summary_ops = [tiered_summary_ops[t][which_op] for t in summary_tiers]
+        grad_ops_key = 'grad_ops' if self.is_update_step() else \
+            'accum_grad_ops'
+        train_op = self.train_graph_outs[grad_ops_key][which_op]
         train_dict = {
             'avg_loss': self.avg_loss[True]['train'],
-            'train_op': self.train_graph_outs['grad_ops'][which_op]}
+            'train_op': train_op}
         train_summary_dict = {
             'avg_loss': self.avg_loss[True]['train'],
-            'train_op': self.train_graph_outs['grad_ops'][which_op],
-            'summary_op': self.train_graph_outs['summary_ops'][which_op]}
+            'train_op': train_op,
+            'summary_op': [op for op in summary_ops if op is not None]}
+        if self.cfg.input_pipeline == 'staging':
+            # Stage the next minibatch while this one is processed
+            train_dict['stage_op'] = self.staging_put_op
+            train_summary_dict['stage_op'] = self.staging_put_op
         return train_dict, train_summary_dict
 
     # ###########
@@ -907,10 +1528,12 @@ class Experiment(object):
             self.cfg.valid_params))
 
         # TODO find a better name?
-        self.train = self.Dataset(
-            which_set='train',
-            return_list=False,
-            **self.cfg.dataset_params)
+        # The loading threads inherit the affinity of this thread
+        with cpu_affinity(parse_cpus(self.cfg.loader_cpus)):
+            self.train = self.Dataset(
+                which_set='train',
+                return_list=False,
+                **self.cfg.dataset_params)
 
         # Dump parameters and commit hash/diff to save path
         # Do not overwrite by default
@@ -926,6 +1549,19 @@ class Experiment(object):
         self.loss_value = 0
         self.global_step_val = self.global_step.eval(self.unhookedsess)
 
+        # Start the threads that prepare the feed_dicts in advance
+        self._feed_prefetcher = None
+        self._prefetched_feed_dict = None
+        if self.cfg.feed_threads > 0:
+            self._start_feed_threads()
+
+        # Fill the StagingAreas with the first minibatches
+        if self.cfg.input_pipeline == 'staging':
+            self._staged = deque()
+            for _ in range(self.cfg.prefetch_batches):
+                feed_dict = self.get_staging_feed_dict(*self._load_minibatch())
+                self.unhookedsess.run(self.staging_put_op, feed_dict=feed_dict)
+
         # If it's the first run, log the hyperparameters in TB
         if (self.cfg.hyperparams_summaries is not None and
                 self.global_step_val == 0):
@@ -947,97 +1583,240 @@ class Experiment(object):
                          dynamic_ncols=True,
                          bar_format=bar_format)
 
+    def _start_feed_threads(self):
+        """Start the threads that prepare the minibatches in advance
+
+        The minibatches are loaded in order by one thread at a time,
+        while `cfg.feed_threads` threads split them per device and
+        build their feed_dict in parallel. `batch_begin` consumes them
+        in the order of the dataset, at most `cfg.feed_queue_size` of
+        them being prepared in advance."""
+        cfg = self.cfg
+
+        def process(minibatch):
+            minibatch = self.compact_minibatch(minibatch)
+            feed_dict, minibatch_chunks = self._build_feed_dict(
+                minibatch, self.get_n_splits(minibatch))
+            return minibatch, minibatch_chunks, feed_dict
+
+        self._producers_start = time()
+        # The threads inherit the affinity of this thread
+        with cpu_affinity(parse_cpus(cfg.loader_cpus)):
+            self._feed_prefetcher = OrderedPrefetcher(
+                self.train.next, process, None, nthreads=cfg.feed_threads,
+                max_ahead=cfg.feed_queue_size)
+
+    def _stop_feed_threads(self):
+        if self._feed_prefetcher is None:
+            return
+        self._feed_prefetcher.close()
+        self._feed_prefetcher = None
+
+    def _load_minibatch(self):
+        """Return the next minibatch
+
+        Return a tuple with the minibatch, its chunks and its feed_dict.
+        The last two are None unless they have been prepared in advance
+        by the feed threads."""
+        if self._feed_prefetcher is None:
+            return self.compact_minibatch(self.train.next()), None, None
+        return next(self._feed_prefetcher)
+
     def batch_begin(self):
         iter_start = time()
-        self._minibatch = self.train.next()
+        if self._feed_prefetcher is not None:
+            self._feed_queue_occupancy = self._feed_prefetcher.ready()
+        if self.cfg.input_pipeline == 'staging':
+            # The minibatch of this step is already on the devices: load
+            # the one that will be staged in its place
+            self._minibatch, self._minibatch_chunks = self._staged.popleft()
+            self._next_minibatch = self._load_minibatch()
+        else:
+            (self._minibatch, self._minibatch_chunks,
+             self._prefetched_feed_dict) = self._load_minibatch()
         self._t_data_load = time() - iter_start
+        self.timings.add('data_fetch', self._t_data_load)
         if self._t_data_load > 1:
             tf.logging.info('Data preprocess and loading took {}'
                             's. Consider increasing the '
                             'data_queues_size parameter.'.format(
                                 self._t_data_load))
 
-    def get_feed_dict(self, n_splits):
+    def get_n_splits(self, minibatch, batch_size=None):
+        """Return the number of devices the minibatch can feed
+
+        `batch_size` is the per-device batch size, by default the
+        training one."""
+        # Is this batch shorter than batch_size?
+        # Check if this batch will not be processed by all the devices.
+        # When the sequence is shorter than seq_length or the number of
+        # batches is smaller than batch_size, the batch will be smaller
+        # than usual. When this happens we might not be able to feed
+        # all the CPUs/GPUs altogether. In that case here we compute
+        # the number of GPUs that we can use for the current batch
+        # Spread the batch over the lowest number of GPUs
+        batch_size = batch_size or self.cfg.batch_size
+        x_batch = minibatch['data']
+        n_splits = len(x_batch) // batch_size
+        if len(x_batch) % batch_size != 0:
+            n_splits += 1
+        return n_splits
+
+    def _build_feed_dict(self, minibatch, n_splits, is_training=True):
+        phase = '' if is_training else 'val_'
         # Get the per-device inputs
-        minibatch_chunks = split_in_chunks(self._minibatch, n_splits,
-                                           flatten_keys=['labels'])
+        with self.timings.time(phase + 'split'):
+            minibatch_chunks = split_in_chunks(minibatch, n_splits,
+                                               flatten_keys=['labels'])
+        t_feed_dict = time()
 
         # Associate each placeholder (of each device) with its input data. Note
         # that the data is split in chunk, one per device. If this_n_splits is
         # smaller than the number of devices, the placeholders of the "extra"
-        # devices are filled with the data of the first chunk. This is
-        # necessary to feed the graph with the expected number of inputs, but
-        # note that the extra outputs and loss will be ignored (see comment
-        # where placeholders are created)
+        # devices are filled with the data of the first chunk, or with an
+        # empty batch if idle_devices_input is `empty`. This is necessary to
+        # feed the graph with the expected number of inputs, but note that
+        # the extra outputs and loss will be ignored (see comment where
+        # placeholders are created)
+        if self.cfg.idle_devices_input == 'empty':
+            fillvalue = {k: v[:0] for k, v in minibatch_chunks[0].iteritems()}
+        else:
+            fillvalue = minibatch_chunks[0]
         feed_dict = {}
-        for p_dict, batch_dict in zip_longest(self.per_dev_placeholders[True],
-                                              minibatch_chunks,
-                                              fillvalue=minibatch_chunks[0]):
+        for p_dict, batch_dict in zip_longest(
+                self.per_dev_placeholders[is_training], minibatch_chunks,
+                fillvalue=fillvalue):
             for p_name, p_obj in p_dict.iteritems():
                 feed_dict[p_obj] = batch_dict[p_name]
 
-        self._minibatch_chunks = minibatch_chunks
         # Extend the user-defined placeholders with those needed by the
         # main loop
         feed_dict[self.sym_num_devs] = n_splits
-        feed_dict[self.sym_num_batches] = len(self._minibatch['data'])
+        feed_dict[self.sym_num_batches] = len(minibatch['data'])
+        self.timings.add(phase + 'feed_dict', time() - t_feed_dict)
+        return feed_dict, minibatch_chunks
+
+    def get_feed_dict(self, n_splits):
+        if self._prefetched_feed_dict is not None:
+            feed_dict = self._prefetched_feed_dict
+        else:
+            feed_dict, self._minibatch_chunks = self._build_feed_dict(
+                self._minibatch, n_splits)
         feed_dict[self.sym_prev_err] = self.loss_value
         return feed_dict
 
-    def batch_do(self):
-        cfg = self.cfg
+    def get_staging_feed_dict(self, minibatch, minibatch_chunks=None,
+                              feed_dict=None):
+        """Return the feed_dict to stage a minibatch on the devices
 
-        # inputs and labels
-        x_batch = self._minibatch['data']
-        # sh = inputs.shape  # do NOT provide a list of shapes
+        The minibatch and its chunks are queued, to be retrieved by
+        `batch_begin` at the step that will process them."""
+        if feed_dict is None:
+            feed_dict, minibatch_chunks = self._build_feed_dict(
+                minibatch, self.get_n_splits(minibatch))
+        self._staged.append((minibatch, minibatch_chunks))
+        return feed_dict
 
-        # Is this batch shorter than batch_size?
-        # Check if this batch will not be processed by all the devices.
-        # When the sequence is shorter than seq_length or the number of
-        # batches is smaller than batch_size, the batch will be smaller
-        # than usual. When this happens we might not be able to feed
-        # all the CPUs/GPUs altogether. In that case here we compute
-        # the number of GPUs that we can use for the current batch
-        # Spread the batch over the lowest number of GPUs
-        this_n_splits = len(x_batch) // cfg.batch_size
-        if len(x_batch) % cfg.batch_size != 0:
-            this_n_splits += 1
+    def batch_do(self):
+        this_n_splits = self.get_n_splits(self._minibatch)
 
-        self._feed_dict = self.get_feed_dict(this_n_splits)
+        if self.cfg.input_pipeline == 'staging':
+            self._feed_dict = self.get_staging_feed_dict(
+                *self._next_minibatch)
+            self._feed_dict[self.sym_prev_err] = self.loss_value
+        else:
+            self._feed_dict = self.get_feed_dict(this_n_splits)
 
         # Use the op for the number of devices the current batch can feed
         which_op = this_n_splits - 1
 
-        train_dict, train_summary_dict = self.get_train_dicts(which_op)
+        summary_tiers = self.get_summary_tiers()
+        train_dict, train_summary_dict = self.get_train_dicts(which_op,
+                                                              summary_tiers)
 
         # Compute (summaries and) loss
         # TODO make this a hook
-        if self.global_step_val % self.cfg.train_summary_freq == 0:
-            fetch_dict = self.sess.run(train_summary_dict,
-                                       feed_dict=self._feed_dict)
-            self.summary_writer.add_summary(fetch_dict['summary_op'],
-                                            self.global_step_val)
+        # Note that sess_run includes the time spent in the hooks
+        if train_summary_dict['summary_op']:
+            with self.timings.time('sess_run'):
+                fetch_dict = self.sess.run(train_summary_dict,
+                                           feed_dict=self._feed_dict)
+            with self.timings.time('summary_write'):
+                for summary in fetch_dict['summary_op']:
+                    self.summary_writer.add_summary(summary,
+                                                    self.global_step_val)
         else:
-            fetch_dict = self.sess.run(train_dict, feed_dict=self._feed_dict)
+            with self.timings.time('sess_run'):
+                fetch_dict = self.sess.run(train_dict,
+                                           feed_dict=self._feed_dict)
         self._fetch_dict = fetch_dict
 
         # Update self.loss_value, potentially used to decide the amount
         # of gradient noise in `process_gradients` via sym_prev_err.
         self.loss_value = fetch_dict['avg_loss']
 
+    def write_input_summaries(self):
+        """Write the data loading statistics to tensorboard
+
+        The time spent waiting for the data tells whether the run is
+        input-bound. When the feed threads are in use, the occupancy of
+        their queue and their throughput are also reported."""
+        values = [tf.Summary.Value(tag='T.input_pipeline/stall_secs',
+                                   simple_value=self._t_data_load)]
+        if self._feed_prefetcher is not None:
+            n_produced = self._feed_prefetcher.n_processed
+            throughput = n_produced / max(time() - self._producers_start, 1e-6)
+            values += [
+                tf.Summary.Value(tag='T.input_pipeline/queue_occupancy',
+                                 simple_value=self._feed_queue_occupancy),
+                tf.Summary.Value(tag='T.input_pipeline/batches_per_sec',
+                                 simple_value=throughput)]
+        self.summary_writer.add_summary(tf.Summary(value=values),
+                                        self.global_step_val)
+
+    def write_timings(self):
+        """Write the percentiles of the duration of each phase
+
+        They are written to tensorboard and appended to the
+        `timings.jsonl` file in the save path, one JSON object per
+        line."""
+        stats = self.timings.percentiles()
+        values = []
+        for phase, phase_stats in sorted(stats.iteritems()):
+            for k, v in sorted(phase_stats.iteritems()):
+                if k != 'n':
+                    values.append(tf.Summary.Value(
+                        tag='T.timings/{}/{}'.format(phase, k),
+                        simple_value=v))
+        self.summary_writer.add_summary(tf.Summary(value=values),
+                                        self.global_step_val)
+        with open(os.path.join(self.cfg.save_path, 'timings.jsonl'),
+                  'a') as f:
+            f.write(json.dumps({'step': self.global_step_val,
+                                'time': time(),
+                                'timings': stats}, sort_keys=True) + '\n')
+
     def batch_end(self):
-        self.pbar.set_description('({:3d}) Ep {:d}'.format(
-            self.global_step_val + 1, self.epoch_id + 1))
-        avg_loss = self._fetch_dict['avg_loss']
-        self.pbar.set_postfix({'D': '{:.2f}s'.format(self._t_data_load),
-                               'loss': '{:.3f}'.format(avg_loss)})
-        self.pbar.update(1)
+        if self.global_step_val % self.cfg.train_summary_freq == 0:
+            with self.timings.time('summary_write'):
+                self.write_input_summaries()
+        with self.timings.time('tqdm'):
+            self.pbar.set_description('({:3d}) Ep {:d}'.format(
+                self.global_step_val + 1, self.epoch_id + 1))
+            avg_loss = self._fetch_dict['avg_loss']
+            self.pbar.set_postfix({'D': '{:.2f}s'.format(self._t_data_load),
+                                   'loss': '{:.3f}'.format(avg_loss)})
+            self.pbar.update(1)
+        if (self.cfg.timings_freq and
+                self.global_step_val % self.cfg.timings_freq == 0):
+            self.write_timings()
         self.global_step_val += 1
 
     def epoch_end(self):
         self.pbar.close()
 
     def experiment_end(self):
+        self._stop_feed_threads()
         end = time()
         m, s = divmod(end - self.start, 60)
         h, m = divmod(m, 60)
@@ -1,3 +1,5 @@
+import math
+
 import tensorflow as tf
 import gflags
 
@@ -9,6 +11,7 @@ from tensorflow.python.ops.metrics_impl import _streaming_confusion_matrix
 from tensorflow.python.framework import ops
 from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import math_ops
+from tensorflow.python.ops import gradients as tf_gradients
 from tensorflow.python.training import training
 from tensorflow.python.training.learning_rate_decay import (exponential_decay,
                                                             piecewise_constant,
@@ -19,6 +22,10 @@ from utils import squash_maybe
 
 smooth = 1.
 
+# The collection of the tensors to keep in memory in the backward pass
+# when cfg.grad_recompute is `collection`
+GRAD_CHECKPOINTS = 'grad_checkpoints'
+
 
 def get_optimizer(optimizer):
     try:
@@ -70,13 +77,17 @@ def apply_lr_decay(cfg, global_step):
     return lr
 
 
-def process_gradients(cfg, global_step, prev_err, grads_and_vars):
+def process_gradients(cfg, global_step, prev_err, grads_and_vars,
+                      clip=True):
     """Add noise and multipliers to gradient
 
     Parameters
     ----------
     grads_and_vars: list
         The list of gradients to be modified.
+    clip: bool
+        If False, the gradients are not clipped, e.g., because they
+        will be clipped once accumulated.
     """
     grad_noise_scale = _get_grad_noise_scale(cfg, global_step, prev_err)
 
@@ -94,7 +105,13 @@ def process_gradients(cfg, global_step, prev_err, grads_and_vars):
                 'This is most likely caused by an improper value '
                 'of cfg.gradient_multipliers.')
 
-    # Optionally clip gradients by global norm
+    if clip:
+        grads_and_vars = clip_gradients(cfg, grads_and_vars)
+    return grads_and_vars, grad_noise_scale
+
+
+def clip_gradients(cfg, grads_and_vars):
+    """Optionally clip gradients by global norm"""
     if isinstance(cfg.max_grad_norm, float):
         grads_and_vars = _clip_gradients_by_norm(
             grads_and_vars, cfg.max_grad_norm)
@@ -104,7 +121,7 @@ def process_gradients(cfg, global_step, prev_err, grads_and_vars):
         raise ValueError(
             "Unknown type %s for cfg.max_grad_norm" %
             type(cfg.max_grad_norm))
-    return grads_and_vars, grad_noise_scale
+    return grads_and_vars
 
 
 def compute_and_process_grads(self, loss_out, var_list=None,
@@ -134,13 +151,38 @@ def compute_and_process_grads(self, loss_out, var_list=None,
     if gate_gradients is None:
         gate_gradients = self.optimizer.GATE_OP
 
+    scaled_loss = loss_out['loss']
+    if self.cfg.precision == 'mixed':
+        # Scale the loss to prevent the small gradients from underflowing
+        # in the reduced precision
+        scaled_loss *= self.loss_scale
+
     # This device's gradients
-    grads_and_vars = self.optimizer.compute_gradients(
-        loss_out['loss'], var_list=var_list,
-        gate_gradients=gate_gradients,
-        aggregation_method=aggregation_method,
-        colocate_gradients_with_ops=colocate_gradients_with_ops,
-        grad_loss=grad_loss)
+    if self.cfg.grad_recompute == 'none':
+        grads_and_vars = self.optimizer.compute_gradients(
+            scaled_loss, var_list=var_list,
+            gate_gradients=gate_gradients,
+            aggregation_method=aggregation_method,
+            colocate_gradients_with_ops=colocate_gradients_with_ops,
+            grad_loss=grad_loss)
+    else:
+        # Recompute the activations between some checkpoints rather
+        # than keeping them in memory
+        if var_list is None:
+            var_list = (tf.trainable_variables() + tf.get_collection(
+                tf.GraphKeys.TRAINABLE_RESOURCE_VARIABLES))
+        if self.cfg.grad_recompute == 'collection':
+            checkpoints = tf.get_collection(GRAD_CHECKPOINTS)
+        else:
+            checkpoints = None
+        grads = gradients_with_recomputation(
+            [scaled_loss], var_list, checkpoints,
+            grad_ys=None if grad_loss is None else [grad_loss],
+            aggregation_method=aggregation_method,
+            colocate_gradients_with_ops=colocate_gradients_with_ops)
+        grads_and_vars = list(zip(grads, var_list))
+    if self.cfg.precision == 'mixed':
+        grads_and_vars = unscale_gradients(grads_and_vars, self.loss_scale)
 
     # Check if no gradient
     vars_with_grad = [v for g, v in grads_and_vars if g is not None]
@@ -155,9 +197,11 @@ def compute_and_process_grads(self, loss_out, var_list=None,
     with tf.name_scope(None):
         with tf.name_scope(phase_set_dev + 'grad_processing'):
             # Add noise and multipliers to gradient
+            # With gradient accumulation, the gradients are clipped
+            # once accumulated
             grads_and_vars, grad_noise_scale = process_gradients(
                 self.cfg, self.global_step, self.sym_prev_err,
-                grads_and_vars)
+                grads_and_vars, clip=self.cfg.accum_steps == 1)
 
     # Create some summaries
     add_summaries(grads_and_vars, grad_noise_scale, phase_set_dev,
@@ -166,6 +210,257 @@ def compute_and_process_grads(self, loss_out, var_list=None,
     return grads_and_vars
 
 
+def get_loss_scale(cfg):
+    """Return the loss scale and the number of steps without overflow
+
+    Both are non-trainable variables. The loss scale is constant if
+    `cfg.loss_scale` is positive, otherwise it is updated dynamically
+    by `apply_gradients_with_loss_scale`.
+    """
+    with tf.variable_scope('loss_scale'):
+        loss_scale = tf.get_variable(
+            'loss_scale', [],
+            initializer=tf.constant_initializer(cfg.loss_scale or
+                                                cfg.loss_scale_init),
+            trainable=False, dtype=tf.float32)
+        good_steps = tf.get_variable(
+            'good_steps', [],
+            initializer=tf.constant_initializer(0),
+            trainable=False, dtype=tf.int32)
+    return loss_scale, good_steps
+
+
+def unscale_gradients(grads_and_vars, loss_scale):
+    """Divide the gradients of the scaled loss by the loss scale"""
+    ret = []
+    for g, v in grads_and_vars:
+        if isinstance(g, tf.IndexedSlices):
+            g = tf.IndexedSlices(g.values / loss_scale, g.indices,
+                                 g.dense_shape)
+        elif g is not None:
+            g /= loss_scale
+        ret.append((g, v))
+    return ret
+
+
+def apply_gradients_with_loss_scale(cfg, optimizer, grads_and_vars,
+                                    global_step, loss_scale, good_steps,
+                                    name=None):
+    """Apply the gradients, unless they overflowed
+
+    The update is skipped if any of the gradients is not finite. Since
+    the gradients are checked after they have been processed (noise,
+    clipping) and averaged, an overflow in any of them skips the update
+    as a whole. The global step is incremented in any case, as it counts
+    the minibatches.
+
+    With dynamic loss scaling, the loss scale is halved at each
+    overflow and doubled after `cfg.loss_scale_period` steps without
+    overflow.
+    """
+    grads = [g.values if isinstance(g, tf.IndexedSlices) else g
+             for g, _ in grads_and_vars if g is not None]
+    is_finite = tf.reduce_all([tf.reduce_all(tf.is_finite(g))
+                               for g in grads])
+    apply_op = tf.cond(is_finite,
+                       lambda: optimizer.apply_gradients(grads_and_vars,
+                                                         name=name),
+                       tf.no_op)
+    # As in `Optimizer.apply_gradients`, the counters are updated after
+    # the variables, so that the update sees the step before the
+    # increment, e.g., in the learning rate schedule
+    with tf.control_dependencies([apply_op]):
+        update_ops = [tf.assign_add(global_step, 1)]
+        if not cfg.loss_scale:
+            new_good_steps = tf.where(is_finite, good_steps + 1,
+                                      tf.zeros_like(good_steps))
+            grow = tf.greater_equal(new_good_steps, cfg.loss_scale_period)
+            new_loss_scale = tf.where(
+                is_finite,
+                tf.where(grow, loss_scale * 2, loss_scale),
+                tf.maximum(loss_scale / 2, 1.))
+            update_ops += [
+                tf.assign(loss_scale, new_loss_scale),
+                tf.assign(good_steps, tf.where(grow,
+                                               tf.zeros_like(good_steps),
+                                               new_good_steps))]
+    return tf.group(*update_ops)
+
+
+def _topological_key(graph):
+    """Return a key that sorts tensors in the order of creation of their ops
+
+    The ops of `graph` are numbered in the order of
+    `graph.get_operations()`, i.e., the order they were created in.
+    """
+    order = {op: i for i, op in enumerate(graph.get_operations())}
+    return lambda t: order[t.op]
+
+
+def _add_grads(g1, g2):
+    """Sum two gradients, either of which can be None or IndexedSlices"""
+    if g1 is None:
+        return g2
+    if g2 is None:
+        return g1
+    if isinstance(g1, tf.IndexedSlices) and isinstance(g2, tf.IndexedSlices):
+        return tf.IndexedSlices(tf.concat([g1.values, g2.values], 0),
+                                tf.concat([g1.indices, g2.indices], 0),
+                                g1.dense_shape)
+    return tf.convert_to_tensor(g1) + tf.convert_to_tensor(g2)
+
+
+def _auto_grad_checkpoints(fwd_ops, key):
+    """Choose the tensors to keep in memory in the backward pass
+
+    Keep the outputs of about sqrt(N) of the N convolutions and matrix
+    multiplications of the forward pass, evenly spaced, so that each of
+    the sqrt(N) recomputed segments costs about sqrt(N) of them. `key`
+    sorts the tensors in the order of the forward pass (see
+    `_topological_key`).
+    """
+    candidates = sorted([op.outputs[0] for op in fwd_ops
+                         if op.type in ('Conv2D', 'Conv3D', 'MatMul',
+                                        'DepthwiseConv2dNative')],
+                        key=key)
+    if len(candidates) < 2:
+        return []
+    step = int(math.ceil(math.sqrt(len(candidates))))
+    return candidates[step - 1::step]
+
+
+def gradients_with_recomputation(ys, xs, checkpoints=None, grad_ys=None,
+                                 **kwargs):
+    """Compute the gradients recomputing the forward pass in segments
+
+    Only the `checkpoints` tensors of the forward pass are kept in
+    memory for the backward pass. The forward pass is split in segments
+    at the checkpoints and, starting from the last one, each segment is
+    recomputed from its checkpoints right before the gradient flows
+    through it. This trades about one extra forward pass for the memory
+    of the activations within the segments (see "Training Deep Nets
+    with Sublinear Memory Cost", https://arxiv.org/abs/1604.06174).
+
+    The stateful ops (e.g., the random ops of the dropout) are not
+    recomputed, so that the recomputed segments are identical to the
+    original ones.
+
+    Parameters
+    ----------
+    ys: list
+        The tensors to be differentiated.
+    xs: list
+        The tensors or variables to differentiate with respect to.
+    checkpoints: list
+        The tensors to keep in memory. If None, they are chosen
+        automatically (see `_auto_grad_checkpoints`).
+    grad_ys: list
+        Optional. The initial gradients of ys.
+    kwargs: dict
+        The extra arguments of `tf.gradients`.
+
+    Returns
+    -------
+    A list with the gradient of ys with respect to each of the xs.
+    """
+    from tensorflow.contrib import graph_editor as ge
+
+    # The forward ops between the xs and the ys
+    xs_ops = [x.op for x in xs]
+    bwd_ops = ge.get_backward_walk_ops([y.op for y in ys], inclusive=True)
+    fwd_ops = ge.get_forward_walk_ops(xs_ops, inclusive=True,
+                                      within_ops=bwd_ops)
+    # Exclude the variables and the ops that read them
+    fwd_ops = [op for op in fwd_ops if op not in xs_ops and not (
+        op.type in ('Identity', 'ReadVariableOp') and
+        op.inputs[0].op in xs_ops)]
+    fwd_ts = set(ge.filter_ts(fwd_ops, True))
+    key = _topological_key(ys[0].graph)
+    if checkpoints is None:
+        checkpoints = _auto_grad_checkpoints(fwd_ops, key)
+    checkpoints = sorted(set(checkpoints) & fwd_ts, key=key)
+    if not checkpoints:
+        return tf_gradients.gradients(ys, xs, grad_ys=grad_ys, **kwargs)
+
+    # Do not recompute the stateful ops
+    stateful_ts = [t for op in fwd_ops if op.op_def.is_stateful
+                   for t in op.outputs]
+
+    def copy_segment(seed_ops, stop_at_ts, control_inputs):
+        """Copy the ops between stop_at_ts and seed_ops
+
+        The copies of the stop_at_ts tensors are fed with the original
+        tensors through a stop_gradient, so that the gradient does not
+        flow past them. The copies are run after `control_inputs`.
+        Return a dict from the original to the copied ops and the
+        stop_gradient tensors."""
+        ops = set(ge.get_backward_walk_ops(
+            seed_ops, inclusive=True, stop_at_ts=stop_at_ts +
+            stateful_ts)) & set(fwd_ops)
+        ops = ops - set(t.op for t in stop_at_ts + stateful_ts)
+        if not ops:
+            return {}, {}
+        # The copies keep the device of the original ops, which is
+        # part of the NodeDef that graph_editor copies
+        _, info = ge.copy_with_input_replacements(ge.sgv(list(ops)), {})
+        copied = {op: info.transformed(op) for op in ops}
+        for op in copied.values():
+            # Do not recompute the segment until its gradient is needed
+            ge.add_control_inputs(op, [c for c in control_inputs
+                                       if c not in op.control_inputs])
+        stopped = {t: tf.stop_gradient(t) for t in stop_at_ts}
+        ge.reroute_ts(list(stopped.values()), list(stopped.keys()),
+                      can_modify=list(copied.values()))
+        return copied, stopped
+
+    # The last segment, from the last checkpoints to the ys. It is
+    # recomputed once the forward pass is over, i.e., after the ys and
+    # their initial gradients, otherwise it could be scheduled during
+    # the forward pass and keep its activations alive
+    last_control_inputs = [y.op for y in ys]
+    if grad_ys is not None:
+        last_control_inputs += [_grad_op(g) for g in grad_ys
+                                if g is not None]
+    copied, stopped = copy_segment([y.op for y in ys], checkpoints,
+                                   last_control_inputs)
+    copied_ys = [copied[y.op].outputs[y.value_index] if y.op in copied
+                 else y for y in ys]
+    boundary = [stopped.get(c, c) for c in checkpoints]
+    grads = tf_gradients.gradients(copied_ys, boundary + list(xs),
+                                   grad_ys=grad_ys, **kwargs)
+    d_checkpoints = dict(zip(checkpoints, grads[:len(checkpoints)]))
+    d_xs = grads[len(checkpoints):]
+
+    # The other segments, backwards, from each checkpoint to the
+    # previous ones
+    for i in range(len(checkpoints) - 1, -1, -1):
+        c = checkpoints[i]
+        if d_checkpoints[c] is None:
+            continue
+        others = checkpoints[:i]
+        copied, stopped = copy_segment(
+            [c.op], others,
+            control_inputs=[_grad_op(d_checkpoints[c])])
+        if c.op not in copied:
+            continue
+        boundary = [stopped.get(o, o) for o in others]
+        grads = tf_gradients.gradients(
+            [copied[c.op].outputs[c.value_index]], boundary + list(xs),
+            grad_ys=[d_checkpoints[c]], **kwargs)
+        for o, d_o in zip(others, grads[:len(others)]):
+            d_checkpoints[o] = _add_grads(d_checkpoints[o], d_o)
+        d_xs = [_add_grads(d_x, d) for d_x, d in
+                zip(d_xs, grads[len(others):])]
+    return d_xs
+
+
+def _grad_op(grad):
+    """Return the op that computes a (possibly sparse) gradient"""
+    if isinstance(grad, tf.IndexedSlices):
+        return grad.values.op
+    return grad.op
+
+
 def _get_grad_noise_scale(cfg, global_step, prev_err):
     if cfg.grad_noise_decay is None:
         grad_noise_scale = cfg.grad_noise_scale
@@ -240,7 +535,68 @@ def add_summaries(grads_and_vars, grad_noise_scale, phase_set_dev,
                                          summaries)
 
 
-def average_gradients(grad_dict, phase_set_dev, up_to_dev=None):
+def get_grad_accumulators(var_list):
+    """Return a buffer per variable to accumulate its gradients
+
+    The buffers are non-trainable zero-initialized local variables,
+    colocated with their variable. They are not saved in the
+    checkpoints, so that the checkpoints do not depend on
+    `cfg.accum_steps`: an accumulation in progress is lost on restart.
+    """
+    accumulators = {}
+    with tf.name_scope('grad_accumulators'):
+        for v in var_list:
+            with tf.colocate_with(v):
+                accumulators[v] = tf.Variable(
+                    tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype),
+                    trainable=False,
+                    name=v.op.name.replace('/', '_') + '_accum',
+                    collections=[tf.GraphKeys.LOCAL_VARIABLES])
+    return accumulators
+
+
+def accumulate_gradients(grads_and_vars, accumulators, accum_steps):
+    """Add the gradients to their accumulators
+
+    Parameters
+    ----------
+    grads_and_vars: list
+        The list of (gradient, variable) tuples of one micro-batch.
+    accumulators: dict
+        The buffer of each variable, see `get_grad_accumulators`.
+    accum_steps: int
+        The number of micro-batches the gradients are accumulated over.
+
+    Returns
+    -------
+    accum_op: Op
+        The op that adds the gradients to the accumulators.
+    acc_grads_and_vars: list
+        The list of (gradient, variable) tuples with the accumulated
+        gradients averaged over the micro-batches, after the gradients
+        of this micro-batch have been added.
+    """
+    accum_ops = []
+    acc_grads_and_vars = []
+    for g, v in grads_and_vars:
+        if g is None:
+            acc_grads_and_vars.append((g, v))
+            continue
+        acc = accumulators[v]
+        with tf.colocate_with(acc):
+            if isinstance(g, tf.IndexedSlices):
+                acc_op = tf.scatter_add(acc, g.indices, g.values)
+            else:
+                acc_op = tf.assign_add(acc, g)
+            accum_ops.append(acc_op)
+        acc_grads_and_vars.append((acc_op / accum_steps, v))
+    return tf.group(*accum_ops), acc_grads_and_vars
+
+
+def average_gradients(grad_dict, phase_set_dev, up_to_dev=None,
+                      sym_num_devs=None, bucket_size=0,
+                      reduce_strategy='central', devices=None,
+                      group_size=0):
     """Calculate the mean gradient for the devices processed so far
 
     Note
@@ -256,15 +612,57 @@ def average_gradients(grad_dict, phase_set_dev, up_to_dev=None):
         A name scope
     up_to_dev: int
         Up to which device to compute the average on
+    sym_num_devs: Tensor or Placeholder (optional)
+        The number of devices to compute the average on, selected at
+        run-time. The gradients of the other devices are masked out, so
+        that one single op can be used whatever the number of devices in
+        use, rather than one op per number of devices.
+    bucket_size: int (optional)
+        If positive, the dense gradients are flattened and concatenated
+        in buckets of at most `bucket_size` bytes that are averaged with
+        one op each, and the sparse gradients are averaged as
+        `IndexedSlices` rather than being converted to dense tensors.
+        See `fused_average_gradients`.
+    reduce_strategy: string (optional)
+        How to sum the gradients of the devices. If `central` they are
+        all transferred and summed on the current device (usually the
+        CPU), if `ring` they are summed with a ring all-reduce across
+        `devices` (see `ring_all_reduce`), if `hierarchical` they are
+        first summed within groups of devices and then with a ring
+        all-reduce across groups (see `hierarchical_all_reduce`).
+    devices: list of strings (optional)
+        The device of each tower. Required by the `ring` and
+        `hierarchical` strategies.
+    group_size: int (optional)
+        The number of devices per group for the `hierarchical`
+        strategy. Defaults to the square root of the number of devices.
 
     Return
     ------
     List of pairs of (gradient, variable) where the gradient has been
     averaged across all towers.
     """
+    if reduce_strategy not in ('central', 'ring', 'hierarchical'):
+        raise ValueError('Unknown reduce_strategy: %s' % reduce_strategy)
+    if reduce_strategy != 'central' and devices is None:
+        raise ValueError('The %s reduce_strategy requires the list of '
+                         'devices' % reduce_strategy)
+    reduce_kwargs = {'reduce_strategy': reduce_strategy,
+                     'devices': devices,
+                     'group_size': group_size}
+
     average_grads = []
     with tf.name_scope(None):
         with tf.name_scope(phase_set_dev + 'grad_avg'):
+            dev_mask = None
+            if sym_num_devs is not None:
+                num_devs = len(next(grad_dict.itervalues()))
+                dev_mask = tf.less(tf.range(num_devs), sym_num_devs,
+                                   name='dev_mask')
+            if bucket_size > 0:
+                return fused_average_gradients(grad_dict, bucket_size,
+                                               up_to_dev, sym_num_devs,
+                                               dev_mask, **reduce_kwargs)
             for v, grads_list in grad_dict.iteritems():
                 if isinstance(v, tf.Variable):
                     name = '' + v.name.replace('/', '_').replace(':', '_')
@@ -275,12 +673,280 @@ def average_gradients(grad_dict, phase_set_dev, up_to_dev=None):
                     rname = 'grad_avg'
                 if up_to_dev is not None:
                     grads_list = grads_list[:up_to_dev + 1]
-                grad_list = tf.stack(axis=0, values=grads_list, name=sname)
-                avg_grad = tf.reduce_mean(grad_list, 0, name=rname)
+                avg_grad = _average_dev_grads(grads_list, sname, rname,
+                                              sym_num_devs, dev_mask,
+                                              **reduce_kwargs)
                 average_grads.append((avg_grad, v))
     return average_grads
 
 
+def _average_dev_grads(grads_list, sname, rname, sym_num_devs, dev_mask,
+                       reduce_strategy='central', devices=None,
+                       group_size=0):
+    """Average a list of per-device gradients"""
+    grads_list = [tf.convert_to_tensor(g) for g in grads_list]
+    # The all-reduce strategies split the gradients in chunks, which
+    # requires their size to be known
+    if (reduce_strategy == 'central' or
+            not grads_list[0].get_shape().is_fully_defined()):
+        grad_list = tf.stack(axis=0, values=grads_list, name=sname)
+        if dev_mask is None:
+            return tf.reduce_mean(grad_list, 0, name=rname)
+        # Select rather than multiply by the mask, not to propagate NaNs
+        # from the devices not in use
+        grad_list = tf.where(dev_mask, grad_list, tf.zeros_like(grad_list))
+        return tf.div(tf.reduce_sum(grad_list, 0),
+                      tf.cast(sym_num_devs, grad_list.dtype), name=rname)
+
+    devices = devices[:len(grads_list)]
+    if dev_mask is not None:
+        masked_grads = []
+        for dev_id, (g, dev) in enumerate(zip(grads_list, devices)):
+            with tf.device(dev):
+                masked_grads.append(tf.where(dev_mask[dev_id], g,
+                                             tf.zeros_like(g)))
+        grads_list = masked_grads
+    if reduce_strategy == 'ring':
+        summed = ring_all_reduce(grads_list, devices)
+    else:
+        summed = hierarchical_all_reduce(grads_list, devices, group_size)
+    # Every device holds the sum: use the copy of the first one, where
+    # the variables are
+    num_devs = (len(grads_list) if sym_num_devs is None else
+                tf.cast(sym_num_devs, summed[0].dtype))
+    return tf.div(summed[0], num_devs, name=rname)
+
+
+def ring_all_reduce(tensors, devices):
+    """Sum tensors placed on different devices with a ring all-reduce
+
+    Each tensor is split in as many chunks as the devices. In the first
+    `n-1` steps (reduce-scatter), each device adds the chunk it receives
+    from the previous device in the ring to its own and sends the result
+    to the next device, so that at the end each device holds one chunk
+    of the sum. In the next `n-1` steps (all-gather) the summed chunks
+    are passed around the ring, so that each device holds the full sum.
+    Each device sends and receives `2(n-1)/n` times the size of the
+    tensor, independently of the number of devices, rather than
+    concentrating all the transfers and computation on one device.
+
+    Parameters
+    ----------
+    tensors: list of Tensors
+        One tensor per device, with the same fully defined shape.
+    devices: list of strings
+        The device of each tensor.
+
+    Return
+    ------
+    A list with the sum of the tensors on each of the devices.
+    """
+    n = len(tensors)
+    if n == 1:
+        return list(tensors)
+    shape = tensors[0].get_shape()
+    num_elements = shape.num_elements()
+    sizes = [num_elements // n + (1 if i < num_elements % n else 0)
+             for i in range(n)]
+    with tf.name_scope('ring_all_reduce'):
+        chunks = []
+        for t, dev in zip(tensors, devices):
+            with tf.device(dev):
+                chunks.append(tf.split(tf.reshape(t, [-1]), sizes))
+
+        # Reduce-scatter: at step s, device i sends chunk (i - s) to
+        # device i + 1
+        for step in range(n - 1):
+            new_chunks = [list(c) for c in chunks]
+            for i in range(n):
+                j, c = (i + 1) % n, (i - step) % n
+                with tf.device(devices[j]):
+                    new_chunks[j][c] = chunks[j][c] + chunks[i][c]
+            chunks = new_chunks
+
+        # All-gather: device i now holds the sum of chunk i + 1. At step
+        # s it sends chunk (i + 1 - s) to device i + 1
+        for step in range(n - 1):
+            new_chunks = [list(c) for c in chunks]
+            for i in range(n):
+                j, c = (i + 1) % n, (i + 1 - step) % n
+                with tf.device(devices[j]):
+                    new_chunks[j][c] = tf.identity(chunks[i][c])
+            chunks = new_chunks
+
+        summed = []
+        for dev, dev_chunks in zip(devices, chunks):
+            with tf.device(dev):
+                summed.append(tf.reshape(tf.concat(dev_chunks, axis=0),
+                                         shape))
+    return summed
+
+
+def hierarchical_all_reduce(tensors, devices, group_size=0):
+    """Sum tensors placed on different devices in two levels
+
+    The devices are split in consecutive groups of `group_size` devices.
+    The tensors of each group are first summed on the first device of
+    the group, the partial sums are then summed with a ring all-reduce
+    across the groups and finally copied to the other devices of each
+    group. This keeps most of the transfers within each group (e.g.,
+    the GPUs connected to the same switch).
+
+    Parameters
+    ----------
+    tensors: list of Tensors
+        One tensor per device, with the same fully defined shape.
+    devices: list of strings
+        The device of each tensor.
+    group_size: int
+        The number of devices per group. Defaults to the square root of
+        the number of devices.
+
+    Return
+    ------
+    A list with the sum of the tensors on each of the devices.
+    """
+    n = len(tensors)
+    if not group_size:
+        group_size = max(1, int(round(n ** 0.5)))
+    groups = [range(i, min(i + group_size, n))
+              for i in range(0, n, group_size)]
+    with tf.name_scope('hierarchical_all_reduce'):
+        partial_sums = []
+        leaders = []
+        for group in groups:
+            leaders.append(devices[group[0]])
+            with tf.device(leaders[-1]):
+                partial_sums.append(tf.add_n([tensors[i] for i in group]))
+        group_sums = ring_all_reduce(partial_sums, leaders)
+        summed = []
+        for group, group_sum in zip(groups, group_sums):
+            for i in group:
+                with tf.device(devices[i]):
+                    summed.append(tf.identity(group_sum))
+    return summed
+
+
+def _average_indexed_slices(grads_list, sym_num_devs, dev_mask):
+    """Average per-device IndexedSlices without converting them to dense
+
+    The indices and the values of all the devices are concatenated and
+    the values scaled, so that the optimizer's sparse update sums the
+    contributions of the devices to the same rows."""
+    values = []
+    for dev_id, g in enumerate(grads_list):
+        dev_values = g.values
+        if dev_mask is not None:
+            rows_mask = tf.fill(tf.shape(dev_values)[:1], dev_mask[dev_id])
+            dev_values = tf.where(rows_mask, dev_values,
+                                  tf.zeros_like(dev_values))
+        values.append(dev_values)
+    values = tf.concat(values, axis=0, name='sparse_grad_values')
+    if sym_num_devs is None:
+        values /= len(grads_list)
+    else:
+        values /= tf.cast(sym_num_devs, values.dtype)
+    indices = tf.concat([g.indices for g in grads_list], axis=0,
+                        name='sparse_grad_indices')
+    return tf.IndexedSlices(values, indices, grads_list[0].dense_shape)
+
+
+def fused_average_gradients(grad_dict, bucket_size, up_to_dev=None,
+                            sym_num_devs=None, dev_mask=None,
+                            reduce_strategy='central', devices=None,
+                            group_size=0):
+    """Average the gradients in size-bounded buckets
+
+    Rather than stacking and averaging the gradients of each variable
+    separately, the dense gradients of each device are flattened and
+    concatenated (on the device itself) in buckets of at most
+    `bucket_size` bytes, averaged with one op per bucket and split back.
+    This reduces the number of ops to be scheduled and of tensors to be
+    transferred to one per bucket and device. Gradients whose shape is
+    not fully defined are averaged separately.
+
+    Sparse gradients are averaged as `IndexedSlices`, to avoid
+    converting embedding-sized gradients to dense tensors.
+
+    Parameters
+    ----------
+    grad_dict: Dict of lists of gradients (per device).
+        A dictionary with variables as keys and a list of gradients per
+        device as values.
+    bucket_size: int
+        The maximum size of a bucket, in bytes. Gradients bigger than
+        this have a bucket on their own.
+    up_to_dev: int
+        Up to which device to compute the average on
+    sym_num_devs: Tensor or Placeholder (optional)
+        The number of devices to compute the average on, selected at
+        run-time.
+    dev_mask: Tensor (optional)
+        A boolean vector, True for the devices in use. Required if
+        `sym_num_devs` is provided.
+    reduce_strategy, devices, group_size:
+        How to sum the buckets across devices. See `average_gradients`.
+
+    Return
+    ------
+    List of pairs of (gradient, variable) where the gradient has been
+    averaged across all towers.
+    """
+    reduce_kwargs = {'reduce_strategy': reduce_strategy,
+                     'devices': devices,
+                     'group_size': group_size}
+    average_grads = []
+    buckets = []
+    open_buckets = {}  # The bucket being filled, for each dtype
+    for v in sorted(grad_dict.keys(), key=lambda v: getattr(v, 'name', v)):
+        grads_list = grad_dict[v]
+        if up_to_dev is not None:
+            grads_list = grads_list[:up_to_dev + 1]
+        if all(isinstance(g, tf.IndexedSlices) for g in grads_list):
+            average_grads.append((_average_indexed_slices(
+                grads_list, sym_num_devs, dev_mask), v))
+            continue
+        grads_list = [tf.convert_to_tensor(g) for g in grads_list]
+        shape = grads_list[0].get_shape()
+        if not shape.is_fully_defined():
+            avg_grad = _average_dev_grads(grads_list, 'pre_grad_avg_stack',
+                                          'grad_avg', sym_num_devs, dev_mask,
+                                          **reduce_kwargs)
+            average_grads.append((avg_grad, v))
+            continue
+        dtype = grads_list[0].dtype.base_dtype
+        nbytes = shape.num_elements() * dtype.size
+        bucket = open_buckets.get(dtype)
+        if bucket is None or (bucket['vars'] and
+                              bucket['nbytes'] + nbytes > bucket_size):
+            bucket = {'nbytes': 0, 'vars': [], 'grads': []}
+            open_buckets[dtype] = bucket
+            buckets.append(bucket)
+        bucket['nbytes'] += nbytes
+        bucket['vars'].append(v)
+        bucket['grads'].append(grads_list)
+
+    for bucket_id, bucket in enumerate(buckets):
+        with tf.name_scope('bucket%d' % bucket_id):
+            # Flatten and concatenate the gradients of each device on the
+            # device itself, so that one single tensor is transferred
+            flat_grads = []
+            for dev_grads in zip(*bucket['grads']):
+                with tf.device(dev_grads[0].device):
+                    flat_grads.append(tf.concat(
+                        [tf.reshape(g, [-1]) for g in dev_grads], axis=0))
+            avg_flat = _average_dev_grads(flat_grads, 'pre_grad_avg_stack',
+                                          'grad_avg', sym_num_devs, dev_mask,
+                                          **reduce_kwargs)
+            sizes = [g[0].get_shape().num_elements() for g in bucket['grads']]
+            for v, grads_list, avg_grad in zip(bucket['vars'],
+                                               bucket['grads'],
+                                               tf.split(avg_flat, sizes)):
+                average_grads.append(
+                    (tf.reshape(avg_grad, grads_list[0].get_shape()), v))
+    return average_grads
+
+
 def average_list_gradients(tower_grads):
     """Calculate the mean gradient for each shared variable across all towers.
 
@@ -433,5 +1099,79 @@ def mean_iou(labels,
         return mean_iou_v, iou, update_op, reset_cm_op
 
 
+def streaming_segmentation_metrics(labels, predictions, loss, num_batches,
+                                   num_classes, void_labels=(), name=None):
+    """Accumulate the segmentation metrics over a stream of minibatches
+
+    The confusion matrix of `mean_iou`, the loss and the accuracy are
+    accumulated in local variables by `update_op`, and zeroed by
+    `reset_op`. The void labels are ignored. Only the tensors in
+    `values` have to be fetched once the stream is over, so that
+    neither the predictions nor the labels are copied to the host.
+
+    Parameters
+    ----------
+        labels: Tensor
+            The ground truth labels. Flattened if its rank is > 1.
+        predictions: Tensor
+            The predicted labels, with as many elements as `labels`.
+        loss: Tensor
+            The mean loss of the minibatch.
+        num_batches: Tensor
+            The number of samples of the minibatch, used to weight the
+            loss.
+        num_classes: int
+            The number of classes, void included.
+        void_labels: list of ints
+            The labels to ignore.
+
+    Returns
+    -------
+        metrics: dict
+            A dictionary with the `update_op` and the `reset_op`, and a
+            dictionary of `values`: the `mean_iou` and the
+            `per_class_iou` of the non-void classes, the pixel
+            `accuracy` and the mean `loss`.
+    """
+    num_classes = max([num_classes] + [v + 1 for v in void_labels])
+    non_void = [c for c in range(num_classes) if c not in void_labels]
+    with tf.variable_scope(name, 'streaming_metrics',
+                           (labels, predictions, loss)):
+        labels = tf.reshape(tf.cast(labels, tf.int32), [-1])
+        predictions = tf.reshape(tf.cast(predictions, tf.int32), [-1])
+        mask = tf.ones_like(labels, dtype=tf.bool)
+        for v in void_labels:
+            mask = tf.logical_and(mask, tf.not_equal(labels, v))
+        weights = tf.cast(mask, tf.float32)
+        labels *= tf.cast(mask, tf.int32)  # void_class --> 0, weight 0
+
+        _, iou, update_cm_op, reset_cm_op = mean_iou(
+            labels, predictions, num_classes, weights)
+        iou = tf.gather(iou, non_void)
+
+        accumulators = [
+            tf.Variable(0., trainable=False, name=n,
+                        collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            for n in ['loss_sum', 'count', 'correct', 'total']]
+        loss_sum, count, correct, total = accumulators
+        num_batches = tf.cast(num_batches, tf.float32)
+        correct_pixels = tf.cast(tf.equal(labels, predictions), tf.float32)
+        update_op = tf.group(
+            update_cm_op,
+            tf.assign_add(loss_sum, tf.cast(loss, tf.float32) * num_batches),
+            tf.assign_add(count, num_batches),
+            tf.assign_add(correct, tf.reduce_sum(weights * correct_pixels)),
+            tf.assign_add(total, tf.reduce_sum(weights)),
+            name='update_op')
+        reset_op = tf.group(reset_cm_op,
+                            *[tf.assign(acc, 0.) for acc in accumulators],
+                            name='reset_op')
+        values = {'mean_iou': tf.reduce_mean(iou),
+                  'per_class_iou': iou,
+                  'accuracy': correct / tf.maximum(total, 1.),
+                  'loss': loss_sum / tf.maximum(count, 1.)}
+    return {'update_op': update_op, 'reset_op': reset_op, 'values': values}
+
+
 def dice_coef_loss(labels, logits, class_dice=1):
     return -dice_coef(labels, logits, class_dice)
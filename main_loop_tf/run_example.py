@@ -12,6 +12,7 @@ try:
     from itertools import izip_longest as zip_longest
 except:
     from itertools import zip_longest
+import sys
 
 from main_loop_tf import Experiment
 from main_loop_tf.utils import split_in_chunks
@@ -19,6 +20,19 @@ import tensorflow as tf
 from tensorflow.contrib import slim
 
 
+def _import_pyplot():
+    """Import matplotlib and pyplot, with a backend that needs no X server
+
+    The backend is only chosen here, when something is actually
+    plotted, so that importing main_loop_tf does not change it.
+    """
+    import matplotlib
+    if 'matplotlib.pyplot' not in sys.modules:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return matplotlib, plt
+
+
 class ExampleExperiment(Experiment):
     """An example implementation of the Experiment abstract class"""
 
@@ -28,9 +42,7 @@ class ExampleExperiment(Experiment):
         This method defines the sequence of transformations that compute
         the output of the network given its input.
         """
-        import gflags
-
-        cfg = gflags.cfg
+        cfg = self.cfg
         ret = {}
         conv = slim.conv2d(inputs['data'],
                            num_outputs=64,
@@ -114,6 +126,9 @@ class ExampleExperiment(Experiment):
                 return_list=False,
                 **self.cfg.dataset_params)
             minibatch = dataset.next()
+        # Convert the minibatch to the types of the placeholders (see
+        # `cfg.input_dtype`)
+        minibatch = self.compact_minibatch(minibatch)
         x_batch = minibatch['data']
 
         # Is this batch shorter than batch_size?
@@ -158,8 +173,7 @@ class ExampleExperiment(Experiment):
 
         # Save one sample on disk
         fetch_dict = self.unhookedsess.run(val_dict, feed_dict=feed_dict)
-        import matplotlib as mpl
-        import matplotlib.pyplot as plt
+        mpl, plt = _import_pyplot()
         cmap = mpl.colors.ListedColormap(dataset.cmap)
         fname = '/home/francesco/exp/main_loop_tf/main_loop_tf/checkpoints/'
         fname += 'camvid'
@@ -173,8 +187,7 @@ class ExampleExperiment(Experiment):
         self._t_data_load = 0
         # Overfit on one image!
         if not hasattr(self, '_minibatch'):
-            import matplotlib as mpl
-            import matplotlib.pyplot as plt
+            mpl, plt = _import_pyplot()
             self._minibatch = self.train.next()
             self._t_data_load = 10
             cmap = mpl.colors.ListedColormap(self.train.cmap)
@@ -186,8 +199,6 @@ class ExampleExperiment(Experiment):
 
 
 if __name__ == '__main__':
-    import sys
-
     # You can also add fixed values like this
     argv = sys.argv
     argv += ['--dataset', 'camvid']
@@ -0,0 +1,47 @@
+import numpy as np
+import tensorflow as tf
+
+from optimization import accumulate_gradients, get_grad_accumulators
+
+accum_steps = 3
+
+with tf.Session().as_default() as sess:
+    v_dense = tf.Variable(np.zeros((2, 2), 'float32'), name='dense')
+    v_sparse = tf.Variable(np.zeros((4, 2), 'float32'), name='sparse')
+    g_dense = tf.placeholder(tf.float32, [2, 2], name='g_dense')
+    g_values = tf.placeholder(tf.float32, [None, 2], name='g_values')
+    g_indices = tf.placeholder(tf.int32, [None], name='g_indices')
+    g_sparse = tf.IndexedSlices(g_values, g_indices, [4, 2])
+
+    accumulators = get_grad_accumulators([v_dense, v_sparse])
+    accum_op, acc_grads_and_vars = accumulate_gradients(
+        [(g_dense, v_dense), (g_sparse, v_sparse), (None, v_dense)],
+        accumulators, accum_steps)
+    assert acc_grads_and_vars[2] == (None, v_dense)
+    acc_grads = [g for g, _ in acc_grads_and_vars[:2]]
+    # The accumulators are not saved in the checkpoints
+    assert not {a.op.name for a in accumulators.values()}.intersection(
+        v.op.name for v in tf.global_variables())
+    sess.run(tf.global_variables_initializer())
+    sess.run(tf.local_variables_initializer())
+
+    dense = [np.random.rand(2, 2).astype('float32')
+             for _ in range(accum_steps)]
+    sparse = [(np.random.rand(2, 2).astype('float32'), [i, 3])
+              for i in range(accum_steps)]
+    for i in range(accum_steps):
+        feed_dict = {g_dense: dense[i], g_values: sparse[i][0],
+                     g_indices: sparse[i][1]}
+        if i < accum_steps - 1:
+            sess.run(accum_op, feed_dict)
+        else:
+            # The last micro-batch is accumulated before averaging
+            out_dense, out_sparse = sess.run(acc_grads, feed_dict)
+
+    expected_sparse = np.zeros((4, 2), 'float32')
+    for values, indices in sparse:
+        np.add.at(expected_sparse, indices, values)
+    print(out_dense, out_sparse)
+    assert np.allclose(out_dense, sum(dense) / accum_steps)
+    assert np.allclose(out_sparse, expected_sparse / accum_steps)
+print('The gradients are correctly accumulated')
@@ -0,0 +1,46 @@
+import numpy as np
+import tensorflow as tf
+
+from main_loop_tf.optimization import (average_gradients,
+                                       hierarchical_all_reduce,
+                                       ring_all_reduce)
+
+num_devs = 4
+devices = ['/cpu:%d' % i for i in range(num_devs)]
+config = tf.ConfigProto(device_count={'CPU': num_devs})
+
+with tf.Session(config=config).as_default() as sess:
+    values = [np.random.rand(3, 5).astype('float32') for _ in devices]
+    tensors = []
+    for v, dev in zip(values, devices):
+        with tf.device(dev):
+            tensors.append(tf.constant(v))
+    expected = np.sum(values, axis=0)
+
+    # Each device should hold the sum
+    for name, summed in [('ring', ring_all_reduce(tensors, devices)),
+                         ('hierarchical',
+                          hierarchical_all_reduce(tensors, devices)),
+                         ('hierarchical (3)',
+                          hierarchical_all_reduce(tensors, devices, 3))]:
+        for dev_sum in sess.run(summed):
+            assert np.allclose(dev_sum, expected), name
+        print('%s all-reduce matches the sum' % name)
+
+    # Less elements than devices
+    small = [tf.constant([float(i), 1.]) for i in range(num_devs)]
+    for dev_sum in sess.run(ring_all_reduce(small, devices)):
+        assert np.allclose(dev_sum, [sum(range(num_devs)), num_devs])
+
+    # The averages should not depend on the strategy
+    sym_num_devs = tf.placeholder(tf.int32)
+    grad_dict = {'v': tensors}
+    for strategy in ['central', 'ring', 'hierarchical']:
+        for n in range(1, num_devs + 1):
+            avg = average_gradients(grad_dict, strategy,
+                                    sym_num_devs=sym_num_devs,
+                                    reduce_strategy=strategy,
+                                    devices=devices)[0][0]
+            avg = sess.run(avg, {sym_num_devs: n})
+            assert np.allclose(avg, np.mean(values[:n], axis=0)), strategy
+        print('%s average matches the mean' % strategy)
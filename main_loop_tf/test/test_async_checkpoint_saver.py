@@ -0,0 +1,192 @@
+from argparse import Namespace
+from contextlib import contextmanager
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import tensorflow as tf
+
+from hooks import AsyncCheckpointSaverHook, EarlyStopHook
+
+
+class FakeSummaryWriter(object):
+    def add_summary(self, summary, global_step):
+        pass
+
+
+with tf.Graph().as_default():
+    global_step = tf.Variable(0, trainable=False, name='global_step')
+    tf.Variable([1., 2.], name='w')
+    exp = Namespace(global_step=global_step,
+                    summary_writer=FakeSummaryWriter())
+    # The checkpoints cannot be written in a missing directory
+    missing_dir = os.path.join(tempfile.mkdtemp(), 'missing')
+    hook = AsyncCheckpointSaverHook(exp, missing_dir, save_steps=1,
+                                    writer_timeout=10)
+    hook.begin()
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        hook.save(sess, 0)
+        # The writer thread survives the error and reports it
+        for _ in range(100):
+            if hook._error is not None:
+                break
+            time.sleep(0.1)
+        assert hook._thread.is_alive()
+        try:
+            hook.save(sess, 1)
+        except Exception:
+            pass
+        else:
+            raise AssertionError('The writer error was not raised')
+        shutil.rmtree(os.path.dirname(missing_dir))
+print('The writer errors are reported')
+
+
+# The pinned checkpoints are kept until unpinned
+save_path = tempfile.mkdtemp()
+try:
+    with tf.Graph().as_default():
+        global_step = tf.Variable(0, trainable=False, name='global_step')
+        tf.Variable([1., 2.], name='w')
+        exp = Namespace(global_step=global_step,
+                        summary_writer=FakeSummaryWriter())
+        hook = AsyncCheckpointSaverHook(exp, save_path, save_steps=10,
+                                        max_to_keep=1, writer_timeout=10)
+        hook.begin()
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            hook.pin(sess, 0)
+            sess.run(tf.assign(global_step, 1))
+            hook.save(sess, 1)
+            hook.end(sess)
+        path = hook.checkpoint_path(0)
+        assert tf.train.get_checkpoint_state(
+            save_path).model_checkpoint_path == hook.checkpoint_path(1)
+        assert os.path.exists(path + '.index')
+        hook.unpin(0)
+        assert not tf.gfile.Glob(path + '.*')
+        # The missing checkpoints are not saved from another session
+        try:
+            hook.when_saved(0, lambda path: None)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('The missing checkpoint was not reported')
+finally:
+    shutil.rmtree(save_path)
+print('The pinned checkpoints are kept')
+
+
+# The pending snapshots are replaced rather than waited for
+save_path = tempfile.mkdtemp()
+try:
+    with tf.Graph().as_default():
+        global_step = tf.Variable(0, trainable=False, name='global_step')
+        tf.Variable([1., 2.], name='w')
+        exp = Namespace(global_step=global_step,
+                        summary_writer=FakeSummaryWriter())
+        hook = AsyncCheckpointSaverHook(exp, save_path, save_steps=10,
+                                        writer_timeout=10)
+        hook.begin()
+        writing, release = threading.Event(), threading.Event()
+        write = hook._write
+
+        def slow_write(*args, **kwargs):
+            writing.set()
+            release.wait(10)
+            return write(*args, **kwargs)
+        hook._write = slow_write
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            hook.save(sess, 0)
+            assert writing.wait(10)
+            # The writer is busy: the save of step 1 is superseded
+            start = time.time()
+            hook.save(sess, 1)
+            hook.save(sess, 2)
+            assert time.time() - start < 5
+            release.set()
+            sess.run(tf.assign(global_step, 2))
+            hook.end(sess)
+        ckpt = tf.train.get_checkpoint_state(save_path)
+        assert list(ckpt.all_model_checkpoint_paths) == [
+            hook.checkpoint_path(step) for step in [0, 2]]
+finally:
+    shutil.rmtree(save_path)
+print('The pending checkpoints are coalesced')
+
+
+class FakeTimings(object):
+    @contextmanager
+    def time(self, phase):
+        yield
+
+
+class StepHook(tf.train.SessionRunHook):
+    """Keep the step counters of the main loop"""
+    def __init__(self, exp):
+        self.exp = exp
+
+    def after_run(self, run_context, run_values):
+        self.exp.global_step_val = self.exp.epoch_id = self._step
+        self._step += 1
+
+    def begin(self):
+        self._step = 0
+
+
+# The best model is promoted from the checkpoints of the saver hook
+save_path = tempfile.mkdtemp()
+try:
+    with tf.Graph().as_default():
+        global_step = tf.Variable(0, trainable=False, name='global_step')
+        tf.Variable([1., 2.], name='w')
+        train_op = tf.assign_add(global_step, 1)
+        cfg = Namespace(patience=5, min_epochs=1, max_epochs=4,
+                        async_checkpoints=True, async_validation=False,
+                        quick_val_every_steps=0, val_skip_first=0,
+                        val_every_epochs=1, val_every_steps=0,
+                        val_every_secs=0, val_on_sets=['valid'],
+                        early_stop_set='valid', early_stop_metric='loss',
+                        early_stop_strategy='min', early_stop_delta=0,
+                        early_stop_smoothing=0, save_path=save_path,
+                        checkpoints_to_keep=5)
+        scores = iter([4., 3., 2., 1.])
+        exp = Namespace(cfg=cfg, global_step=global_step,
+                        train=Namespace(nbatches=1), epoch_id=0,
+                        summary_writer=FakeSummaryWriter(),
+                        timings=FakeTimings(),
+                        default_validate_fn=lambda *args: None,
+                        validate_sets=lambda sets: {'valid': next(scores)})
+        # Periodic checkpoints at steps 1 and 3, and at the validated
+        # steps
+        exp.saver_hook = AsyncCheckpointSaverHook(exp, save_path,
+                                                  save_steps=2,
+                                                  writer_timeout=10)
+        hooks = [StepHook(exp), exp.saver_hook, EarlyStopHook(exp)]
+        with tf.train.MonitoredSession(hooks=hooks) as sess:
+            while not sess.should_stop():
+                sess.run(train_op)
+
+    def path(name, step):
+        return os.path.join(save_path, '%s-%d' % (name, step))
+    # The validated steps are checkpointed once, and hard-linked
+    for step in [1, 2, 3, 4]:
+        assert os.path.samefile(path('best.ckpt', step) + '.index',
+                                path('model.ckpt', step) + '.index')
+    assert tf.train.latest_checkpoint(
+        save_path, 'best_checkpoint') == path('best.ckpt', 4)
+    ckpt = tf.train.get_checkpoint_state(save_path)
+    assert list(ckpt.all_model_checkpoint_paths) == [
+        path('model.ckpt', step) for step in [1, 2, 3, 4]]
+    # The checkpoints come with the meta graph
+    with tf.Graph().as_default(), tf.Session() as sess:
+        saver = tf.train.import_meta_graph(path('model.ckpt', 4) + '.meta')
+        saver.restore(sess, path('model.ckpt', 4))
+        assert sess.run('global_step:0') == 4
+finally:
+    shutil.rmtree(save_path)
+print('The best checkpoints are promoted at the right step')
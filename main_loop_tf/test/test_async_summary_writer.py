@@ -0,0 +1,58 @@
+import threading
+
+import tensorflow as tf
+
+from main_loop_tf.utils import AsyncSummaryWriter
+
+
+class FakeWriter(object):
+    def __init__(self):
+        self.written = []
+        self.flushes = 0
+        self.closed = False
+        self.block = threading.Event()
+
+    def add_summary(self, summary, global_step):
+        self.block.wait()
+        self.written.append((global_step, [v.tag for v in summary.value]))
+
+    def flush(self):
+        self.flushes += 1
+
+    def close(self):
+        self.closed = True
+
+
+def summary(tag, value):
+    return tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value)])
+
+
+# The summaries of the same step are merged, serialized or not
+fake = FakeWriter()
+fake.block.set()
+writer = AsyncSummaryWriter(fake, max_queue=10)
+writer.add_summary(summary('a', 1.).SerializeToString(), 1)
+writer.add_summary(summary('b', 2.), 1)
+writer.flush()
+writer.add_summary(summary('a', 3.), 2)
+writer.close()
+print(fake.written)
+assert [tags for _, tags in fake.written] in ([['a', 'b'], ['a']],
+                                              [['a'], ['b'], ['a']])
+assert fake.written[-1] == (2, ['a'])
+assert fake.closed and fake.flushes >= 2
+
+# A full queue drops the summaries instead of blocking
+for policy, expected in [('oldest', [8, 9]), ('newest', [0, 1])]:
+    fake = FakeWriter()
+    writer = AsyncSummaryWriter(fake, max_queue=2, drop_policy=policy)
+    for step in range(10):
+        writer.add_summary(summary('a', step), step)
+    fake.block.set()
+    writer.close()
+    steps = [s for s, _ in fake.written]
+    print(policy, steps, writer.dropped)
+    # The writer thread might have taken the first summary before the
+    # queue got full
+    assert steps[-2:] == expected or steps[1:] == expected
+print('Summaries are written asynchronously')
@@ -95,3 +95,42 @@ with tf.Session().as_default() as sess:
     # mix 2
     pprint_run({g11: 5, g12: 2., g13: 0,
                 g21: 2, g22: 5., g23: 0.5}, avg12)
+
+    # MASKED: one op for any number of devices
+    print('\nMASKED')
+    num_devs = tf.placeholder(tf.int32, name='num_devs')
+    avg_masked = average_gradients(dev_grads12, 'avg_masked',
+                                   sym_num_devs=num_devs)
+    avg_masked = [el0 for el0, el1 in avg_masked]  # strip non-tensors
+    feed_dict = {g11: 3, g12: 2., g13: 2,
+                 g21: float('nan'), g22: 1., g23: 0.5}
+    # The second device is not in use: its NaN must not be propagated
+    masked_num = sess.run(avg_masked, dict(feed_dict, **{num_devs: 1}))
+    avg1_num = sess.run(avg1, feed_dict)
+    assert masked_num == avg1_num, (masked_num, avg1_num)
+    feed_dict[g21] = 1
+    masked_num = sess.run(avg_masked, dict(feed_dict, **{num_devs: 2}))
+    avg12_num = sess.run(avg12, feed_dict)
+    assert masked_num == avg12_num, (masked_num, avg12_num)
+    print('Masked averages match the per-device-count averages')
+
+    # FUSED: buckets of dense gradients and sparse gradients
+    print('\nFUSED')
+    dense = [tf.placeholder(tf.float32, [2, 3]) for _ in range(4)]
+    sparse = [tf.IndexedSlices(tf.placeholder(tf.float32, [None, 3]),
+                               tf.placeholder(tf.int32, [None]),
+                               tf.constant([10, 3])) for _ in range(2)]
+    dev_grads = {'d1': dense[:2], 'd2': dense[2:], 's': sparse}
+    fused = dict((v, g) for g, v in average_gradients(
+        dev_grads, 'avg_fused', sym_num_devs=num_devs, bucket_size=48))
+    assert isinstance(fused['s'], tf.IndexedSlices)
+    feed_dict = {num_devs: 2,
+                 sparse[0].values: [[1, 1, 1]], sparse[0].indices: [0],
+                 sparse[1].values: [[3, 3, 3]], sparse[1].indices: [0]}
+    for i, d in enumerate(dense):
+        feed_dict[d] = [[i] * 3] * 2
+    d1, d2, s = sess.run([fused['d1'], fused['d2'],
+                          tf.convert_to_tensor(fused['s'])], feed_dict)
+    assert (d1 == 0.5).all() and (d2 == 2.5).all(), (d1, d2)
+    assert (s[0] == 2).all() and (s[1:] == 0).all(), s
+    print('Fused averages match the per-variable averages')
@@ -0,0 +1,89 @@
+from argparse import Namespace
+import os
+import shutil
+import tempfile
+
+import tensorflow as tf
+
+from hooks import EarlyStopHook
+
+
+class FakeSaverHook(object):
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = checkpoint_dir
+        self.saved = []
+
+    def checkpoint_path(self, global_step):
+        return os.path.join(self.checkpoint_dir,
+                            'model.ckpt-%d' % global_step)
+
+    def when_saved(self, global_step, callback):
+        self.saved.append(global_step)
+
+    def unpin(self, global_step):
+        pass
+
+
+save_path = tempfile.mkdtemp()
+try:
+    cfg = Namespace(patience=2, min_epochs=1, async_checkpoints=True,
+                    async_validation=False, quick_val_every_steps=0,
+                    val_on_sets=['valid', 'test'], early_stop_set='all',
+                    early_stop_metric='loss', early_stop_strategy='min',
+                    early_stop_delta=0.1, early_stop_smoothing=0,
+                    save_path=save_path, checkpoints_to_keep=1)
+    exp = Namespace(cfg=cfg, default_validate_fn=None,
+                    saver_hook=FakeSaverHook(save_path))
+    hook = EarlyStopHook(exp)
+
+    # The loss is averaged over the sets and has to improve by delta
+    for step, loss in enumerate([1., 0.95, 0.8, 0.9, 0.85, 0.85]):
+        assert not hook._early_stopped
+        metrics_val = {'valid': {'loss': loss - 0.1, 'mean_iou': 0.},
+                       'test': {'loss': loss + 0.1, 'mean_iou': 0.}}
+        hook._update(metrics_val, epoch_id=step, global_step=step,
+                     session=None)
+    assert abs(hook.best_score - 0.8) < 1e-6, hook.best_score
+    assert exp.saver_hook.saved == [0, 2]
+    assert hook._early_stopped
+
+    # The score is smoothed before being compared
+    cfg.early_stop_set = 'valid'
+    cfg.early_stop_strategy = 'max'
+    cfg.early_stop_delta = 0
+    cfg.early_stop_smoothing = 0.5
+    hook = EarlyStopHook(exp)
+    for score in [1., 0., 0.]:
+        hook._update({'valid': score}, epoch_id=0, global_step=0,
+                     session=None)
+    assert hook.best_score == 1. and hook._smoothed_score == 0.25
+
+    # The best checkpoints are hard-links of the saved ones
+    for step in [5, 7]:
+        path = exp.saver_hook.checkpoint_path(step)
+        for ext in ['.index', '.data-00000-of-00001']:
+            with open(path + ext, 'w') as f:
+                f.write(str(step))
+        hook._promote(path)
+        best = os.path.join(save_path, 'best.ckpt-%d.index' % step)
+        assert os.path.samefile(best, path + '.index')
+    # Only `checkpoints_to_keep` best checkpoints are kept
+    assert not os.path.exists(os.path.join(save_path, 'best.ckpt-5.index'))
+    assert tf.train.latest_checkpoint(
+        save_path, 'best_checkpoint').endswith('best.ckpt-7')
+finally:
+    shutil.rmtree(save_path)
+print('The early stopping works as expected')
+
+# Only the variables the validation reads are snapshotted
+with tf.Graph().as_default():
+    global_step = tf.Variable(0, trainable=False, name='global_step')
+    w = tf.Variable([1., 2.], name='w')
+    optimizer = tf.train.AdamOptimizer()
+    optimizer.minimize(tf.reduce_sum(w * w), global_step)
+    cfg.precision = 'float32'
+    exp = Namespace(cfg=cfg, default_validate_fn=None, optimizer=optimizer)
+    hook = EarlyStopHook(exp)
+    assert [v.op.name for v in hook._snapshot_variables()] == [
+        'global_step', 'w']
+print('The snapshot excludes the variables of the optimizer')
@@ -0,0 +1,13 @@
+import os
+from subprocess import check_output
+
+from main_loop_tf.utils import get_git_revision
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+expected = check_output('git rev-parse HEAD', cwd=cwd, shell=True).strip()
+revision = get_git_revision(cwd)
+print(revision)
+assert revision == expected.decode('ascii')
+# The result is cached
+assert get_git_revision(cwd) is revision
+print('The revision matches git rev-parse HEAD')
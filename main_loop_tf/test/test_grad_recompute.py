@@ -0,0 +1,41 @@
+import numpy as np
+import tensorflow as tf
+from tensorflow.contrib import slim
+
+from optimization import gradients_with_recomputation, GRAD_CHECKPOINTS
+
+with tf.Session().as_default() as sess:
+    x = tf.placeholder(tf.float32, [2, 16, 16, 3])
+    net = x
+    with tf.device('/cpu:0'):
+        for i in range(6):
+            net = slim.conv2d(net, 8, (3, 3), scope='conv%d' % i)
+            if i % 2:
+                tf.add_to_collection(GRAD_CHECKPOINTS, net)
+            # Stateful ops should not be recomputed
+            net = tf.nn.dropout(net, 0.9, seed=i)
+        loss = tf.reduce_mean(net ** 2)
+    var_list = tf.trainable_variables()
+
+    grads = tf.gradients(loss, var_list)
+    grads_auto = gradients_with_recomputation([loss], var_list)
+    grads_coll = gradients_with_recomputation(
+        [loss], var_list, tf.get_collection(GRAD_CHECKPOINTS))
+    # The recomputed convolutions keep their device and run after the
+    # forward pass
+    convs = [op for op in tf.get_default_graph().get_operations()
+             if op.type == 'Conv2D']
+    assert len(convs) > 6
+    assert all('cpu:0' in op.device.lower() for op in convs)
+    assert all(op.control_inputs for op in convs[6:])
+    sess.run(tf.global_variables_initializer())
+
+    # Evaluate all the gradients in the same run, to share the dropout
+    feed_dict = {x: np.random.rand(2, 16, 16, 3)}
+    out, out_auto, out_coll = sess.run([grads, grads_auto, grads_coll],
+                                       feed_dict)
+    for v, g, g_auto, g_coll in zip(var_list, out, out_auto, out_coll):
+        print(v.op.name, np.abs(g - g_auto).max(), np.abs(g - g_coll).max())
+        assert np.allclose(g, g_auto, atol=1e-6)
+        assert np.allclose(g, g_coll, atol=1e-6)
+print('The recomputed gradients match')
@@ -0,0 +1,87 @@
+from collections import namedtuple
+
+import numpy as np
+import tensorflow as tf
+
+from optimization import (apply_gradients_with_loss_scale, get_loss_scale,
+                          unscale_gradients)
+from utils import fp32_storage_getter
+
+Cfg = namedtuple('Cfg', ['loss_scale', 'loss_scale_init',
+                         'loss_scale_period'])
+cfg = Cfg(loss_scale=0, loss_scale_init=2. ** 15, loss_scale_period=2)
+
+with tf.Session().as_default() as sess:
+    # The variables are stored in float32 and cast to bfloat16
+    with tf.variable_scope('model', custom_getter=fp32_storage_getter):
+        w = tf.get_variable('w', [2], dtype=tf.bfloat16,
+                            initializer=tf.ones_initializer())
+        # So are the non-trainable ones, e.g., the moving statistics
+        m = tf.get_variable('moving_mean', [2], dtype=tf.bfloat16,
+                            initializer=tf.zeros_initializer(),
+                            trainable=False)
+    master_w, = tf.trainable_variables()
+    assert master_w.dtype.base_dtype == tf.float32
+    assert w.dtype == tf.bfloat16
+    master_m, = [v for v in tf.global_variables()
+                 if v.op.name == 'model/moving_mean']
+    assert master_m.dtype.base_dtype == tf.float32
+    assert m.dtype == tf.bfloat16
+
+    global_step = tf.Variable(0, trainable=False, name='global_step')
+    loss_scale, good_steps = get_loss_scale(cfg)
+    x = tf.placeholder(tf.float32, [2], name='x')
+    loss = tf.reduce_sum(tf.cast(w * tf.cast(x, tf.bfloat16), tf.float32))
+    grads_and_vars = tf.train.GradientDescentOptimizer(1.).compute_gradients(
+        loss * loss_scale, [master_w])
+    assert grads_and_vars[0][0].dtype == tf.float32
+    grads_and_vars = unscale_gradients(grads_and_vars, loss_scale)
+    train_op = apply_gradients_with_loss_scale(
+        cfg, tf.train.GradientDescentOptimizer(1.), grads_and_vars,
+        global_step, loss_scale, good_steps)
+    sess.run(tf.global_variables_initializer())
+
+    # The gradients are unscaled
+    sess.run(train_op, {x: [1., 2.]})
+    assert np.allclose(sess.run(master_w), [0., -1.])
+    assert sess.run([loss_scale, good_steps]) == [2. ** 15, 1]
+
+    # The scale is doubled after `loss_scale_period` good steps
+    sess.run(train_op, {x: [1., 2.]})
+    assert np.allclose(sess.run(master_w), [-1., -3.])
+    assert sess.run([loss_scale, good_steps]) == [2. ** 16, 0]
+
+    # The update is skipped on overflow and the scale halved
+    sess.run(train_op, {x: [np.inf, 1.]})
+    assert np.allclose(sess.run(master_w), [-1., -3.])
+    assert sess.run([loss_scale, good_steps]) == [2. ** 15, 0]
+    assert sess.run(global_step) == 3
+print('The loss is correctly scaled')
+
+
+def train_with_lr_schedule(mixed, nsteps=3):
+    """Return the weights after `nsteps` with a lr of `global_step + 1`"""
+    with tf.Graph().as_default(), tf.Session() as sess:
+        global_step = tf.Variable(0, trainable=False, name='global_step')
+        w = tf.Variable(0., name='w')
+        lr = tf.cast(global_step + 1, tf.float32)
+        optimizer = tf.train.GradientDescentOptimizer(lr)
+        if mixed:
+            loss_scale, good_steps = get_loss_scale(cfg)
+            grads_and_vars = unscale_gradients(
+                optimizer.compute_gradients(w * loss_scale, [w]), loss_scale)
+            train_op = apply_gradients_with_loss_scale(
+                cfg, optimizer, grads_and_vars, global_step, loss_scale,
+                good_steps)
+        else:
+            train_op = optimizer.minimize(w, global_step)
+        sess.run(tf.global_variables_initializer())
+        for _ in range(nsteps):
+            sess.run(train_op)
+        return sess.run(w)
+
+
+# The optimizer sees the step before the increment, as in float32
+for _ in range(10):
+    assert train_with_lr_schedule(True) == train_with_lr_schedule(False) == -6.
+print('The learning rate schedule sees the same steps in mixed precision')
@@ -0,0 +1,22 @@
+import numpy as np
+import tensorflow as tf
+
+from main_loop_tf.utils import normalize_per_image
+
+rng = np.random.RandomState(0)
+# A batch of images and a batch of videos
+for shape in [(2, 5, 6, 3), (2, 4, 5, 6, 3)]:
+    data = rng.randint(0, 256, size=shape).astype('uint8')
+    # The float path: each image or frame is normalized on its own
+    x = data.astype('float32') / 255.
+    frames = x.reshape((-1,) + shape[-3:])
+    expected = np.array([(f - f.mean(axis=(0, 1))) / f.std(axis=(0, 1))
+                         for f in frames]).reshape(shape)
+
+    with tf.Graph().as_default():
+        x = tf.cast(tf.constant(data), tf.float32) / 255.
+        x = normalize_per_image(x, remove_mean=True, divide_by_std=True)
+        with tf.Session() as sess:
+            out = sess.run(x)
+    assert np.allclose(out, expected, atol=1e-4), shape
+print('The images and the frames are normalized independently')
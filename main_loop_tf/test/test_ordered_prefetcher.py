@@ -0,0 +1,79 @@
+import random
+import time
+
+from main_loop_tf.utils import OrderedPrefetcher
+
+n = 50
+max_ahead = 4
+
+
+class Sequence(object):
+    """A non thread-safe sequence that checks it is never called
+    concurrently"""
+    def __init__(self):
+        self.i = 0
+        self.calls = 0
+
+    def next(self):
+        self.calls += 1
+        assert self.calls == 1, 'fetch called concurrently'
+        time.sleep(random.random() * 1e-3)
+        ret = self.i
+        self.i += 1
+        self.calls -= 1
+        return ret
+
+
+def process(i):
+    time.sleep(random.random() * 1e-2)
+    return i * 2
+
+
+seq = Sequence()
+prefetcher = OrderedPrefetcher(seq.next, process, n, nthreads=4,
+                               max_ahead=max_ahead)
+out = []
+for el in prefetcher:
+    # Never more than `max_ahead` elements are prepared in advance
+    assert seq.i <= len(out) + 1 + max_ahead
+    out.append(el)
+assert out == [2 * i for i in range(n)], out
+assert seq.i == n
+
+
+# Errors are raised in order
+def failing_process(i):
+    if i == 5:
+        raise ValueError(i)
+    return i
+
+
+prefetcher = OrderedPrefetcher(Sequence().next, failing_process, n,
+                               nthreads=4)
+out = []
+try:
+    for el in prefetcher:
+        out.append(el)
+except ValueError:
+    assert out == list(range(5)), out
+else:
+    raise AssertionError('The error was not raised')
+
+# The threads can be stopped early
+prefetcher = OrderedPrefetcher(Sequence().next, process, n, nthreads=4)
+next(prefetcher)
+prefetcher.close()
+assert not any(th.is_alive() for th in prefetcher._threads)
+
+# An endless sequence, e.g., the training minibatches
+prefetcher = OrderedPrefetcher(Sequence().next, process, None, nthreads=4,
+                               max_ahead=max_ahead)
+out = [next(prefetcher) for _ in range(2 * n)]
+assert out == [2 * i for i in range(2 * n)], out
+time.sleep(0.1)
+assert prefetcher.ready() == max_ahead
+assert prefetcher.n_processed == 2 * n + max_ahead
+prefetcher.close()
+# The elements discarded by close are not counted
+assert prefetcher.n_processed == 2 * n + max_ahead
+print('The sequence is prefetched in order')
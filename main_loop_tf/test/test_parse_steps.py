@@ -0,0 +1,7 @@
+from main_loop_tf.utils import parse_steps
+
+assert parse_steps('') == set()
+assert parse_steps('100') == {100}
+assert parse_steps('100,200:203') == {100, 200, 201, 202}
+assert parse_steps(' 5 , 1:3,5') == {1, 2, 5}
+print('Steps parsed correctly')
@@ -0,0 +1,23 @@
+import tensorflow as tf
+
+from main_loop_tf.utils import retag_summary
+
+with tf.Graph().as_default():
+    with tf.name_scope('V.aggregated_stats'):
+        loss = tf.summary.scalar('avg_loss', tf.constant(1.))
+    other = tf.summary.scalar('other', tf.constant(2.))
+    merged = tf.summary.merge([loss, other])
+    with tf.Session() as sess:
+        serialized = sess.run(merged)
+for s in ['valid', 'test']:
+    summary = retag_summary(serialized, 'V.', 'V_' + s + '.')
+    tags = [v.tag for v in summary.value]
+    # Only the tags of the shared graph are moved to the set's family
+    assert sorted(tags) == ['V_%s.aggregated_stats/avg_loss' % s, 'other'], \
+        tags
+# The summary protos are not modified
+summary = tf.Summary.FromString(serialized)
+assert retag_summary(summary, 'V.', 'V_valid.') is not summary
+assert sorted(v.tag for v in summary.value) == [
+    'V.aggregated_stats/avg_loss', 'other']
+print('The summaries are retagged per set')
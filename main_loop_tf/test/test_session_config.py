@@ -0,0 +1,32 @@
+from argparse import Namespace
+
+import tensorflow as tf
+from tensorflow.core.protobuf.rewriter_config_pb2 import RewriterConfig
+
+from main_loop_tf.utils import get_tf_config, parse_cpus
+
+assert parse_cpus(None) == set()
+assert parse_cpus(['0-3', '8', ' ']) == {0, 1, 2, 3, 8}
+
+cfg = Namespace(intra_op_threads=4, inter_op_threads=2, xla_jit='session',
+                grappler_options=['constant_folding=off',
+                                  'disable_model_pruning=true'])
+config = get_tf_config(cfg)
+assert config.allow_soft_placement
+assert config.intra_op_parallelism_threads == 4
+assert config.inter_op_parallelism_threads == 2
+assert (config.graph_options.optimizer_options.global_jit_level ==
+        tf.OptimizerOptions.ON_1)
+rewrite_options = config.graph_options.rewrite_options
+assert rewrite_options.constant_folding == RewriterConfig.OFF
+assert rewrite_options.disable_model_pruning
+
+for bad in ['not_an_option=on', 'constant_folding=maybe']:
+    cfg.grappler_options = [bad]
+    try:
+        get_tf_config(cfg)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('{} should be rejected'.format(bad))
+print('The session is correctly configured')
@@ -47,3 +47,17 @@ for p_dict, batch_dict in zip_longest(placeholders,
         feed_dict[p_obj] = batch_dict[p_name]
 
 pprint(feed_dict)
+
+
+# The chunks should match np.array_split and be views on the minibatch
+for nsplits in range(1, bs + 1):
+    ret = split_in_chunks(minibatch, nsplits)
+    for k in ['data', 'labels']:
+        expected = np.array_split(minibatch[k], nsplits)
+        for chunk, exp in zip([r[k] for r in ret], expected):
+            if k == 'labels':
+                exp = exp.flatten()
+            assert np.array_equal(chunk, exp)
+            assert chunk.size == 0 or np.may_share_memory(chunk,
+                                                          minibatch[k])
+print('Chunks match np.array_split and share memory with the minibatch')
@@ -0,0 +1,34 @@
+import numpy as np
+import tensorflow as tf
+
+from optimization import streaming_segmentation_metrics
+
+num_classes = 3
+void_labels = [3]
+
+with tf.Session().as_default() as sess:
+    labels = tf.placeholder(tf.int32, [None])
+    pred = tf.placeholder(tf.int64, [None])
+    loss = tf.placeholder(tf.float32, [])
+    num_batches = tf.placeholder(tf.int32, [])
+    metrics = streaming_segmentation_metrics(labels, pred, loss, num_batches,
+                                             num_classes, void_labels)
+    sess.run(tf.local_variables_initializer())
+
+    batches = [([0, 1, 2, 3], [0, 1, 1, 2], 1., 2),
+               ([2, 2, 3, 0], [2, 0, 0, 0], 4., 1)]
+    for epoch in range(2):
+        sess.run(metrics['reset_op'])
+        for lab, p, ls, nb in batches:
+            sess.run(metrics['update_op'], {labels: lab, pred: p, loss: ls,
+                                            num_batches: nb})
+        values = sess.run(metrics['values'])
+        # Confusion matrix without the void pixels:
+        #   label 0 -> 0, 0; label 1 -> 1; label 2 -> 1, 2, 0
+        expected_iou = [2. / 3, 1. / 2, 1. / 3]
+        print(values)
+        assert np.allclose(values['per_class_iou'], expected_iou)
+        assert np.isclose(values['mean_iou'], np.mean(expected_iou))
+        assert np.isclose(values['accuracy'], 4. / 6)
+        assert np.isclose(values['loss'], (1. * 2 + 4. * 1) / 3)
+print('The metrics are correctly accumulated')
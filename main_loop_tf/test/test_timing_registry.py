@@ -0,0 +1,37 @@
+import threading
+
+from main_loop_tf.utils import NullTimingRegistry, TimingRegistry
+
+timings = TimingRegistry(window=100)
+
+# Only the last `window` durations are kept
+for i in range(200):
+    timings.add('sess_run', float(i))
+stats = timings.percentiles()
+print(stats)
+assert stats['sess_run']['n'] == 100
+assert stats['sess_run']['p50'] == 149.5
+assert stats['sess_run']['p99'] >= stats['sess_run']['p95'] >= 149.5
+
+# The context manager records one duration per block
+with timings.time('split'):
+    pass
+assert timings.percentiles()['split']['n'] == 1
+
+# Concurrent updates are not lost
+threads = [threading.Thread(target=lambda: [timings.add('feed_dict', 0.)
+                                            for _ in range(50)])
+           for _ in range(4)]
+for th in threads:
+    th.start()
+for th in threads:
+    th.join()
+assert timings.percentiles()['feed_dict']['n'] == 100
+print('Timings are correctly recorded')
+
+# The disabled timings record nothing
+timings = NullTimingRegistry()
+with timings.time('split'):
+    timings.add('sess_run', 1.)
+assert timings.percentiles() == {}
+print('Disabled timings are not recorded')
@@ -1,11 +1,13 @@
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 import logging
 import os
-from subprocess import check_output
-import sys
+from subprocess import CalledProcessError, check_output
+import threading
+from time import time
 import tqdm
 
 import gflags
-import matplotlib
 import numpy as np
 import tensorflow as tf
 
@@ -13,9 +15,6 @@ import tensorflow as tf
 # import settings  # noqa
 
 
-# Force matplotlib not to use any Xwindows backend.
-matplotlib.use('Agg')
-sys.setrecursionlimit(99999)
 tf.logging.set_verbosity(tf.logging.INFO)
 
 
@@ -25,15 +24,26 @@ def split_in_chunks(minibatch, num_splits, flatten_keys=['labels']):
     Return a list of dictionaries, one per device. Each dictionary
     contains, for each key, the values that should be allocated on its
     device.
+
+    The chunks are split along the first axis as in `np.array_split`,
+    but are views on the minibatch rather than copies: each value is
+    copied at most once, only if it is not C-contiguous, and the keys
+    in `flatten_keys` are flattened with a reshape that does not copy
+    either. Copy the chunks if you need to modify them in place.
     '''
-    # Split the value of each key into chunks
-    out = {}
+    out = [{} for _ in range(num_splits)]
     for k, v in minibatch.iteritems():
-        out[k] = np.array_split(v.copy(), num_splits)
-        if any(k == v for v in flatten_keys):
-            out[k] = [el.flatten() for el in out[k]]
-    return map(dict, zip(*[[(k, v) for v in value]
-                           for k, value in out.items()]))
+        v = np.ascontiguousarray(v)  # no-op if already contiguous
+        flatten = k in flatten_keys
+        # The first `extras` chunks have one extra element
+        chunk_len, extras = divmod(len(v), num_splits)
+        start = 0
+        for i, dev_dict in enumerate(out):
+            end = start + chunk_len + (1 if i < extras else 0)
+            chunk = v[start:end]
+            dev_dict[k] = chunk.reshape(-1) if flatten else chunk
+            start = end
+    return out
 
 
 def apply_loss(labels, net_out, loss_fn, weight_decay, is_training,
@@ -85,12 +95,83 @@ def apply_l2_penalty(loss, weight_decay):
     return loss
 
 
+# The git revisions and diffs, computed at most once per process
+_git_cache = {}
+
+
+def _find_git_dir(path):
+    """Return the .git directory of the repository containing path"""
+    path = os.path.realpath(path)
+    while True:
+        git_dir = os.path.join(path, '.git')
+        if os.path.isfile(git_dir):
+            # A worktree or a submodule
+            with open(git_dir) as f:
+                line = f.read().strip()
+            if line.startswith('gitdir:'):
+                return os.path.join(path, line[len('gitdir:'):].strip())
+        if os.path.isdir(git_dir):
+            return git_dir
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def get_git_revision(path):
+    """Return the hash of the HEAD of the repository containing path
+
+    The git files are read directly, rather than running `git
+    rev-parse HEAD` in a subprocess. Return -1 if path is not in a git
+    repository.
+    """
+    key = ('revision', os.path.realpath(path))
+    if key not in _git_cache:
+        _git_cache[key] = -1
+        git_dir = _find_git_dir(path)
+        try:
+            with open(os.path.join(git_dir, 'HEAD')) as f:
+                head = f.read().strip()
+            if head.startswith('ref:'):
+                ref = head[len('ref:'):].strip()
+                # The refs of the worktrees are in the common dir
+                common_dir = git_dir
+                if os.path.exists(os.path.join(git_dir, 'commondir')):
+                    with open(os.path.join(git_dir, 'commondir')) as f:
+                        common_dir = os.path.join(git_dir, f.read().strip())
+                ref_path = os.path.join(common_dir, ref)
+                if os.path.exists(ref_path):
+                    with open(ref_path) as f:
+                        head = f.read().strip()
+                else:
+                    with open(os.path.join(common_dir, 'packed-refs')) as f:
+                        for line in f:
+                            if line.strip().endswith(' ' + ref):
+                                head = line.split()[0]
+                                break
+            if len(head) == 40:
+                _git_cache[key] = head
+        except (IOError, OSError, TypeError, AttributeError):
+            pass
+    return _git_cache[key]
+
+
+def get_git_diff(path):
+    """Return the `git diff` of the repository containing path"""
+    key = ('diff', os.path.realpath(path))
+    if key not in _git_cache:
+        try:
+            _git_cache[key] = check_output('git diff', cwd=path, shell=True)
+        except (CalledProcessError, OSError):
+            _git_cache[key] = ''
+    return _git_cache[key]
+
+
 def save_repos_hash(params_dict, this_repo_name, packages=['theano']):
     # Repository hash and diff
     cwd = os.path.dirname(os.path.realpath(__file__))
-    params_dict[this_repo_name + '_hash'] = check_output(
-        'git rev-parse HEAD', cwd=cwd, shell=True)[:-1]
-    diff = check_output('git diff', cwd=cwd, shell=True)
+    params_dict[this_repo_name + '_hash'] = get_git_revision(cwd)
+    diff = get_git_diff(cwd)
     if diff != '':
         params_dict[this_repo_name + '_diff'] = diff
     # packages
@@ -124,6 +205,47 @@ def fig2array(fig):
     return buf
 
 
+def fp32_storage_getter(getter, name, shape=None, dtype=None,
+                        initializer=None, regularizer=None, trainable=True,
+                        *args, **kwargs):
+    """A custom getter that stores the float variables in float32
+
+    The variables requested with a reduced precision dtype, trainable
+    or not, are created in float32 and cast to the requested dtype, so
+    that the updates, e.g., those of the weights (the "master weights")
+    or of the moving statistics of the batch normalization, are
+    accumulated in full precision.
+    """
+    reduced = (dtype is not None and tf.as_dtype(dtype).is_floating and
+               tf.as_dtype(dtype) != tf.float32 and
+               tf.as_dtype(dtype) != tf.float64)
+    storage_dtype = tf.float32 if reduced else dtype
+    var = getter(name, shape, dtype=storage_dtype, initializer=initializer,
+                 regularizer=regularizer, trainable=trainable, *args,
+                 **kwargs)
+    if reduced:
+        var = tf.cast(var, dtype)
+    return var
+
+
+def normalize_per_image(x, remove_mean, divide_by_std):
+    """Normalize each image, or each frame of a video, in the graph
+
+    The statistics are computed over the spatial axes only, i.e., the
+    two axes before the channels, so that the frames of a
+    [batch, time, height, width, channels] video are normalized
+    independently, as the dataset does.
+    """
+    ndims = x.get_shape().ndims
+    axes = list(range(ndims - 3, ndims - 1))
+    if remove_mean:
+        x -= tf.reduce_mean(x, axis=axes, keep_dims=True)
+    if divide_by_std:
+        _, var = tf.nn.moments(x, axes, keep_dims=True)
+        x /= tf.sqrt(var)
+    return x
+
+
 def squash_maybe(scope_str, var_name, up_to=2):
     """Potentially squash name_scopes together.
 
@@ -150,6 +272,155 @@ def squash_maybe(scope_str, var_name, up_to=2):
     return scope_str, var_name
 
 
+# The summaries are grouped in tiers that are run at different frequencies
+SUMMARY_TIERS = ('scalars', 'norms', 'histograms')
+
+
+def summary_tier(summary):
+    """Return the tier of a summary
+
+    The histograms are the most expensive to compute and write, the
+    norms of the weights and of the gradients require a reduction on
+    every variable, the other scalars (e.g., the losses) are cheap.
+    """
+    if summary.op.type == 'HistogramSummary':
+        return 'histograms'
+    if 'grad_norms' in summary.op.name or 'weights_norms' in summary.op.name:
+        return 'norms'
+    return 'scalars'
+
+
+def retag_summary(summary, old_prefix, new_prefix):
+    """Rename the tags of a summary
+
+    The tags of `summary`, serialized or not, that start with
+    `old_prefix` are prefixed with `new_prefix` instead, e.g., to write
+    the summaries of a graph shared by several validation sets under
+    the family of each set. Return a new :class:`tf.Summary`.
+    """
+    if isinstance(summary, bytes):
+        summary = tf.Summary.FromString(summary)
+    else:
+        summary = tf.Summary.FromString(summary.SerializeToString())
+    for value in summary.value:
+        if value.tag.startswith(old_prefix):
+            value.tag = new_prefix + value.tag[len(old_prefix):]
+    return summary
+
+
+class AsyncSummaryWriter(object):
+    """Write the summaries to the event file from a background thread
+
+    `add_summary` only puts the summary in a bounded queue. A writer
+    thread parses the serialized summaries, merges those of the same
+    step and writes them to `writer` in batches, flushing at most every
+    `flush_secs` seconds. When the queue is full, the oldest or the
+    newest summary is dropped according to `drop_policy`, so that a
+    slow disk never stalls the training.
+
+    Parameters
+    ----------
+        writer: :class:`tf.summary.FileWriter`
+            The writer the summaries are eventually written with.
+        max_queue: int
+            The maximum number of summaries waiting to be written.
+        drop_policy: string
+            Which summary to drop when the queue is full, `oldest` or
+            `newest`.
+        flush_secs: float
+            How frequently the event file is flushed, in seconds.
+    """
+    def __init__(self, writer, max_queue=100, drop_policy='oldest',
+                 flush_secs=10):
+        if drop_policy not in ('oldest', 'newest'):
+            raise ValueError('Unknown drop policy: {}'.format(drop_policy))
+        self.writer = writer
+        self.dropped = 0
+        self._max_queue = max_queue
+        self._drop_policy = drop_policy
+        self._flush_secs = flush_secs
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._flush_requested = False
+        self._thread = threading.Thread(target=self._writer_loop,
+                                        name='AsyncSummaryWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add_summary(self, summary, global_step=None):
+        """Queue a summary, serialized or not, to be written"""
+        with self._cond:
+            if self._closed:
+                return
+            if len(self._queue) >= self._max_queue:
+                if self.dropped == 0:
+                    tf.logging.warn('The summaries queue is full, some '
+                                    'summaries will be dropped')
+                self.dropped += 1
+                if self._drop_policy == 'newest':
+                    return
+                self._queue.popleft()
+            self._queue.append((summary, global_step))
+            self._cond.notify()
+
+    def add_graph(self, *args, **kwargs):
+        self.writer.add_graph(*args, **kwargs)
+
+    def flush(self):
+        """Write the queued summaries and flush the event file"""
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify()
+            while self._flush_requested and self._thread.is_alive():
+                self._cond.wait(1)
+
+    def close(self):
+        """Write the queued summaries and close the event file"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        if self.dropped:
+            tf.logging.warn('{} summaries were dropped'.format(self.dropped))
+        self.writer.close()
+
+    def _writer_loop(self):
+        last_flush = time()
+        while True:
+            with self._cond:
+                while not (self._queue or self._closed or
+                           self._flush_requested):
+                    self._cond.wait(self._flush_secs)
+                    if time() - last_flush >= self._flush_secs:
+                        break
+                batch = list(self._queue)
+                self._queue.clear()
+                closed = self._closed
+                flush = self._flush_requested
+            self._write(batch)
+            if closed or flush or time() - last_flush >= self._flush_secs:
+                self.writer.flush()
+                last_flush = time()
+            if flush:
+                with self._cond:
+                    self._flush_requested = False
+                    self._cond.notify_all()
+            if closed:
+                return
+
+    def _write(self, batch):
+        merged = OrderedDict()
+        for summary, global_step in batch:
+            if not isinstance(summary, tf.Summary):
+                summary = tf.Summary.FromString(summary)
+            if global_step not in merged:
+                merged[global_step] = tf.Summary()
+            merged[global_step].value.extend(summary.value)
+        for global_step, summary in merged.iteritems():
+            self.writer.add_summary(summary, global_step)
+
+
 class TqdmHandler(logging.StreamHandler):
     # From https://github.com/tqdm/tqdm/issues/193#issuecomment-233212170
     def __init__(self):
@@ -160,6 +431,77 @@ class TqdmHandler(logging.StreamHandler):
         tqdm.tqdm.write(msg)
 
 
+class TimingRegistry(object):
+    """Rolling wall-clock timings of the phases of the main loop
+
+    Keep the last `window` durations of each phase and compute their
+    percentiles on demand. It can be updated from several threads.
+
+    Parameters
+    ----------
+        window: int
+            The number of durations to keep per phase.
+    """
+    def __init__(self, window=1000):
+        self._window = window
+        self._times = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self, phase):
+        """Time the enclosed block as `phase`"""
+        start = time()
+        try:
+            yield
+        finally:
+            self.add(phase, time() - start)
+
+    def add(self, phase, secs):
+        with self._lock:
+            if phase not in self._times:
+                self._times[phase] = deque(maxlen=self._window)
+            self._times[phase].append(secs)
+
+    def percentiles(self, percentiles=(50, 95, 99)):
+        """Return the percentiles of the durations of each phase
+
+        Returns
+        -------
+            stats: dict
+                A dictionary per phase, with the `p<N>` percentiles (in
+                seconds) and the number `n` of durations they are
+                computed on.
+        """
+        with self._lock:
+            times = {k: list(v) for k, v in self._times.iteritems()}
+        stats = {}
+        for phase, values in times.iteritems():
+            if not values:
+                continue
+            pvals = np.percentile(values, percentiles)
+            stats[phase] = {'p%d' % p: float(v)
+                            for p, v in zip(percentiles, pvals)}
+            stats[phase]['n'] = len(values)
+        return stats
+
+
+class NullTimingRegistry(object):
+    """A `TimingRegistry` that records nothing
+
+    Used when the timings are disabled, so that the main loop does not
+    pay for the lock and the bookkeeping at every step.
+    """
+    @contextmanager
+    def time(self, phase):
+        yield
+
+    def add(self, phase, secs):
+        pass
+
+    def percentiles(self, percentiles=(50, 95, 99)):
+        return {}
+
+
 def flowToColor(flow, varargin=None):
     '''
     Convert optical flow to RGB image
@@ -364,3 +706,289 @@ def uniquify_path(path, extension=''):
         last_existing_path = unique_path
         unique_path = path + '_' + str(incr_num) + extension
     return last_existing_path, unique_path
+
+
+def parse_steps(steps_spec):
+    """Parse a comma separated list of steps and ranges of steps
+
+    Parameters
+    ----------
+        steps_spec: string
+            A comma separated list of steps (e.g., `100`) and ranges of
+            steps (e.g., `200:210`). As in python slices, the end of a
+            range is excluded.
+
+    Returns
+    -------
+        steps: set
+            The set of the selected steps.
+    """
+    steps = set()
+    for el in steps_spec.split(','):
+        el = el.strip()
+        if el == '':
+            continue
+        if ':' in el:
+            start, stop = el.split(':')
+            steps.update(range(int(start), int(stop)))
+        else:
+            steps.add(int(el))
+    return steps
+
+
+def parse_cpus(cpus):
+    """Parse a list of CPU ids and ranges of CPU ids
+
+    Parameters
+    ----------
+        cpus: list of strings
+            A list of CPU ids (e.g., `4`) and ranges of CPU ids (e.g.,
+            `0-3`, end included as in `taskset`).
+
+    Returns
+    -------
+        cpus: set
+            The set of the selected CPU ids.
+    """
+    ret = set()
+    for el in cpus or []:
+        el = str(el).strip()
+        if el == '':
+            continue
+        if '-' in el:
+            start, stop = el.split('-')
+            ret.update(range(int(start), int(stop) + 1))
+        else:
+            ret.add(int(el))
+    return ret
+
+
+def _libc_affinity(cpus=None):
+    # Python 2 has no os.sched_{get,set}affinity
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    mask_t = ctypes.c_ulong * 16  # Up to 1024 CPUs
+    bits = ctypes.sizeof(ctypes.c_ulong) * 8
+    mask = mask_t()
+    if libc.sched_getaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)):
+        raise OSError(ctypes.get_errno(), 'sched_getaffinity failed')
+    prev = set(i * bits + b for i, word in enumerate(mask)
+               for b in range(bits) if word >> b & 1)
+    if cpus is not None:
+        mask = mask_t()
+        for cpu in cpus:
+            mask[cpu // bits] |= 1 << (cpu % bits)
+        if libc.sched_setaffinity(0, ctypes.sizeof(mask),
+                                  ctypes.byref(mask)):
+            raise OSError(ctypes.get_errno(), 'sched_setaffinity failed')
+    return prev
+
+
+def set_cpu_affinity(cpus):
+    """Restrict the calling thread to a set of CPUs
+
+    On Linux the affinity is a property of the thread, and the threads
+    inherit the affinity of the thread that creates them. This is a
+    no-op if `cpus` is empty.
+
+    Parameters
+    ----------
+        cpus: iterable of ints
+            The CPU ids the thread is allowed to run on.
+
+    Returns
+    -------
+        prev_cpus: set
+            The CPU ids the thread was allowed to run on before the
+            call, or None if `cpus` is empty.
+    """
+    cpus = set(cpus)
+    if not cpus:
+        return None
+    if hasattr(os, 'sched_setaffinity'):
+        prev = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, cpus)
+        return prev
+    return _libc_affinity(cpus)
+
+
+@contextmanager
+def cpu_affinity(cpus):
+    """Restrict the calling thread, and the threads it creates, to a
+    set of CPUs within the context"""
+    prev = set_cpu_affinity(cpus)
+    try:
+        yield
+    finally:
+        if prev is not None:
+            set_cpu_affinity(prev)
+
+
+def get_tf_config(cfg):
+    """Return the session configuration
+
+    Set the size of the thread pools, the global XLA auto-jit and the
+    grappler rewrites according to the flags. Each grappler option is
+    a `name=value` pair, where `name` is a field of
+    `tf.RewriterConfig` and `value` is either a boolean or the name of
+    one of the values of its enum (e.g., `constant_folding=off`,
+    `memory_optimization=heuristics`).
+    """
+    from tensorflow.core.protobuf import rewriter_config_pb2
+    config = tf.ConfigProto(
+        allow_soft_placement=True,
+        intra_op_parallelism_threads=cfg.intra_op_threads,
+        inter_op_parallelism_threads=cfg.inter_op_threads)
+    if cfg.xla_jit == 'session':
+        config.graph_options.optimizer_options.global_jit_level = (
+            tf.OptimizerOptions.ON_1)
+
+    rewrite_options = config.graph_options.rewrite_options
+    fields = rewriter_config_pb2.RewriterConfig.DESCRIPTOR.fields_by_name
+    for opt in cfg.grappler_options or []:
+        name, _, value = opt.partition('=')
+        name, value = name.strip(), value.strip()
+        field = fields.get(name)
+        if field is None:
+            raise ValueError('Unknown grappler option: {}'.format(name))
+        if field.type == field.TYPE_BOOL:
+            if value.lower() not in ('true', 'false'):
+                raise ValueError('Grappler option {} should be true or '
+                                 'false, got {}'.format(name, value))
+            setattr(rewrite_options, name, value.lower() == 'true')
+        elif field.enum_type is not None:
+            enum_value = field.enum_type.values_by_name.get(value.upper())
+            if enum_value is None:
+                raise ValueError('Grappler option {} should be one of {}, '
+                                 'got {}'.format(
+                                     name,
+                                     list(field.enum_type.values_by_name),
+                                     value))
+            setattr(rewrite_options, name, enum_value.number)
+        else:
+            raise ValueError('Unsupported grappler option: {}'.format(name))
+    return config
+
+
+@contextmanager
+def tower_jit_scope(cfg):
+    """Compile the ops created in the context, and their gradients,
+    with XLA if `cfg.xla_jit` is `towers`"""
+    if cfg.xla_jit != 'towers':
+        yield
+        return
+    from tensorflow.contrib.compiler import jit
+    with jit.experimental_jit_scope():
+        yield
+
+
+class OrderedPrefetcher(object):
+    """Prepare the elements of a sequence in parallel, in order
+
+    Iterating over the prefetcher returns `process(fetch())` for `n`
+    consecutive calls to `fetch`. `fetch` is called by one thread at a
+    time, in order, and is meant to be cheap or not thread-safe (e.g.,
+    the `next` method of a dataset). `process` is called by `nthreads`
+    threads in parallel. The results are returned in the order of the
+    calls to `fetch`, and at most `max_ahead` of them are prepared in
+    advance. An exception raised by `fetch` or `process` is raised by
+    the iterator when the element it was raised for is reached.
+
+    `ready()` is the number of elements prepared and not returned yet,
+    `n_processed` the number of elements prepared so far.
+
+    Parameters
+    ----------
+        fetch: callable
+            Return the next element of the sequence.
+        process: callable
+            Process an element of the sequence.
+        n: int or None
+            The number of elements of the sequence. If None, the
+            sequence is endless.
+        nthreads: int
+            The number of threads.
+        max_ahead: int
+            The maximum number of elements processed in advance.
+    """
+    def __init__(self, fetch, process, n, nthreads=1, max_ahead=4):
+        self._fetch = fetch
+        self._process = process
+        self._n = float('inf') if n is None else n
+        self._max_ahead = max(max_ahead, 1)
+        self._fetch_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._results = {}
+        self._next_fetch = 0
+        self._next_out = 0
+        self._closed = False
+        self.n_processed = 0
+        self._threads = []
+        for i in range(max(nthreads, 1)):
+            th = threading.Thread(target=self._worker,
+                                  name='OrderedPrefetcher%d' % i)
+            th.daemon = True
+            th.start()
+            self._threads.append(th)
+
+    def _worker(self):
+        while True:
+            with self._fetch_lock:
+                with self._cond:
+                    while (not self._closed and self._next_fetch < self._n and
+                           self._next_fetch - self._next_out >=
+                           self._max_ahead):
+                        self._cond.wait()
+                    if self._closed or self._next_fetch >= self._n:
+                        return
+                    seq = self._next_fetch
+                    self._next_fetch += 1
+                try:
+                    item = self._fetch()
+                except Exception as e:
+                    item = e
+            if not isinstance(item, Exception):
+                try:
+                    item = self._process(item)
+                except Exception as e:
+                    item = e
+            with self._cond:
+                if self._closed:
+                    return
+                self._results[seq] = item
+                self.n_processed += 1
+                self._cond.notify_all()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._cond:
+            if self._next_out >= self._n:
+                raise StopIteration
+            while self._next_out not in self._results:
+                self._cond.wait()
+            item = self._results.pop(self._next_out)
+            self._next_out += 1
+            self._cond.notify_all()
+        if isinstance(item, Exception):
+            self.close()
+            raise item
+        return item
+
+    next = __next__  # Python 2
+
+    def ready(self):
+        """Return the number of elements ready to be returned"""
+        with self._cond:
+            return len(self._results)
+
+    def close(self):
+        """Stop the threads, discarding the elements not returned yet"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for th in self._threads:
+            th.join()
+        self._results.clear()